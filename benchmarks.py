@@ -0,0 +1,885 @@
+import os
+import time
+import bisect
+import random
+import itertools
+import signal
+import argparse
+import tempfile
+import threading
+import multiprocessing
+import subprocess
+from datetime import datetime
+from socket_utils import serialize262, wait_for_ready_file
+from socket_utils import codecs, read_cluster_config
+from client import ReplicaClient
+from site_store import SiteStore, SiteNameIndex, render_output, aggregate, parse_doses
+from site_store import histogram_bins
+from site_store import numpy, encode_operations
+
+# Benchmarks deploy server replicas on ports assigned by the OS, as for tests.py.
+
+
+class LoadClient(ReplicaClient):
+    """Client generating load; requests return their output, and dummy
+    requests go out every dummy_interval seconds."""
+    def __init__(self, addresses, dummy_interval=.005, ack_timeout=2.0, compression=(),
+                 cache_size=0, learner=None):
+        super(LoadClient, self).__init__(
+            addresses, learners=[learner] if learner is not None else [],
+            ack_timeout=ack_timeout, heartbeat_interval=dummy_interval,
+            compression=compression, cache_size=cache_size,
+            client_id='{}-{}'.format(datetime.now().strftime('%Y%m%d%H%M%S%f'),
+                                     random.getrandbits(32)))
+
+    def request(self, msg_dict):
+        """Issues a request and returns its output."""
+        return super(LoadClient, self).request(msg_dict)['output_msg']
+
+
+def start_servers(num_replicas, *options):
+    """Deploys server replicas in a subprocess; returns it and their addresses."""
+    servers, addresses, _ = start_cluster(num_replicas, 0, *options)
+    return servers, addresses
+
+
+def start_cluster(num_replicas, num_learners, *options):
+    """Deploys server replicas and learners in a subprocess; returns it and
+    the addresses of the replicas and of the learners."""
+    ready_file = os.path.join(tempfile.mkdtemp(), 'ready')
+    servers = subprocess.Popen(["python", "servers.py", str(num_replicas), "--port", "0",
+                                "--learners", str(num_learners),
+                                "--ready-file", ready_file] + list(options),
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    addresses = wait_for_ready_file(ready_file, timeout=10)
+    assert servers.poll() is None
+    return servers, addresses, list(read_cluster_config(ready_file, 'learner').values())
+
+
+def stop_servers(servers):
+    """Shuts down server replicas deployed by start_servers."""
+    # Keyboard interrupt performs cleanup of replica subprocesses
+    servers.send_signal(signal.SIGINT)
+    servers.wait()
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a list of values."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(label, latencies, elapsed):
+    """Prints throughput and latency summary of a benchmark run."""
+    print('{}: {} requests in {:.1f}s ({:.1f} req/s), p50 {:.1f} ms, p99 {:.1f} ms'.format(
+        label, len(latencies), elapsed, len(latencies) / elapsed,
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+
+
+def replica_pids(servers):
+    """Process IDs of the replicas deployed by start_servers."""
+    with open('/proc/{0}/task/{0}/children'.format(servers.pid)) as f:
+        return [int(pid) for pid in f.read().split()]
+
+
+def run_mixed_load(addresses, num_clients, duration, sites, list_ratio,
+                   samples=None, ack_timeout=2.0, before_close=None):
+    """Runs clients issuing a mixed 'l'/'e' load; returns request latencies.
+
+    If samples is given, (start time, latency) pairs are appended to it.
+    If before_close is given, it is called once the load is over, while
+    clients are still connected.
+    """
+    clients = [LoadClient(addresses, ack_timeout=ack_timeout)
+               for _ in range(num_clients)]
+    for c in clients:
+        c.connect()
+
+    latencies = []
+    latencies_lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def load_loop(c):
+        rng = random.Random(c.client_id)
+        while time.time() < deadline:
+            if rng.random() < list_ratio:
+                msg_dict = {'transaction': 'l'}
+            else:
+                msg_dict = {'transaction': 'e', 'site_name': rng.choice(sites),
+                            'vaccine_no': str(rng.randrange(1000))}
+            start = time.time()
+            c.request(msg_dict)
+            with latencies_lock:
+                latencies.append(time.time() - start)
+                if samples is not None:
+                    samples.append((start, latencies[-1]))
+
+    start = time.time()
+    threads = [threading.Thread(target=load_loop, args=(c,)) for c in clients]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    if before_close is not None:
+        before_close()
+    for c in clients:
+        c.close()
+    return latencies, elapsed
+
+
+def bench_pipeline(args):
+    """Throughput of inline versus pipelined reply rendering."""
+    sites = ['Site {}'.format(i) for i in range(args.sites)]
+    for render_workers in (0, 4):
+        servers, addresses = start_servers(args.replicas, '--render-workers',
+                                           str(render_workers))
+        try:
+            # Populate database so that listings are non-trivial
+            setup_client = LoadClient(addresses)
+            setup_client.connect()
+            for site in sites:
+                setup_client.request({'transaction': 'n', 'site_name': site, 'zip_code': '02138'})
+            setup_client.close()
+
+            latencies, elapsed = run_mixed_load(addresses, args.clients, args.duration,
+                                                sites, args.list_ratio)
+            report('render_workers={}'.format(render_workers), latencies, elapsed)
+        finally:
+            stop_servers(servers)
+
+
+def bench_failover(args):
+    """Request latency before and after a replica is hard-killed or hangs."""
+    sites = ['Site {}'.format(i) for i in range(args.sites)]
+    servers, addresses = start_servers(args.replicas, '--ordering', args.ordering)
+    # First replica; the sequencer in sequencer ordering
+    pid = replica_pids(servers)[0]
+    fault_signal = signal.SIGKILL if args.fault == 'kill' else signal.SIGSTOP
+    try:
+        setup_client = LoadClient(addresses)
+        setup_client.connect()
+        for site in sites:
+            setup_client.request({'transaction': 'n', 'site_name': site, 'zip_code': '02138'})
+        setup_client.close()
+
+        # Inject fault halfway through the load
+        fault_times = []
+        def inject_fault():
+            fault_times.append(time.time())
+            os.kill(pid, fault_signal)
+        timer = threading.Timer(args.duration / 2, inject_fault)
+        timer.start()
+        samples = []
+        run_mixed_load(addresses, args.clients, args.duration, sites,
+                       args.list_ratio, samples=samples, ack_timeout=args.ack_timeout)
+        timer.join()
+
+        # Requests are attributed to the fault if they completed after it
+        fault_time = fault_times[0]
+        for label, latencies in (
+                ('before {}'.format(args.fault), [l for s, l in samples if s + l < fault_time]),
+                ('after {}'.format(args.fault), [l for s, l in samples if s + l >= fault_time])):
+            print('{}: {} requests, p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(
+                label, len(latencies), percentile(latencies, 50) * 1000,
+                percentile(latencies, 99) * 1000, max(latencies) * 1000))
+    finally:
+        if fault_signal == signal.SIGSTOP:
+            os.kill(pid, signal.SIGCONT)
+        stop_servers(servers)
+
+
+def bench_ordering(args):
+    """Request latency of stability test versus sequencer ordering as the
+    number of connected clients grows."""
+    sites = ['Site {}'.format(i) for i in range(args.sites)]
+    for ordering in ('lamport', 'sequencer'):
+        for num_clients in args.client_counts:
+            servers, addresses = start_servers(args.replicas, '--ordering', ordering)
+            try:
+                # Idle clients only send dummy requests
+                idle_clients = [LoadClient(addresses, dummy_interval=args.idle_interval,
+                                           ack_timeout=60)
+                                for _ in range(num_clients - args.clients)]
+                for c in idle_clients:
+                    c.connect()
+
+                latencies, elapsed = run_mixed_load(addresses, min(args.clients, num_clients),
+                                                    args.duration, sites, args.list_ratio,
+                                                    ack_timeout=60)
+                report('{}, {} clients'.format(ordering, num_clients), latencies, elapsed)
+
+                for c in idle_clients:
+                    c.close()
+            finally:
+                stop_servers(servers)
+
+
+def bench_broadcast(args):
+    """Time and client CPU time per broadcast, from sending a request to
+    collecting the acks of all replicas, as the number of replicas grows."""
+    for num_replicas in args.replica_counts:
+        servers, addresses = start_servers(num_replicas)
+        try:
+            client = LoadClient(addresses, dummy_interval=args.idle_interval)
+            client.connect()
+            times = []
+            cpu_started = time.process_time()
+            for _ in range(args.broadcasts):
+                started = time.perf_counter()
+                client.send_request({'transaction': 'd'})
+                times.append(time.perf_counter() - started)
+            cpu = time.process_time() - cpu_started
+            print('{} replicas: p50 {:.3f} ms, p99 {:.3f} ms, client CPU {:.1f} us '
+                  'per broadcast'.format(num_replicas, percentile(times, 50) * 1000,
+                                         percentile(times, 99) * 1000,
+                                         cpu / args.broadcasts * 1e6))
+            client.close()
+        finally:
+            stop_servers(servers)
+
+
+def bench_transport(args):
+    """Ack latency of broadcasts and listing throughput over TCP versus Unix
+    domain sockets on the same host."""
+    sites = ['Site {}'.format(i) for i in range(args.sites)]
+    for transport in ('tcp', 'unix'):
+        options = [] if transport == 'tcp' else ['--unix', tempfile.mkdtemp()]
+        servers, addresses = start_servers(args.replicas, *options)
+        try:
+            setup_client = LoadClient(addresses)
+            setup_client.connect()
+            for site in sites:
+                setup_client.request({'transaction': 'n', 'site_name': site,
+                                      'zip_code': '02138'})
+            setup_client.close()
+
+            client = LoadClient(addresses, dummy_interval=args.idle_interval)
+            client.connect()
+            times = []
+            for _ in range(args.broadcasts):
+                started = time.perf_counter()
+                client.send_request({'transaction': 'd'})
+                times.append(time.perf_counter() - started)
+            print('{} acks: p50 {:.3f} ms, p99 {:.3f} ms'.format(
+                transport, percentile(times, 50) * 1000, percentile(times, 99) * 1000))
+            client.close()
+
+            latencies, elapsed = run_mixed_load(addresses, args.clients, args.duration,
+                                                sites, 1)
+            report('{} listings'.format(transport), latencies, elapsed)
+        finally:
+            stop_servers(servers)
+
+
+def bench_straggler(args):
+    """Request latency while one connected client stalls, without and with
+    client leases."""
+    sites = ['Site {}'.format(i) for i in range(args.sites)]
+    for lease in (0, args.lease):
+        servers, addresses = start_servers(args.replicas, '--lease', str(lease))
+        try:
+            setup_client = LoadClient(addresses)
+            setup_client.connect()
+            for site in sites:
+                setup_client.request({'transaction': 'n', 'site_name': site, 'zip_code': '02138'})
+            setup_client.close()
+
+            # Straggler sends nothing during the middle third of the load
+            straggler = LoadClient(addresses, ack_timeout=60)
+            straggler.connect()
+            stall = threading.Timer(args.duration / 3, straggler.pause,
+                                    args=(args.duration / 3,))
+            stall.start()
+            latencies, elapsed = run_mixed_load(addresses, args.clients, args.duration,
+                                                sites, args.list_ratio, ack_timeout=60)
+            stall.join()
+
+            # Straggler is served again once it has renewed its lease
+            start = time.time()
+            straggler.request({'transaction': 'v', 'site_name': sites[0]})
+            straggler_latency = time.time() - start
+            straggler.close()
+
+            print('lease={}: {} requests, p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms; '
+                  'straggler request after stall {:.1f} ms'.format(
+                      lease, len(latencies), percentile(latencies, 50) * 1000,
+                      percentile(latencies, 99) * 1000, max(latencies) * 1000,
+                      straggler_latency * 1000))
+        finally:
+            stop_servers(servers)
+
+
+def bench_compression(args):
+    """Size, CPU cost and latency of listings without and with compression."""
+    sites = ['Site {}'.format(i) for i in range(args.sites)]
+    servers, addresses = start_servers(args.replicas)
+    try:
+        setup_client = LoadClient(addresses)
+        setup_client.connect()
+        for i, site in enumerate(sites):
+            setup_client.request({'transaction': 'n', 'site_name': site,
+                                  'zip_code': '{:05d}'.format(2138 + i)})
+        listing = serialize262({'transaction': 'l', 'lclock': '0', 'rseqno': '0',
+                                'output_msg': setup_client.request({'transaction': 'l'})})
+        setup_client.close()
+
+        for codec in [None] + sorted(codecs):
+            if codec is None:
+                stats = 'listing {} bytes'.format(len(listing))
+            else:
+                # CPU cost of compressing and decompressing one listing
+                _, compress, decompress = codecs[codec]
+                compressed = compress(listing)
+                start = time.process_time()
+                for _ in range(args.rounds):
+                    compress(listing)
+                compress_time = (time.process_time() - start) / args.rounds
+                start = time.process_time()
+                for _ in range(args.rounds):
+                    decompress(compressed)
+                decompress_time = (time.process_time() - start) / args.rounds
+                stats = ('listing {} bytes (ratio {:.1f}x), compress {:.3f} ms, '
+                         'decompress {:.3f} ms'.format(
+                             len(compressed), len(listing) / len(compressed),
+                             compress_time * 1000, decompress_time * 1000))
+
+            c = LoadClient(addresses, compression=[codec] if codec else ())
+            c.connect()
+            latencies = []
+            for _ in range(args.rounds):
+                start = time.time()
+                c.request({'transaction': 'l'})
+                latencies.append(time.time() - start)
+            c.close()
+            print('{}: {}; [l] p50 {:.1f} ms over {} requests'.format(
+                codec or 'none', stats, percentile(latencies, 50) * 1000, args.rounds))
+    finally:
+        stop_servers(servers)
+
+
+def aggregate_listing(listing, zip_prefix, zip_digits):
+    """Aggregates a rendered listing as a client would have to; returns
+    the same rows as site_store.aggregate."""
+    length = max(zip_digits, len(zip_prefix))
+    groups = {}
+    for row in listing.split('\n')[1:]:
+        availability, zip_code, _ = row.split(',', 2)
+        if not zip_code.startswith(zip_prefix):
+            continue
+        stats = groups.setdefault(zip_code[:length], [0, 0, 0, None, None,
+                                                      [0] * len(histogram_bins)])
+        stats[0] += 1
+        doses = parse_doses(availability)
+        if doses < 0:
+            continue
+        stats[1] += 1
+        stats[2] += doses
+        stats[3] = doses if stats[3] is None else min(stats[3], doses)
+        stats[4] = doses if stats[4] is None else max(stats[4], doses)
+        stats[5][bisect.bisect_right(histogram_bins, doses) - 1] += 1
+    return [(group,) + tuple(stats[:5]) + (tuple(stats[5]),)
+            for group, stats in sorted(groups.items())]
+
+
+def bench_aggregate(args):
+    """Time of aggregate queries over a large store, vectorized and not,
+    versus aggregating a listing on the client."""
+    rng = random.Random(0)
+    zip_codes = ['{:05d}'.format(rng.randrange(100000)) for _ in range(3000)]
+    store = SiteStore()
+    for i in range(args.store_sites):
+        availability = (str(rng.randrange(2000)) if rng.random() < .9
+                        else rng.choice(['True', 'False']))
+        store.set_site('Site {}'.format(i), (availability, rng.choice(zip_codes)))
+
+    start = time.process_time()
+    listing = render_output({'transaction': 'l'}, store.apply({'transaction': 'l'})[1])
+    render_time = time.process_time() - start
+    print('{} sites: [l] listing {:.1f} MB rendered in {:.0f} ms'.format(
+        args.store_sites, len(listing) / 2 ** 20, render_time * 1000))
+
+    for zip_prefix, zip_digits in (('', 0), ('021', 0), ('', 3)):
+        start = time.process_time()
+        columns = store.apply({'transaction': 'a'})
+        snapshot_time = time.process_time() - start
+        times = {}
+        results = []
+        modes = [('client', None), ('python', False)]
+        if numpy is not None:
+            modes.append(('numpy', True))
+        for mode, vectorized in modes:
+            start = time.process_time()
+            if vectorized is None:
+                results.append(aggregate_listing(listing, zip_prefix, zip_digits))
+            else:
+                results.append(aggregate(columns, zip_prefix, zip_digits, vectorized))
+            times[mode] = time.process_time() - start
+        assert all(result == results[0] for result in results)
+        print('prefix {!r}, {} digits ({} groups): column snapshot {:.1f} ms; '
+              'aggregate {}'.format(zip_prefix or '*', zip_digits, len(results[0]),
+                                    snapshot_time * 1000,
+                                    ', '.join('{} {:.1f} ms'.format(mode, t * 1000)
+                                              for mode, t in times.items())))
+
+
+def bench_search(args):
+    """Time of site name searches with the name index versus scanning
+    all names, over --store-sites names."""
+    rng = random.Random(0)
+    places = ['{}{}'.format(rng.choice(['North', 'South', 'East', 'West', 'New', 'Old', '']),
+                            ''.join(rng.choice('aeioubcdfghklmnprstvw') for _ in range(6)).title())
+              for _ in range(2000)]
+    kinds = ['Pharmacy', 'Clinic', 'Hospital', 'Health Center', 'Medical Center',
+             'Community Center', 'University', 'School', 'Library', 'Fire Station']
+    start_rss = replica_rss(os.getpid())
+    site_names = ['{} {} {}'.format(rng.choice(places), rng.choice(kinds), i)
+                  for i in range(args.store_sites)]
+    names_rss = replica_rss(os.getpid())
+    start = time.time()
+    index = SiteNameIndex()
+    for site_name in site_names:
+        index.add(site_name)
+    print('{} site names ({:.0f} MiB) indexed in {:.1f} s, index {:.0f} MiB'.format(
+        args.store_sites, names_rss - start_rss, time.time() - start,
+        replica_rss(os.getpid()) - names_rss))
+
+    def sample_query(match):
+        site_name = rng.choice(index.names)
+        if match == 'prefix':
+            return site_name[:len(site_name) // 2].lower()
+        if match == 'substring':
+            offset = rng.randrange(len(site_name) - 5)
+            return site_name[offset:offset + 5].upper()
+        return ' '.join(rng.sample(site_name.split(), 2))
+
+    for match in ('prefix', 'substring', 'token'):
+        times = {'index': [], 'scan': []}
+        for _ in range(args.rounds):
+            query = sample_query(match)
+            start = time.process_time()
+            result = index.search(query, match)
+            times['index'].append(time.process_time() - start)
+
+            # Scan of all names, as a client would on a listing
+            start = time.process_time()
+            folded = query.casefold()
+            matches = []
+            for site_name in index.names:
+                if SiteNameIndex.name_matches(site_name, folded, match):
+                    matches.append(site_name)
+                    if len(matches) > 20:
+                        break
+            times['scan'].append(time.process_time() - start)
+            assert result == (matches[:20], len(matches) > 20)
+        print('{}: index p50 {:.2f} ms, p99 {:.2f} ms; scan p50 {:.1f} ms, p99 {:.1f} ms'.format(
+            match, percentile(times['index'], 50) * 1000, percentile(times['index'], 99) * 1000,
+            percentile(times['scan'], 50) * 1000, percentile(times['scan'], 99) * 1000))
+
+
+def bench_transfer(args):
+    """Throughput of dose transfers between a few sites, and doses lost,
+    with read-modify-write requests versus multi-site transactions."""
+    sites = ['Site {}'.format(i) for i in range(args.hot_sites)]
+    for mode in ('read-modify-write', 'transaction'):
+        servers, addresses = start_servers(args.replicas)
+        try:
+            setup_client = LoadClient(addresses)
+            setup_client.connect()
+            for site in sites:
+                setup_client.request({'transaction': 'n', 'site_name': site, 'zip_code': '02138'})
+                setup_client.request({'transaction': 'e', 'site_name': site, 'vaccine_no': '1000'})
+
+            clients = [LoadClient(addresses) for _ in range(args.clients)]
+            for c in clients:
+                c.connect()
+            latencies = []
+            deadline = time.time() + args.duration
+
+            def transfer_loop(c):
+                # Moves one dose at a time between random sites
+                rng = random.Random(c.client_id)
+                while time.time() < deadline:
+                    source, target = rng.sample(sites, 2)
+                    start = time.time()
+                    if mode == 'transaction':
+                        c.request({'transaction': 't', 'operations': encode_operations(
+                            [('u', source, '-1'), ('u', target, '1')])})
+                    else:
+                        doses = [int(c.request({'transaction': 'v', 'site_name': site})
+                                     .rsplit(': ', 1)[1]) for site in (source, target)]
+                        c.request({'transaction': 'e', 'site_name': source,
+                                   'vaccine_no': str(doses[0] - 1)})
+                        c.request({'transaction': 'e', 'site_name': target,
+                                   'vaccine_no': str(doses[1] + 1)})
+                    latencies.append(time.time() - start)
+
+            start = time.time()
+            threads = [threading.Thread(target=transfer_loop, args=(c,)) for c in clients]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.time() - start
+            for c in clients:
+                c.close()
+
+            # Total doses of all sites, which transfers should not change
+            total = int(setup_client.request({'transaction': 'a', 'zip_code': '',
+                                              'zip_digits': '0'})
+                        .split('\n')[1].split(',')[3])
+            setup_client.close()
+            report(mode, latencies, elapsed)
+            print('  {} of {} doses lost or created'.format(
+                abs(total - 1000 * len(sites)), 1000 * len(sites)))
+        finally:
+            stop_servers(servers)
+
+
+def bench_cache(args):
+    """Read latency and output volume without and with client caches."""
+    sites = ['Site {}'.format(i) for i in range(args.sites)]
+    servers, addresses = start_servers(args.replicas)
+    try:
+        setup_client = LoadClient(addresses)
+        setup_client.connect()
+        for site in sites:
+            setup_client.request({'transaction': 'n', 'site_name': site, 'zip_code': '02138'})
+        setup_client.close()
+
+        for cache_size in (0, 1 << 20):
+            clients = [LoadClient(addresses, cache_size=cache_size)
+                       for _ in range(args.clients)]
+            for c in clients:
+                c.connect()
+            latencies = []
+            deadline = time.time() + args.duration
+
+            def read_loop(c):
+                # Reads of a few popular sites and listings, and rare edits
+                rng = random.Random(c.client_id)
+                while time.time() < deadline:
+                    r = rng.random()
+                    if r < args.write_ratio:
+                        msg_dict = {'transaction': 'e', 'site_name': rng.choice(sites),
+                                    'vaccine_no': str(rng.randrange(1000))}
+                    elif r < args.write_ratio + args.list_ratio:
+                        msg_dict = {'transaction': 'l'}
+                    else:
+                        msg_dict = {'transaction': 'v', 'site_name': rng.choice(sites[:10])}
+                    start = time.time()
+                    c.request(msg_dict)
+                    latencies.append(time.time() - start)
+
+            start = time.time()
+            threads = [threading.Thread(target=read_loop, args=(c,)) for c in clients]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.time() - start
+            output_bytes = sum(c.output_bytes for c in clients)
+            for c in clients:
+                c.close()
+            report('cache_size={}'.format(cache_size), latencies, elapsed)
+            print('  {:.0f} output bytes received per request'.format(
+                output_bytes / len(latencies)))
+    finally:
+        stop_servers(servers)
+
+
+def bench_learners(args):
+    """Write latency and read throughput as learners are added to serve reads."""
+    sites = ['Site {}'.format(i) for i in range(args.sites)]
+    for num_learners in args.learner_counts:
+        servers, addresses, learners = start_cluster(args.replicas, num_learners)
+        try:
+            setup_client = LoadClient(addresses)
+            setup_client.connect()
+            for site in sites:
+                setup_client.request({'transaction': 'n', 'site_name': site, 'zip_code': '02138'})
+            setup_client.close()
+
+            # Readers are spread over the learners, or read from the
+            # replicas if there are none
+            writers = [LoadClient(addresses) for _ in range(args.writers)]
+            readers = [LoadClient(addresses, learner=learners[i % len(learners)]
+                                  if learners else None)
+                       for i in range(args.clients)]
+            for c in writers + readers:
+                c.connect()
+            write_latencies = []
+            read_latencies = []
+            deadline = time.time() + args.duration
+
+            def write_loop(c):
+                rng = random.Random(c.client_id)
+                while time.time() < deadline:
+                    msg_dict = {'transaction': 'e', 'site_name': rng.choice(sites),
+                                'vaccine_no': str(rng.randrange(1000))}
+                    start = time.time()
+                    c.request(msg_dict)
+                    write_latencies.append(time.time() - start)
+
+            def read_loop(c):
+                rng = random.Random(c.client_id)
+                while time.time() < deadline:
+                    if rng.random() < args.list_ratio:
+                        msg_dict = {'transaction': 'l'}
+                    else:
+                        msg_dict = {'transaction': 'v', 'site_name': rng.choice(sites)}
+                    start = time.time()
+                    c.request(msg_dict)
+                    read_latencies.append(time.time() - start)
+
+            start = time.time()
+            threads = ([threading.Thread(target=write_loop, args=(c,)) for c in writers] +
+                       [threading.Thread(target=read_loop, args=(c,)) for c in readers])
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.time() - start
+            for c in writers + readers:
+                c.close()
+            report('{} learners, writes'.format(num_learners), write_latencies, elapsed)
+            report('{} learners, reads'.format(num_learners), read_latencies, elapsed)
+        finally:
+            stop_servers(servers)
+
+
+def replica_rss(pid):
+    """Resident set size of a replica process in MiB."""
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+
+
+def replica_usage(pid):
+    """CPU seconds used so far by a replica process, and context switches of
+    its live threads."""
+    with open('/proc/{}/stat'.format(pid)) as f:
+        # Fields after the parenthesized command name; utime and stime are
+        # the 14th and 15th fields
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    switches = 0
+    for tid in os.listdir('/proc/{}/task'.format(pid)):
+        try:
+            with open('/proc/{}/task/{}/status'.format(pid, tid)) as f:
+                switches += sum(int(line.split()[1]) for line in f
+                                if 'ctxt_switches' in line)
+        except FileNotFoundError:
+            # Thread exited meanwhile
+            pass
+    return cpu, switches
+
+
+def bench_batching(args):
+    """Throughput of many busy clients with commands executed one at a time
+    versus in batches of stable requests."""
+    sites = ['Site {}'.format(i) for i in range(args.sites)]
+    for num_clients, ordering, batch in itertools.product(
+            args.busy_clients, ('lamport', 'sequencer'), (0, args.batch)):
+        servers, addresses = start_servers(args.replicas, '--ordering', ordering,
+                                           '--batch', str(batch))
+        pids = replica_pids(servers)
+        try:
+            setup_client = LoadClient(addresses)
+            setup_client.connect()
+            for site in sites:
+                setup_client.request({'transaction': 'n', 'site_name': site, 'zip_code': '02138'})
+            setup_client.close()
+
+            # Client connection threads of replicas exit when clients close
+            # their connections, so usage is taken before
+            usage = []
+            usage_started = [replica_usage(pid) for pid in pids]
+            latencies, elapsed = run_mixed_load(
+                addresses, num_clients, args.duration, sites, args.list_ratio,
+                before_close=lambda: usage.extend(replica_usage(pid) for pid in pids))
+            cpu = sum(u[0] - s[0] for u, s in zip(usage, usage_started))
+            switches = sum(u[1] - s[1] for u, s in zip(usage, usage_started))
+            report('{} clients, {}, batch={}'.format(num_clients, ordering, batch),
+                   latencies, elapsed)
+            # Per request and replica
+            requests = len(latencies) * len(pids)
+            print('  replica CPU {:.0f} us and {:.1f} context switches per request'.format(
+                cpu / requests * 1e6, switches / requests))
+        finally:
+            stop_servers(servers)
+
+
+def flood(addresses, count, num_clients):
+    """Target of clients flooding replicas with count listings in total,
+    each sent as soon as the previous one is acked, without waiting for
+    outputs."""
+    def flood_loop(flooder):
+        for _ in range(count // num_clients):
+            flooder.send_request({'transaction': 'l'})
+            while not flooder.output_queue.empty():
+                flooder.output_queue.get()
+        flooder.close()
+
+    flooders = [LoadClient(addresses, ack_timeout=600) for _ in range(num_clients)]
+    for flooder in flooders:
+        flooder.connect()
+    threads = [threading.Thread(target=flood_loop, args=(flooder,)) for flooder in flooders]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def bench_flood(args):
+    """Latency of well-behaved clients and replica memory while flooding
+    clients send listings back to back, without and with admission
+    limits."""
+    sites = ['Site {}'.format(i) for i in range(args.sites)]
+    for ordering, limits in itertools.product(
+            ('lamport', 'sequencer'),
+            (('0', '0'), (str(args.client_backlog), str(args.backlog)))):
+        servers, addresses = start_servers(args.replicas, '--ordering', ordering,
+                                           '--client-backlog', limits[0],
+                                           '--backlog', limits[1])
+        pids = replica_pids(servers)
+        try:
+            setup_client = LoadClient(addresses)
+            setup_client.connect()
+            for site in sites:
+                setup_client.request({'transaction': 'n', 'site_name': site, 'zip_code': '02138'})
+            setup_client.close()
+
+            # Flooding clients, in a process of their own, send listings as
+            # fast as replicas ack them, without waiting for outputs
+            flooder = multiprocessing.Process(target=flood,
+                                              args=(addresses, args.flood_requests,
+                                                    args.flood_clients))
+            flooder.start()
+            max_rss = []
+            load_done = threading.Event()
+
+            def sample_rss():
+                while not load_done.is_set():
+                    max_rss.append(max(replica_rss(pid) for pid in pids))
+                    time.sleep(.1)
+
+            rss_thread = threading.Thread(target=sample_rss)
+            rss_thread.start()
+            latencies, elapsed = run_mixed_load(addresses, args.clients, args.duration,
+                                                sites, args.list_ratio, ack_timeout=600)
+            load_done.set()
+            rss_thread.join()
+            flooder.join()
+            report('{}, client_backlog={}, backlog={}'.format(ordering, *limits),
+                   latencies, elapsed)
+            print('  max {:.1f} ms, replica RSS up to {:.1f} MiB'.format(
+                max(latencies) * 1000, max(max_rss)))
+        finally:
+            stop_servers(servers)
+
+
+def bench_lifecycle(args):
+    """Time to start a cluster, serve a first request and stop it."""
+    start_times = []
+    stop_times = []
+    for _ in range(args.rounds):
+        start = time.time()
+        servers, addresses = start_servers(args.replicas)
+        c = LoadClient(addresses)
+        c.connect()
+        c.request({'transaction': 'v', 'site_name': 'Harvard University'})
+        c.close()
+        start_times.append(time.time() - start)
+
+        start = time.time()
+        stop_servers(servers)
+        stop_times.append(time.time() - start)
+
+    print('{} replicas, {} rounds: start + first request p50 {:.1f} ms, '
+          'stop p50 {:.1f} ms'.format(args.replicas, args.rounds,
+                                      percentile(start_times, 50) * 1000,
+                                      percentile(stop_times, 50) * 1000))
+
+
+benchmarks = {
+    'aggregate': bench_aggregate,
+    'batching': bench_batching,
+    'broadcast': bench_broadcast,
+    'cache': bench_cache,
+    'compression': bench_compression,
+    'failover': bench_failover,
+    'flood': bench_flood,
+    'learners': bench_learners,
+    'lifecycle': bench_lifecycle,
+    'ordering': bench_ordering,
+    'pipeline': bench_pipeline,
+    'search': bench_search,
+    'straggler': bench_straggler,
+    'transfer': bench_transfer,
+    'transport': bench_transport,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage='benchmarks.py <benchmark> [options]')
+    parser.add_argument('benchmark', choices=sorted(benchmarks))
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--sites', type=int, default=500)
+    parser.add_argument('--list-ratio', type=float, default=.2,
+                        help="fraction of 'l' requests in mixed load")
+    parser.add_argument('--write-ratio', type=float, default=.02,
+                        help="fraction of 'e' requests in cache benchmark")
+    parser.add_argument('--rounds', type=int, default=20,
+                        help='cluster lifecycles in lifecycle benchmark, '
+                             'listings in compression benchmark, or queries '
+                             'per kind in search benchmark')
+    parser.add_argument('--fault', choices=['kill', 'stop'], default='kill',
+                        help='replica fault injected in failover benchmark '
+                             '(SIGKILL or SIGSTOP)')
+    parser.add_argument('--ack-timeout', type=float, default=2.0,
+                        help='client ack timeout in failover benchmark')
+    parser.add_argument('--ordering', choices=['lamport', 'sequencer'], default='lamport',
+                        help='ordering of replicas in failover benchmark')
+    parser.add_argument('--client-counts', type=int, nargs='+', default=[10, 100, 1000],
+                        help='connected clients in ordering benchmark, of which '
+                             '--clients issue requests and the rest are idle')
+    parser.add_argument('--replica-counts', type=int, nargs='+', default=[1, 3, 5, 9],
+                        help='replicas in broadcast benchmark')
+    parser.add_argument('--busy-clients', type=int, nargs='+', default=[50, 100],
+                        help='clients issuing requests in batching benchmark')
+    parser.add_argument('--batch', type=int, default=256,
+                        help='batch size of replicas in batching benchmark')
+    parser.add_argument('--learner-counts', type=int, nargs='+', default=[0, 2, 4],
+                        help='learners in learners benchmark')
+    parser.add_argument('--writers', type=int, default=2,
+                        help="clients issuing 'e' requests in learners benchmark, "
+                             "besides --clients readers")
+    parser.add_argument('--broadcasts', type=int, default=2000,
+                        help='broadcasts timed per replica count in broadcast '
+                             'benchmark, and per transport in transport benchmark')
+    parser.add_argument('--idle-interval', type=float, default=1.0,
+                        help='time between dummy requests of idle clients in '
+                             'ordering benchmark (client.py uses 0.1)')
+    parser.add_argument('--client-backlog', type=int, default=4,
+                        help='per-client backlog limit in flood benchmark')
+    parser.add_argument('--backlog', type=int, default=64,
+                        help='total backlog limit in flood benchmark')
+    parser.add_argument('--flood-requests', type=int, default=20000,
+                        help='listings sent by the flooding clients in flood benchmark')
+    parser.add_argument('--flood-clients', type=int, default=16,
+                        help='flooding clients in flood benchmark')
+    parser.add_argument('--hot-sites', type=int, default=10,
+                        help='sites between which transfer benchmark moves doses')
+    parser.add_argument('--store-sites', type=int, default=1000000,
+                        help='sites of the store in aggregate and search benchmarks')
+    parser.add_argument('--lease', type=float, default=.5,
+                        help='client lease of replicas in straggler benchmark')
+    args = parser.parse_args()
+
+    benchmarks[args.benchmark](args)
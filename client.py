@@ -1,62 +1,168 @@
 import sys
 import time
+import queue
+import random
+import socket
+import argparse
 import threading
 from datetime import datetime
-from multiprocessing import Queue
-from socket_utils import ClientSocket262, serialize262, deserialize262
+from collections import OrderedDict
+from socket_utils import ClientSocket262, serialize262, deserialize262, send_to_all
+from socket_utils import read_cluster_config, wait_for_ready_file, codecs, parse_address
+from site_store import encode_operations, read_actions
+from profiling import add_profiling_arguments, start_profiling
 
 
 # Replica coordination among state machines implemented using:
 # Agreement protocol: Schneider, Gries, and Schlichting - Fault Tolerant Broadcasts
 # Order protocol: Lamport - Logical clocks (as described by Schneider)
 
-lclock = 0                      # Logical clock; used to implement order protocol
-lclock_lock = threading.Lock()  # Lock for logical clock
-request_lock = threading.Lock() # Lock to enforce Broadcast Sequencing Restriction from agreement protocol
-quit_flag = False               # Flag indicating that client has quit
-sm_replicas = []                # List containing sockets for each server replica
-sm_replica_statuses = []        # List containing boolean status of each server replica
-ack_queues = []                 # List of queues containing acks from each server replica; used to implement agreement protocol
-output_queue = Queue()          # Queue containing outputs of requested commands
-client_id = datetime.now().strftime('%Y%m%d%H%M%S%f') # Unique client ID
+ack_timeout = 2.0               # Seconds to wait for acks before a replica is considered failed
+heartbeat_interval = .1         # Seconds between dummy requests, which double as heartbeats
+
+
+class ResponseCache:
+    """LRU cache of outputs of reads, for conditional requests.
+
+    Outputs of [v] are cached by site name, and the output of [l] under
+    None, along with the version of the site (or database) they were
+    rendered at. The total length of cached outputs is bounded by max_size.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def lookup(self, key):
+        """Returns the cached (version, output) of key, or None."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def store(self, key, version, output):
+        """Caches the output of key at version, evicting least recently
+        used entries as needed."""
+        old_entry = self.entries.pop(key, None)
+        if old_entry is not None:
+            self.size -= len(old_entry[1])
+        if len(output) > self.max_size:
+            return
+        self.entries[key] = (version, output)
+        self.size += len(output)
+        while self.size > self.max_size:
+            _, (_, evicted_output) = self.entries.popitem(last=False)
+            self.size -= len(evicted_output)
+
+
+search_limit = 20               # Most site names returned by a search
 
 
 def choose_action():
     """Display prompt for user and accept a choice."""
     choice = None
-    options = ['l', 'v', 'e', 'n', 'q']
+    options = ['l', 'v', 's', 'e', 'c', 'u', 't', 'n', 'a', 'q']
     prompt = ('What would you like to do?\n[l] list all vaccine site details;\n'
-              '[v] view # of available vaccines at a particular site;\n[e] edit'
-              ' vaccine availability at a particular site;\n[n] add a new '
-              'vaccine site;\n[q] close the connection and quit.\n')
+              '[v] view # of available vaccines at a particular site;\n[s] '
+              'search vaccine site names;\n[e] edit'
+              ' vaccine availability at a particular site;\n[c] edit vaccine '
+              'availability at a particular site only if it is unchanged;\n[u] '
+              'add or remove vaccines at a particular site;\n[t] update several '
+              'sites at once (all or none);\n[n] add a new '
+              'vaccine site;\n[a] aggregate vaccine availability by ZIP code;\n'
+              '[q] close the connection and quit.\n')
     while choice not in options:
         choice = input(prompt).strip()
     return choice
 
 
+def input_availability(p):
+    """Prompts for a vaccine availability."""
+    vaccine_no = input(p).strip()
+    while not (vaccine_no.isdigit() or vaccine_no == 'True' or
+               vaccine_no == 'False'):
+        p = 'Availability must be a nonnegative integer or [True/False]: '
+        vaccine_no = input(p).strip()
+    return vaccine_no
+
+
+def input_delta():
+    """Prompts for a number of vaccines to add or remove."""
+    delta = input('Please enter the number of vaccines to add (negative to remove): ').strip()
+    while not delta.lstrip('-').isdigit():
+        delta = input('Number of vaccines must be an integer: ').strip()
+    return delta
+
+
 def take_action(action):
     """Wire protocol logic based on user's selected action."""
-    msg_dict = {'transaction': action, 'client_id': client_id}
+    msg_dict = {'transaction': action}
 
     if action == 'v':
         # Prompt for site name
         site_name = input('Please enter the vaccine site name: ').strip()
         msg_dict['site_name'] = site_name
 
+    elif action == 's':
+        # Prompt for search text and kind of match
+        msg_dict['query'] = input('Please enter the text to search for in site names: ').strip()
+        p = 'Please choose how to match: [p] prefix, [s] substring, [t] whole words: '
+        match = input(p).strip()
+        while match not in ('p', 's', 't'):
+            match = input('Match must be one of [p], [s] or [t]: ').strip()
+        msg_dict['match'] = {'p': 'prefix', 's': 'substring', 't': 'token'}[match]
+        msg_dict['limit'] = str(search_limit)
+
     elif action == 'e':
         # Prompt for site name
         site_name = input('Please enter the vaccine site name: ').strip()
         msg_dict['site_name'] = site_name
 
         # Prompt for vaccine availability
-        p = ('Please enter the number of available vaccines at this site '
-             '(or [True/False] for binary availability): ')
-        vaccine_no = input(p).strip()
-        while not (vaccine_no.isdigit() or vaccine_no == 'True' or
-                   vaccine_no == 'False'):
-            p = 'Availability must be a nonnegative integer or [True/False]: '
-            vaccine_no = input(p).strip()
-        msg_dict['vaccine_no'] = vaccine_no
+        msg_dict['vaccine_no'] = input_availability(
+            'Please enter the number of available vaccines at this site '
+            '(or [True/False] for binary availability): ')
+
+    elif action == 'c':
+        # Prompt for site name, expected and new vaccine availability
+        site_name = input('Please enter the vaccine site name: ').strip()
+        msg_dict['site_name'] = site_name
+        msg_dict['expected'] = input_availability(
+            'Please enter the vaccine availability you expect at this site: ')
+        msg_dict['vaccine_no'] = input_availability(
+            'Please enter the new vaccine availability at this site: ')
+
+    elif action == 'u':
+        # Prompt for site name and number of vaccines
+        site_name = input('Please enter the vaccine site name: ').strip()
+        msg_dict['site_name'] = site_name
+        msg_dict['delta'] = input_delta()
+
+    elif action == 't':
+        # Prompt for operations until an empty site name
+        operations = []
+        while True:
+            p = 'Please enter the next vaccine site name (or nothing to send the updates): '
+            site_name = input(p).strip()
+            if not site_name:
+                if operations:
+                    break
+                continue
+            p = 'Please choose an update: [e] edit, [c] edit if unchanged, [u] add or remove: '
+            kind = input(p).strip()
+            while kind not in ('e', 'c', 'u'):
+                kind = input('Update must be one of [e], [c] or [u]: ').strip()
+            if kind == 'e':
+                operations.append((kind, site_name, input_availability(
+                    'Please enter the new vaccine availability at this site: ')))
+            elif kind == 'c':
+                expected = input_availability(
+                    'Please enter the vaccine availability you expect at this site: ')
+                operations.append((kind, site_name, expected, input_availability(
+                    'Please enter the new vaccine availability at this site: ')))
+            else:
+                operations.append((kind, site_name, input_delta()))
+        msg_dict['operations'] = encode_operations(operations)
 
     elif action == 'n':
         # Prompt for site name
@@ -69,179 +175,551 @@ def take_action(action):
             zip_code = input('ZIP code must be a nonnegative integer: ').strip()
         msg_dict['zip_code'] = zip_code
 
-    return msg_dict
-
-
-def dummy_request_loop():
-    """Target to send dummy requests for logical clock stability test."""
-    global lclock
-
-    while True:
-        # Send request to server replicas; atomic with respect to request
-        # broadcasts according to agreement protocol
-        request_lock.acquire()
-
-        ## Update logical clock
-        lclock_lock.acquire()
-        lclock += 1
-        lclock_lock.release()
-
-        ## Use logical clock value as request ID (order protocol)
-        request_seqno = lclock
-
-        ## Send request message
-        msg_dict = {'transaction': 'd', 'rseqno': str(request_seqno), 'client_id': client_id}
-        for i in range(len(sm_replicas)):
-            smr = sm_replicas[i]
-            # Send request only to active replicas
-            if sm_replica_statuses[i]:
-                smr.send(serialize262(msg_dict))
-
-        # Check for acks or failure (agreement protocol)
-        for i in range(len(sm_replicas)):
-            if sm_replica_statuses[i]:
-                ack_msg = ack_queues[i].get()
-                if ack_msg['transaction'] == 'f':
-                    sm_replica_statuses[i] = False
-
-        request_lock.release()
+    elif action == 'a':
+        # Prompt for ZIP code prefix of sites to aggregate over
+        p = 'Please enter the ZIP code prefix of sites to aggregate (or nothing for all sites): '
+        zip_prefix = input(p).strip()
+        while zip_prefix and not zip_prefix.isdigit():
+            zip_prefix = input('ZIP code prefix must be digits or nothing: ').strip()
+        msg_dict['zip_code'] = zip_prefix
+
+        # Prompt for grouping
+        p = 'Please enter the number of leading ZIP code digits to group by (0 for none): '
+        zip_digits = input(p).strip()
+        while not zip_digits.isdigit():
+            zip_digits = input('Number of digits must be a nonnegative integer: ').strip()
+        msg_dict['zip_digits'] = zip_digits
 
-        # Delay between dummy requests
-        time.sleep(.1)
-
-
-def receive_messages(smr_index):
-    """Target receiving messages from socket corresponding to smr_index."""
-    global lclock
-
-    smr = sm_replicas[smr_index]
-    while True:
-        # Receive message
-        incoming_msg = smr.receive()
-        fields = deserialize262(incoming_msg)
-
-        # Break if client quits
-        if quit_flag:
-            break
+    return msg_dict
 
-        # Update logical clock
-        lclock_lock.acquire()
-        lclock = max(lclock, int(fields['lclock'])) + 1
-        lclock_lock.release()
-
-        # Add to appropriate message queue
-        if fields['transaction'] == 'k':
-            # Message is an ack (agreement protocol)
-            ack_queues[smr_index].put(fields)
-        elif fields['transaction'] == 'f':
-            # Message is a failure notice (Failure Detection Assumption, Schneider)
-            ack_queues[smr_index].put(fields)
-            return
-        else:
-            # Message is a command output, executed upon fulfillment of order protocol
-            output_queue.put(fields)
 
+class ReplicaClient:
+    """Client side of the replica protocols, shared by client.py and the
+    load clients of benchmarks.py.
+
+    Requests are broadcast to all replicas considered live, one at a time
+    (Broadcast Sequencing Restriction), and each broadcast waits for the
+    acks of those replicas (agreement protocol). Dummy requests go out
+    every heartbeat_interval seconds, so that the stability test advances
+    and unresponsive replicas are detected while no request is made. Reads
+    are sent to a learner replica, if one of learners is reachable, and
+    outputs of cached reads are not resent while unchanged.
+    """
+    def __init__(self, addresses, learners=(), ack_timeout=ack_timeout,
+                 heartbeat_interval=heartbeat_interval, compression=(),
+                 cache_size=1 << 20, client_id=None):
+        self.addresses = addresses
+        self.learners = list(learners)
+        self.ack_timeout = ack_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.compression = compression
+        self.cache = ResponseCache(cache_size) if cache_size > 0 else None
+        self.client_id = client_id or datetime.now().strftime('%Y%m%d%H%M%S%f')
+
+        # Logical clock; used to implement order protocol
+        self.lclock = 0
+        self.lclock_lock = threading.Lock()
+        # Lock to enforce Broadcast Sequencing Restriction from agreement protocol
+        self.request_lock = threading.Lock()
+        # Whether the client has quit
+        self.quit_flag = False
+        # Request ID of the last rejoin after an exclusion, and request ID
+        # after which replicas excluded the client (lapsed lease); a client
+        # that has sent no request yet is excluded after -1
+        self.joined_at = -1
+        self.lease_cut = None
+
+        # Sockets of the replicas, their boolean status, and whether the
+        # connection to each of them is still usable
+        self.sockets = []
+        self.statuses = []
+        self.reachable = []
+        # (replica index, ack) pairs from all replicas, and outputs of
+        # requested commands
+        self.ack_queue = queue.Queue()
+        self.output_queue = queue.Queue()
+        self.threads = []
+
+        # Learner serving reads, if any, its acks and outputs, and the
+        # position in the total order of the latest output received
+        self.learner = None
+        self.learner_address = None
+        self.learner_queue = queue.Queue()
+        self.read_after = 0
+
+        # Total length of command outputs received
+        self.output_bytes = 0
+
+    def handshake(self, s):
+        """Sends the initial message with the client ID and offered codecs
+        on a new connection; returns the reply."""
+        initial_msg = {'transaction': 'i', 'lclock': str(self.lclock),
+                       'client_id': self.client_id}
+        if self.compression:
+            initial_msg['compression'] = ','.join(self.compression)
+        s.send(serialize262(initial_msg))
+        fields = deserialize262(s.receive())
+        with self.lclock_lock:
+            self.lclock = max(self.lclock, int(fields['lclock'])) + 1
+        return fields
+
+    def connect(self):
+        """Connects to all replicas and to a learner chosen at random, if
+        any, and starts the receive and dummy request threads."""
+        for ip, port in self.addresses:
+            s = ClientSocket262(ip, port)
+            s.connect()
+            self.sockets.append(s)
+
+            # Detect replica status from response
+            fields = self.handshake(s)
+            if fields['transaction'] == 'f':
+                self.statuses.append(False)
+            else:
+                assert fields['transaction'] == 'i'
+                self.statuses.append(True)
+                s.set_codec(fields.get('compression'))
+            self.reachable.append(True)
+
+        if self.learners:
+            self.learner_address = random.choice(self.learners)
+            s = ClientSocket262(*self.learner_address)
+            try:
+                s.connect()
+                s.set_codec(self.handshake(s).get('compression'))
+                self.learner = s
+                threading.Thread(target=self.receive_learner_messages, args=(s,),
+                                 name='receive_learner_messages', daemon=True).start()
+            except (RuntimeError, OSError):
+                # Reads are sent to the replicas instead
+                s.client_socket.close()
+
+        # Start threads receiving command outputs from each replica, and
+        # sending dummy requests (order protocol)
+        for i in range(len(self.sockets)):
+            t = threading.Thread(target=self.receive_messages, args=(i,),
+                                 name='receive_messages', daemon=True)
+            t.start()
+            self.threads.append(t)
+        threading.Thread(target=self.dummy_request_loop, name='dummy_request_loop',
+                         daemon=True).start()
+
+    def broadcast(self, msg_dict, include_failed=False):
+        """Sends a message to all active replicas (and failed but reachable
+        replicas if include_failed) at once; a broken connection, or one
+        that does not take the message within ack_timeout, marks a replica
+        failed."""
+        targets = [i for i in range(len(self.sockets))
+                   if self.statuses[i] or (include_failed and self.reachable[i])]
+        failed = send_to_all([self.sockets[i] for i in targets], serialize262(msg_dict),
+                             timeout=self.ack_timeout)
+        for i in targets:
+            if self.sockets[i] in failed:
+                self.disconnect(i)
+
+    def collect_acks(self):
+        """Waits for acks from all active replicas (agreement protocol).
+
+        Acks are taken in the order they arrive, against a common deadline,
+        so a client waits at most ack_timeout in total. Replicas that send a
+        failure notice, break their connection or miss the deadline are
+        marked failed. A replica delaying its ack to apply backpressure
+        sends wait notices, each of which extends its deadline by
+        ack_timeout. If the client itself stalls past a deadline, the
+        deadlines start over, at most once per call, so that contention in
+        the client cannot keep a hung replica from being marked failed.
+        Acks from replicas no longer awaited are dropped.
+        """
+        deadline = time.time() + self.ack_timeout
+        deadlines = {i: deadline for i in range(len(self.sockets)) if self.statuses[i]}
+        restarted = False
+        while deadlines:
+            wake = min(deadlines.values())
+            try:
+                i, fields = self.ack_queue.get(timeout=max(0, wake - time.time()))
+            except queue.Empty:
+                now = time.time()
+                if not restarted and now - wake > self.ack_timeout / 10:
+                    # Woken up late: the client itself stalled, and acks may
+                    # have arrived meanwhile without being received yet
+                    deadlines = dict.fromkeys(deadlines, now + self.ack_timeout)
+                    restarted = True
+                    continue
+                # Unresponsive replicas (Failure Detection Assumption, Schneider)
+                for i in [i for i, d in deadlines.items() if d <= now]:
+                    del deadlines[i]
+                    self.disconnect(i)
+                continue
+            if i not in deadlines:
+                # Left over from a replica considered failed
+                continue
+            if fields is not None and fields['transaction'] == 'w':
+                deadlines[i] = time.time() + self.ack_timeout
+                continue
+            del deadlines[i]
+            if fields is None:
+                self.disconnect(i)
+            elif fields['transaction'] == 'f':
+                self.statuses[i] = False
+
+    def disconnect(self, index):
+        """Marks a crashed or unresponsive replica failed and drops its connection."""
+        self.statuses[index] = False
+        if self.reachable[index]:
+            self.reachable[index] = False
+            # Unblocks the thread receiving from the replica
+            try:
+                self.sockets[index].client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def next_request_id(self):
+        """Advances the logical clock; returns its value, used as request ID
+        (order protocol)."""
+        with self.lclock_lock:
+            self.lclock += 1
+            return self.lclock
+
+    def send_request(self, msg_dict):
+        """Sends a request to all active replicas and waits for their acks;
+        returns its request ID and the rejoin it was sent after, or None if
+        the client has quit.
+
+        If replicas excluded the client from the stability test because its
+        lease lapsed, the client first rejoins, which renews the lease.
+        """
+        # Atomic with respect to request broadcasts according to agreement
+        # protocol
+        with self.request_lock:
+            if self.quit_flag:
+                return None
+            if self.lease_cut is not None:
+                self.renew_lease()
+            request_seqno = self.next_request_id()
+            self.broadcast(dict(msg_dict, rseqno=str(request_seqno),
+                                client_id=self.client_id))
+            self.collect_acks()
+        return request_seqno, self.joined_at
+
+    def renew_lease(self):
+        """Rejoins the stability test after replicas excluded the client; the
+        caller holds request_lock.
+
+        Replicas drop requests sent after the cut of the exclusion until the
+        rejoin message. Its acks advance the logical clock past every
+        request the replicas have ordered in the meantime.
+        """
+        self.joined_at = self.next_request_id()
+        self.lease_cut = None
+        self.broadcast({'transaction': 'i', 'rseqno': str(self.joined_at),
+                        'lclock': str(self.joined_at), 'client_id': self.client_id})
+        self.collect_acks()
+
+    def pause(self, seconds):
+        """Stops sending anything for a while, like a stalled client."""
+        with self.request_lock:
+            time.sleep(seconds)
+
+    def dummy_request_loop(self):
+        """Target to send dummy requests for logical clock stability test.
+
+        Dummy requests also serve as heartbeats: their acks are awaited with
+        the same deadline as those of user requests, so an unresponsive
+        replica is detected even while the user is idle. They also renew
+        the lease of the client.
+        """
+        while self.send_request({'transaction': 'd'}) is not None:
+            # Delay between dummy requests
+            time.sleep(self.heartbeat_interval)
+
+    def request(self, msg_dict):
+        """Issues a request and waits for its output; returns the output
+        message.
+
+        Reads are served by the learner, unless it fails, and the outputs of
+        cached reads are only sent by replicas if they changed.
+        """
+        # Reads of cached outputs are conditional on their version
+        cached = None
+        if self.cache is not None and msg_dict['transaction'] in ('v', 'l'):
+            cache_key = msg_dict.get('site_name')
+            cached = self.cache.lookup(cache_key)
+            if cached is not None:
+                msg_dict = dict(msg_dict, version=str(cached[0]))
+
+        fields = None
+        if self.learner is not None and msg_dict['transaction'] in read_actions:
+            fields = self.read_from_learner(msg_dict)
+
+        if fields is None:
+            request_seqno, sent_joined_at = self.send_request(msg_dict)
+
+            # Wait until order protocol is fulfilled by replicas
+            while True:
+                # Discard duplicates or outputs to past commands
+                fields = self.output_queue.get()
+                if fields['transaction'] == 'x':
+                    # Request sent after the cut of an exclusion was dropped;
+                    # send it again after rejoining
+                    if sent_joined_at <= int(fields['rseqno']) < request_seqno:
+                        request_seqno, sent_joined_at = self.send_request(msg_dict)
+                elif int(fields['rseqno']) == request_seqno:
+                    break
+        self.read_after = max(self.read_after, int(fields.get('slot', '0')))
+
+        if 'output_msg' not in fields:
+            # Not modified since cached
+            fields['output_msg'] = cached[1]
+        elif self.cache is not None and msg_dict['transaction'] in ('v', 'l'):
+            self.cache.store(cache_key, int(fields['version']), fields['output_msg'])
+        return fields
+
+    def digests(self):
+        """Queries the digests of all live replicas at one position of the
+        total order ('h'); returns their output messages, which are equal
+        unless replicas diverged."""
+        request_seqno, _ = self.send_request({'transaction': 'h'})
+        outputs = []
+        deadline = time.time() + self.ack_timeout
+        while len(outputs) < sum(self.statuses):
+            try:
+                fields = self.output_queue.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if fields['transaction'] == 'h' and int(fields['rseqno']) == request_seqno:
+                outputs.append(fields['output_msg'])
+        return outputs
+
+    def read_from_learner(self, msg_dict):
+        """Sends a read to the learner, which serves it once it has applied
+        every command whose output the client has received; returns the
+        output message, or None if the learner failed.
+
+        The ack of the learner is awaited against ack_timeout, like those of
+        replicas, and so is the output once acked; a learner that misses
+        either is dropped.
+        """
+        request_seqno = str(self.next_request_id())
+        try:
+            self.learner.send(serialize262(dict(msg_dict, rseqno=request_seqno,
+                                                slot=str(self.read_after),
+                                                client_id=self.client_id)))
+        except (RuntimeError, OSError):
+            self.drop_learner()
+            return None
+
+        deadline = time.time() + self.ack_timeout
+        while True:
+            try:
+                fields = self.learner_queue.get(timeout=max(0, deadline - time.time()))
+            except queue.Empty:
+                fields = None
+            if fields is None:
+                self.drop_learner()
+                return None
+            if fields['rseqno'] != request_seqno:
+                # Left over from a past read
+                continue
+            if fields['transaction'] == 'k':
+                # The learner may first have to apply commands up to the slot
+                deadline = time.time() + self.ack_timeout
+                continue
+            return fields
+
+    def drop_learner(self):
+        """Stops reading from a crashed or unresponsive learner; reads are
+        then sent to all replicas."""
+        try:
+            self.learner.client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.learner = None
+
+    def receive_learner_messages(self, s):
+        """Target receiving acks and outputs of reads from the learner."""
+        while True:
+            try:
+                fields = deserialize262(s.receive())
+            except (RuntimeError, OSError):
+                # Learner crashed or the client quit
+                self.learner_queue.put(None)
+                return
+
+            with self.lclock_lock:
+                self.lclock = max(self.lclock, int(fields['lclock'])) + 1
+            self.output_bytes += len(fields.get('output_msg', ''))
+            self.learner_queue.put(fields)
+
+    def receive_messages(self, index):
+        """Target receiving messages from the replica at index."""
+        s = self.sockets[index]
+        while True:
+            try:
+                fields = deserialize262(s.receive())
+            except (RuntimeError, OSError):
+                # Replica crashed or was disconnected; notify waiting broadcast
+                self.ack_queue.put((index, None))
+                return
+
+            # Update logical clock
+            with self.lclock_lock:
+                self.lclock = max(self.lclock, int(fields['lclock'])) + 1
+
+            # Add to appropriate message queue
+            if fields['transaction'] in ('k', 'w'):
+                # Message is an ack (agreement protocol), or a notice that
+                # the ack is delayed (backpressure)
+                self.ack_queue.put((index, fields))
+                if self.quit_flag:
+                    return
+            elif fields['transaction'] == 'f':
+                # Message is a failure notice (Failure Detection Assumption, Schneider)
+                self.ack_queue.put((index, fields))
+                return
+            elif fields['transaction'] == 'x':
+                # Exclusion notice (lapsed lease); stale if the client rejoined since
+                if int(fields['rseqno']) >= self.joined_at:
+                    self.lease_cut = int(fields['rseqno'])
+                self.output_queue.put(fields)
+            else:
+                # Message is a command output, executed upon fulfillment of
+                # order protocol
+                self.output_bytes += len(fields.get('output_msg', ''))
+                self.output_queue.put(fields)
+
+    def close(self):
+        """Sends a quit message to all reachable replicas and the learner,
+        and closes the connections once replicas answered it, or failed to
+        in time."""
+        # No request is sent after the quit message
+        with self.request_lock:
+            self.quit_flag = True
+            msg_dict = {'transaction': 'q', 'rseqno': str(self.next_request_id()),
+                        'client_id': self.client_id}
+            self.broadcast(msg_dict, include_failed=True)
+            if self.learner is not None:
+                try:
+                    self.learner.send(serialize262(msg_dict))
+                except (RuntimeError, OSError):
+                    pass
+
+        # Avoid closing sockets when receive threads are using them to recv;
+        # replicas that do not answer the quit message in time are dropped
+        for i, t in enumerate(self.threads):
+            t.join(self.ack_timeout)
+            if t.is_alive():
+                self.disconnect(i)
+                t.join()
+
+        # Socket hygiene
+        for s in self.sockets:
+            s.client_socket.close()
+        if self.learner is not None:
+            self.learner.client_socket.close()
 
 if __name__ == "__main__":
     # Check for correct usage
     print("Enter all port numbers on which server replicas have been initialized, in order for the system to work correctly!")
     print("Example Usage (3 server replicas): client.py 8892 8893 8894")
-    if len(sys.argv) < 2:
+    parser = argparse.ArgumentParser(usage='client.py <port> [<port> ...] [options]')
+    parser.add_argument('ports', nargs='*',
+                        help='ports on localhost on which server replicas are '
+                             'listening, or unix:PATH for replicas listening '
+                             'on Unix domain sockets')
+    parser.add_argument('--config', metavar='PATH',
+                        help='connect to the replicas listed in a cluster '
+                             'configuration')
+    parser.add_argument('--ready-file', metavar='PATH',
+                        help='wait for the readiness file of servers.py and '
+                             'connect to the replicas listed there')
+    parser.add_argument('--learners', nargs='+', default=[], metavar='ADDRESS',
+                        help='ports (or unix:PATH addresses) of learner '
+                             'replicas, in addition to those listed in a '
+                             'configuration or readiness file; reads are '
+                             'sent to one of them at random')
+    parser.add_argument('--ack-timeout', type=float, default=ack_timeout, metavar='SECONDS',
+                        help='time to wait for acks before a replica is '
+                             'considered failed (default: %(default)s)')
+    parser.add_argument('--heartbeat-interval', type=float, default=heartbeat_interval,
+                        metavar='SECONDS',
+                        help='time between dummy requests, which also detect '
+                             'unresponsive replicas (default: %(default)s)')
+    parser.add_argument('--compression', nargs='+', choices=sorted(codecs), default=[],
+                        metavar='CODEC',
+                        help='offer to compress large messages such as '
+                             'listings with the first of these codecs that a '
+                             'replica supports ({})'.format(', '.join(sorted(codecs))))
+    parser.add_argument('--cache-size', type=int, default=1 << 20,
+                        metavar='BYTES',
+                        help='total size of cached [v] and [l] outputs, which '
+                             'replicas do not resend while unchanged '
+                             '(default: %(default)s; 0 disables the cache)')
+    parser.add_argument('--search-limit', type=int, default=search_limit, metavar='N',
+                        help='most site names returned by a search (default: '
+                             '%(default)s; replicas return at most 1000)')
+    parser.add_argument('--digest', action='store_true',
+                        help='print the state digest of every live replica, '
+                             'taken at the same position of the total order, '
+                             'and quit')
+    add_profiling_arguments(parser)
+    args = parser.parse_args()
+    learner_addresses = [('localhost', int(port)) if port.isdigit() else parse_address(port)
+                         for port in args.learners]
+    if args.config is not None:
+        addresses = list(read_cluster_config(args.config).values())
+        learner_addresses += read_cluster_config(args.config, 'learner').values()
+    elif args.ready_file is not None:
+        addresses = wait_for_ready_file(args.ready_file)
+        learner_addresses += read_cluster_config(args.ready_file, 'learner').values()
+    else:
+        addresses = [('localhost', int(port)) if port.isdigit() else parse_address(port)
+                     for port in args.ports]
+    if len(addresses) < 1:
         print("Must enter at least one server replica.")
         sys.exit()
-
-    # Establish conections to all servers
-    for i in range(1, len(sys.argv)):
-        # Connect socket
-        s = ClientSocket262('localhost', int(sys.argv[i]))
-        s.connect()
-        sm_replicas.append(s)
-        ack_queues.append(Queue())
-
-        # Send initial message with client ID
-        s.send(serialize262({'transaction': 'i', 'lclock': str(lclock), 'client_id': client_id}))
-
-        # Detect replica status from response and update logical clock
-        fields = deserialize262(s.receive())
-        if fields['transaction'] == 'f':
-            sm_replica_statuses.append(False)
-        else:
-            assert fields['transaction'] == 'i'
-            sm_replica_statuses.append(True)
-        lclock_lock.acquire()
-        lclock = max(lclock, int(fields['lclock'])) + 1
-        lclock_lock.release()
-
-    print('Connected to {} servers; application starting.\n'.format(len(sys.argv) - 1))
-
-    # Start thread sending dummy requests (order protocol)
-    dummy_request_thread = threading.Thread(target=dummy_request_loop, daemon=True)
-    dummy_request_thread.start()
-
-    # Start threads receiving command outputs from each server
-    receive_threads = []
-    for i in range(len(sm_replicas)):
-        t = threading.Thread(target=receive_messages, args=(i,), daemon=True)
-        t.start()
-        receive_threads.append(t)
+    if args.search_limit <= 0:
+        print("Search limit must be a positive integer.")
+        sys.exit()
+    search_limit = args.search_limit
+    client = ReplicaClient(addresses, learners=learner_addresses,
+                           ack_timeout=args.ack_timeout,
+                           heartbeat_interval=args.heartbeat_interval,
+                           compression=args.compression, cache_size=args.cache_size)
+
+    profiler = None
+    if args.profile is not None:
+        threading.current_thread().name = 'main'
+        profiler = start_profiling('client_{}'.format(client.client_id), args.profile,
+                                   args.profile_window)
+
+    # Establish conections to all servers, and to a learner, if any, which
+    # serves reads
+    client.connect()
+    if client.learner_address is not None and client.learner is None:
+        print('Learner at {}:{} is unreachable; reads are sent to all '
+              'servers.'.format(*client.learner_address))
+    print('Connected to {} servers; application starting.\n'.format(len(addresses)))
+
+    # Digests of the replicas, which agree unless they diverged, instead of
+    # the application
+    if args.digest:
+        for output_msg in client.digests():
+            print(output_msg)
 
     # Main while loop
-    while True:
+    while not args.digest:
         # Prompt user action
         choice = choose_action()
         msg_dict = take_action(choice)
-
-        # Send request to server replicas; atomic with respect to request
-        # broadcasts according to agreement protocol
-        request_lock.acquire()
-
-        if choice == 'q':
-            quit_flag = True
-
-        ## Update logical clock
-        lclock_lock.acquire()
-        lclock += 1
-        lclock_lock.release()
-
-        ## Use lclock value as request ID (order protocol)
-        request_seqno = lclock
-
-        ## Send request message
-        msg_dict['rseqno'] = str(request_seqno)
-        for i in range(len(sm_replicas)):
-            smr = sm_replicas[i]
-            # Send request only to active replicas unless quitting
-            if sm_replica_statuses[i] or choice == 'q':
-                smr.send(serialize262(msg_dict))
-
         if choice == 'q':
             break
 
-        # Check for acks or failure (agreement protocol)
-        for i in range(len(sm_replicas)):
-            if sm_replica_statuses[i]:
-                ack_msg = ack_queues[i].get()
-                if ack_msg['transaction'] == 'f':
-                    sm_replica_statuses[i] = False
-
-        request_lock.release()
-
         # Display output to user, after order protocol is fulfilled by server
-        queue_seqno = 0
-        while queue_seqno != request_seqno:
-            # Discard duplicates or outputs to past commands
-            msg = output_queue.get()
-            queue_seqno = int(msg['rseqno'])
-
-        print('\n' + msg['output_msg'] + '\n')
+        print('\n' + client.request(msg_dict)['output_msg'] + '\n')
 
     # Quit case
     print('Exiting client...')
+    client.close()
 
-    # Avoid closing sockets when receive threads are using them to recv
-    for t in receive_threads:
-        t.join()
-
-    # Socket hygiene
-    for smr in sm_replicas:
-        smr.client_socket.close()
+    if profiler is not None:
+        profiler.finish()
@@ -0,0 +1,165 @@
+import os
+import sys
+import time
+import signal
+import threading
+
+
+class SamplingProfiler:
+    """Low-overhead sampling profiler over all threads of a process.
+
+    A background thread periodically samples the stack of every other
+    thread. While no capture is active the sampler blocks, so an armed but
+    idle profiler costs nothing. Dumps consist of a per-thread summary and
+    a collapsed-stack file (one `frame;frame;... count` line per distinct
+    stack, rooted at the thread name) suitable for flame graph tools.
+    """
+    def __init__(self, name, output_dir, interval=.005):
+        self.name = name
+        self.output_dir = output_dir
+        self.interval = interval
+
+        # Sample counts per (thread name, frame, ..., frame) stack
+        self.samples = {}
+        self.samples_lock = threading.Lock()
+        self.capture_start = None
+
+        # Capture status, current capture window and number of dumps
+        self.active = threading.Event()
+        self.window_timer = None
+        self.dump_count = 0
+
+        # Cache of frame labels per code object
+        self.labels = {}
+
+        sampler_thread = threading.Thread(target=self.sample_loop,
+                                          name='profiler', daemon=True)
+        sampler_thread.start()
+
+    def start(self, duration=None):
+        """Starts a capture, dumped after duration seconds if given."""
+        with self.samples_lock:
+            self.samples = {}
+            self.capture_start = time.time()
+        if self.window_timer is not None:
+            self.window_timer.cancel()
+            self.window_timer = None
+        if duration:
+            self.window_timer = threading.Timer(duration, self.finish)
+            self.window_timer.daemon = True
+            self.window_timer.start()
+        self.active.set()
+
+    def finish(self):
+        """Ends the current capture, if any, and dumps it."""
+        if self.active.is_set():
+            self.active.clear()
+            self.dump()
+
+    def sample_loop(self):
+        """Target sampling stacks of all threads while capture is active."""
+        own_ident = threading.get_ident()
+        while True:
+            self.active.wait()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            frames = sys._current_frames()
+            with self.samples_lock:
+                for ident, frame in frames.items():
+                    if ident == own_ident:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self.label(frame.f_code))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, 'thread-{}'.format(ident)))
+                    stack = tuple(reversed(stack))
+                    self.samples[stack] = self.samples.get(stack, 0) + 1
+            time.sleep(self.interval)
+
+    def label(self, code):
+        """Returns the label of a frame executing code."""
+        label = self.labels.get(code)
+        if label is None:
+            label = '{} ({}:{})'.format(code.co_name,
+                                        os.path.basename(code.co_filename),
+                                        code.co_firstlineno)
+            self.labels[code] = label
+        return label
+
+    def dump(self):
+        """Writes summary and collapsed stacks of the current capture."""
+        with self.samples_lock:
+            samples = dict(self.samples)
+            elapsed = time.time() - (self.capture_start or time.time())
+        if not samples:
+            return
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.dump_count += 1
+        prefix = os.path.join(self.output_dir, '{}-{}-{}'.format(
+            self.name, time.strftime('%Y%m%d%H%M%S'), self.dump_count))
+
+        # Collapsed stacks for flame graphs
+        with open(prefix + '.collapsed', 'w') as f:
+            for stack, count in sorted(samples.items()):
+                f.write(';'.join(stack) + ' ' + str(count) + '\n')
+
+        # Per-thread summary of self and inclusive samples per function
+        threads = {}
+        for stack, count in samples.items():
+            total, self_counts, incl_counts = threads.get(stack[0], (0, {}, {}))
+            if len(stack) > 1:
+                self_counts[stack[-1]] = self_counts.get(stack[-1], 0) + count
+            for frame in set(stack[1:]):
+                incl_counts[frame] = incl_counts.get(frame, 0) + count
+            threads[stack[0]] = (total + count, self_counts, incl_counts)
+
+        with open(prefix + '.profile.txt', 'w') as f:
+            f.write('Profile of {} over {:.1f}s ({:.0f} ms sampling interval)\n'.format(
+                self.name, elapsed, self.interval * 1000))
+            for thread_name in sorted(threads):
+                total, self_counts, incl_counts = threads[thread_name]
+                f.write('\nThread {}: {} samples\n'.format(thread_name, total))
+                f.write('  self%  incl%  function\n')
+                top = sorted(incl_counts, key=lambda x: (-self_counts.get(x, 0),
+                                                         -incl_counts[x]))[:25]
+                for frame in top:
+                    f.write('  {:5.1f}  {:5.1f}  {}\n'.format(
+                        100 * self_counts.get(frame, 0) / total,
+                        100 * incl_counts[frame] / total, frame))
+
+
+def add_profiling_arguments(parser):
+    """Adds command line options of profiling mode to an argument parser."""
+    parser.add_argument('--profile', metavar='DIR',
+                        help='enable profiling mode, writing profiles to DIR')
+    parser.add_argument('--profile-window', type=float, default=0, metavar='SECONDS',
+                        help='in profiling mode, capture only in windows of '
+                             'SECONDS started by SIGUSR1 (default: capture '
+                             'from startup until shutdown)')
+
+
+def start_profiling(name, output_dir, window):
+    """Starts profiling mode in the current process; returns the profiler.
+
+    SIGUSR1 starts a new capture window and SIGUSR2 dumps the current
+    capture. Without a window, capture starts right away and lasts until
+    shutdown. Must be called from the main thread.
+    """
+    profiler = SamplingProfiler(name, output_dir)
+
+    def handle_signal(signum, frame):
+        # Dump outside of the signal handler
+        if signum == signal.SIGUSR1:
+            target = profiler.start
+            args = (window,)
+        else:
+            target = profiler.dump
+            args = ()
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+    signal.signal(signal.SIGUSR1, handle_signal)
+    signal.signal(signal.SIGUSR2, handle_signal)
+    if not window:
+        profiler.start()
+    return profiler
@@ -1,33 +1,533 @@
+import os
 import sys
 import time
+import heapq
+import itertools
+import queue
 import signal
 import socket
+import argparse
 import threading
+from collections import deque
 from multiprocessing import Process, Queue
 from socket_utils import ClientSocket262, serialize262, deserialize262
+from socket_utils import read_cluster_config, write_ready_file, choose_codec
+from socket_utils import listening_socket, unix_host
+from site_store import SiteStore, render_output, not_modified, read_actions
+from profiling import add_profiling_arguments, start_profiling
 
 
 # Replica coordination among state machines implemented using:
 # Agreement protocol: Schneider, Gries, and Schlichting - Fault Tolerant Broadcasts
 # Order protocol: Lamport - Logical clocks (as described by Schneider)
 
+test_mode = False   # Whether replicas are checked for divergence by tests.py
+
+
+class StabilityOrderer:
+    """Stability test of the order protocol over per-client FIFO channels.
+
+    Requests are offered as they arrive; each offer returns the (possibly
+    empty) list of requests that have become stable, in total order.
+
+    A client can be excluded from the stability test right after one of its
+    requests (the cut). Exclusion is prepared by freeze, which holds back
+    later messages of the client, and then committed by exclude or aborted
+    by unfreeze. Once excluded, the client leaves the stability test when
+    its cut has been ordered; its later messages are dropped until it joins
+    again with an 'i' message carrying a request ID.
+
+    A client whose ack is held back sends nothing until it gets the ack;
+    a lower bound on the request ID of its next message, given by bound,
+    stands in for that message meanwhile.
+    """
+    def __init__(self):
+        # Pending (request ID, request) pairs per connected client
+        self.pending = {}
+        # Heap of (request ID, client ID) of the first pending request of
+        # each client, and number of clients without pending requests
+        self.heads = []
+        self.empty = 0
+        # Request ID of the last message received per client
+        self.last_received = {}
+        # Cuts of frozen and excluded clients, and held back messages of
+        # frozen clients
+        self.cuts = {}
+        self.held = {}
+        # Clients of commands dropped since last cleared, one entry per command
+        self.dropped = []
+
+    def join(self, client_id):
+        """Adds a newly connected client to the stability test."""
+        if client_id not in self.pending:
+            self.pending[client_id] = deque()
+            self.empty += 1
+
+    def enqueue(self, client_id, req_id, fields):
+        """Appends a request to the pending requests of a client."""
+        request_queue = self.pending[client_id]
+        if not request_queue:
+            self.empty -= 1
+            heapq.heappush(self.heads, (req_id, client_id))
+        request_queue.append((req_id, fields))
+
+    def dequeue(self, client_id):
+        """Removes the first pending request of a client, which is the
+        lowest of all."""
+        request_queue = self.pending[client_id]
+        request_queue.popleft()
+        if request_queue:
+            heapq.heapreplace(self.heads, (request_queue[0][0], client_id))
+        else:
+            heapq.heappop(self.heads)
+            self.empty += 1
+
+    def offer(self, client_id, fields):
+        """Adds the next message of a client and returns stable requests."""
+        action = fields['transaction']
+        if 'rseqno' not in fields:
+            # Initial message of a newly connected client
+            self.join(client_id)
+            return []
+        req_id = int(fields['rseqno'])
+        cut = self.cuts.get(client_id)
+        if cut is not None and req_id > cut:
+            if client_id in self.held:
+                self.held[client_id].append(fields)
+                return []
+            if action == 'i':
+                # Excluded client rejoins
+                del self.cuts[client_id]
+            elif action == 'q':
+                # Excluded clients quit without ordering
+                return [(client_id, fields)]
+            else:
+                if action != 'd':
+                    self.dropped.append(client_id)
+                return []
+
+        self.last_received[client_id] = req_id
+        if action == 'i':
+            self.join(client_id)
+            return []
+        self.enqueue(client_id, req_id, fields)
+        if req_id == cut and client_id not in self.held:
+            self.enqueue(client_id, cut, {'transaction': 'x'})
+        return self.drain()
+
+    def bound(self, client_id, req_id):
+        """Records that the next message of a client has a request ID above
+        req_id; returns stable requests."""
+        request_queue = self.pending.get(client_id)
+        if request_queue is None or client_id in self.cuts:
+            return []
+        if req_id <= (request_queue[-1][0] if request_queue else
+                      self.last_received.get(client_id, -1)):
+            return []
+        # A dummy request at the bound advances the stability test
+        self.enqueue(client_id, req_id, {'transaction': 'd'})
+        return self.drain()
+
+    def leave(self, client_id):
+        """Removes a client whose connection broke from the stability test
+        after the messages received from it, as if it had quit; returns
+        stable requests."""
+        if client_id not in self.pending and client_id not in self.cuts:
+            return []
+        req_ids = [self.last_received.get(client_id, 0)]
+        if self.pending.get(client_id):
+            # Possibly a dummy at a bound
+            req_ids.append(self.pending[client_id][-1][0])
+        req_ids += [int(fields['rseqno']) for fields in self.held.get(client_id, ())]
+        return self.offer(client_id, {'transaction': 'q', 'rseqno': str(max(req_ids) + 1),
+                                      'client_id': client_id})
+
+    def freeze(self, client_id, cut):
+        """Holds back messages of a client after request ID cut; returns
+        whether the client can be excluded there."""
+        if (client_id not in self.pending or client_id in self.cuts or
+                self.last_received.get(client_id, -1) > cut):
+            return False
+        self.cuts[client_id] = cut
+        self.held[client_id] = []
+        return True
+
+    def exclude(self, client_id):
+        """Excludes a frozen client after its cut; returns stable requests."""
+        cut = self.cuts[client_id]
+        if client_id in self.pending and self.last_received.get(client_id, -1) >= cut:
+            self.enqueue(client_id, cut, {'transaction': 'x'})
+        return self.release(client_id)
+
+    def unfreeze(self, client_id):
+        """Aborts the exclusion of a frozen client; returns stable requests."""
+        del self.cuts[client_id]
+        return self.release(client_id)
+
+    def release(self, client_id):
+        """Offers messages held back from a client; returns stable requests."""
+        stable = []
+        for fields in self.held.pop(client_id):
+            stable += self.offer(client_id, fields)
+        return stable + self.drain()
+
+    def drain(self):
+        """Removes and returns all requests that are currently stable."""
+        stable = []
+        # A request is stable once every client has a pending request
+        while self.pending and not self.empty:
+            # Identify request with lowest request ID (stability test)
+            req_id, client_id = self.heads[0]
+            request_queue = self.pending[client_id]
+            fields = request_queue[0][1]
+
+            if fields['transaction'] == 'q':
+                # Quit message case - client leaves the stability test
+                del self.pending[client_id]
+                heapq.heappop(self.heads)
+            elif fields['transaction'] == 'd':
+                # Dummy requests only advance the stability test
+                self.dequeue(client_id)
+                continue
+            elif fields['transaction'] == 'x':
+                # Exclusion case - client leaves the stability test unless it
+                # has rejoined since
+                self.dequeue(client_id)
+                if not request_queue and client_id in self.cuts:
+                    del self.pending[client_id]
+                    self.empty -= 1
+                continue
+            elif len(request_queue) < 2:
+                # Verify agreement protocol by waiting for receipt of next
+                # message from same client
+                break
+            else:
+                self.dequeue(client_id)
+            stable.append((client_id, fields))
+        return stable
+
+
+class SequencerOrderer:
+    """Total order assigned by a sequencer replica.
+
+    The sequencer, the live replica with the lowest ID, assigns consecutive
+    slots to requests as it receives them and broadcasts the assignments to
+    the other replicas in ascending ID order. Every replica forwards
+    requests in slot order once it has both the request and its slot.
+
+    When the sequencer fails, the next replica takes over. Since assignments
+    are broadcast in ascending ID order, it knows every assignment that any
+    live replica knows; it rebroadcasts its recent assignments and then
+    assigns slots to the requests that have none yet.
+    """
+    def __init__(self, replica_id, replica_ids, history=4096):
+        self.replica_id = replica_id
+        self.live = set(replica_ids)
+
+        # Received requests not yet forwarded, by (client ID, request ID)
+        self.pending = {}
+        # Received requests without a known slot, in order of arrival
+        self.unassigned = {}
+        # Known assignments not yet forwarded, by slot, and their requests
+        self.slots = {}
+        self.assigned = set()
+        # Recent assignments, rebroadcast when taking over as sequencer
+        self.history = deque(maxlen=history)
+
+        self.next_slot = 0          # Next slot to forward
+        self.next_free_slot = 0     # Next slot to assign
+
+        # Clients whose connection broke; slots of their requests that were
+        # not received are skipped
+        self.departed = set()
+
+    def is_sequencer(self):
+        """Whether this replica currently assigns slots."""
+        return min(self.live) == self.replica_id
+
+    def fail(self, replica_id):
+        """Removes a failed replica; returns whether this replica took over."""
+        was_sequencer = self.is_sequencer()
+        self.live.discard(replica_id)
+        return not was_sequencer and self.is_sequencer()
+
+    def offer(self, client_id, fields):
+        """Adds a request received from a client and returns stable requests."""
+        key = (client_id, fields['rseqno'])
+        self.pending[key] = fields
+        if key not in self.assigned:
+            self.unassigned[key] = None
+        return self.drain()
+
+    def learn(self, slot, client_id, rseqno):
+        """Records an assignment of the sequencer and returns stable requests."""
+        if slot >= self.next_slot and slot not in self.slots:
+            key = (client_id, rseqno)
+            self.slots[slot] = key
+            self.assigned.add(key)
+            self.unassigned.pop(key, None)
+            self.history.append((slot, client_id, rseqno))
+            self.next_free_slot = max(self.next_free_slot, slot + 1)
+        return self.drain()
+
+    def leave(self, client_id):
+        """Skips the slots of requests of a client whose connection broke
+        that were never received; returns stable requests."""
+        self.departed.add(client_id)
+        return self.drain()
+
+    def assign(self):
+        """Assigns slots to all unassigned requests; returns the assignments.
+
+        Assigned requests become stable only once drained, so that the
+        assignments can be broadcast before any of them is executed.
+        """
+        assignments = []
+        for client_id, rseqno in list(self.unassigned):
+            slot = self.next_free_slot
+            self.slots[slot] = (client_id, rseqno)
+            self.assigned.add((client_id, rseqno))
+            self.history.append((slot, client_id, rseqno))
+            self.next_free_slot += 1
+            assignments.append((slot, client_id, rseqno))
+        self.unassigned.clear()
+        return assignments
+
+    def drain(self):
+        """Removes and returns requests whose slots are next, in slot order."""
+        stable = []
+        while True:
+            key = self.slots.get(self.next_slot)
+            if key in self.pending:
+                stable.append((key[0], self.pending.pop(key)))
+            elif key is None or key[0] not in self.departed:
+                break
+            del self.slots[self.next_slot]
+            self.assigned.discard(key)
+            self.next_slot += 1
+        return stable
+
+
+class ClientLeases:
+    """Client leases of the stability test, coordinated among replicas.
+
+    Every message of a client renews its lease. The live replica with the
+    lowest ID coordinates the exclusion of clients whose leases lapse, in
+    two phases: it freezes the client after the last request it received
+    from it (the cut) and asks the other replicas to do the same; if all of
+    them can, it commits the exclusion, otherwise it aborts it. Replicas
+    that have already used a later message of the client cannot freeze it,
+    so every replica excludes the client at the same point of its FIFO
+    channel.
+
+    Decisions are broadcast in ascending ID order, so a replica taking over
+    as coordinator knows every decision that any live replica knows; it
+    rebroadcasts its recent commits and aborts the exclusions it has only
+    prepared.
+    """
+    def __init__(self, replica_id, replica_ids, duration, history=1024):
+        self.replica_id = replica_id
+        self.live = set(replica_ids)
+        self.duration = duration
+
+        # Time each client was last heard from, and of the next lease check
+        self.last_heard = {}
+        self.next_check = 0
+        # Exclusions coordinated here: client ID -> (cut, replicas yet to vote)
+        self.votes = {}
+        # Recent commits (client ID, cut), rebroadcast when taking over
+        self.commits = deque(maxlen=history)
+
+    def is_coordinator(self):
+        """Whether this replica currently coordinates exclusions."""
+        return min(self.live) == self.replica_id
+
+    def renew(self, client_id):
+        """Renews the lease of a client that was just heard from."""
+        self.last_heard[client_id] = time.time()
+
+    def lapsed(self, client_ids):
+        """Returns the clients among client_ids whose leases have lapsed;
+        checks at most every quarter of the lease duration."""
+        now = time.time()
+        if now < self.next_check:
+            return []
+        self.next_check = now + self.duration / 4
+        return [c for c in client_ids if c not in self.votes and
+                now - self.last_heard.setdefault(c, now) > self.duration]
+
+    def start(self, client_id, cut):
+        """Starts coordinating an exclusion; returns whether it is decided
+        already (no other live replica votes)."""
+        self.votes[client_id] = (cut, self.live - {self.replica_id})
+        return not self.votes[client_id][1]
+
+    def vote(self, client_id, cut, replica_id, yes):
+        """Records a vote; returns 'commit' or 'abort' once decided."""
+        cut_voters = self.votes.get(client_id)
+        if cut_voters is None or cut_voters[0] != cut:
+            return None
+        voters = cut_voters[1]
+        voters.discard(replica_id)
+        if not yes or not voters:
+            del self.votes[client_id]
+            return 'commit' if yes else 'abort'
+        return None
+
+    def fail(self, replica_id):
+        """Removes a failed replica; returns whether this replica took over
+        and the exclusions that no longer await votes."""
+        was_coordinator = self.is_coordinator()
+        self.live.discard(replica_id)
+        decided = []
+        for client_id, (cut, voters) in list(self.votes.items()):
+            voters.discard(replica_id)
+            if not voters:
+                del self.votes[client_id]
+                decided.append((client_id, cut))
+        return not was_coordinator and self.is_coordinator(), decided
+
+
+class DigestChecker:
+    """Compares digest checkpoints reported by replicas.
+
+    Replicas report their digests after every so many executed commands;
+    reports for the same position in the total order are compared as they
+    arrive, and a mismatch is flagged with the request executed there.
+    """
+    def __init__(self, digest_queue, num_replicas, history=1024):
+        self.digest_queue = digest_queue
+        self.num_replicas = num_replicas
+        self.history = history
+
+        # First report and number of reports per checkpoint, oldest first
+        self.checkpoints = {}
+        self.checkpoint_order = deque()
+
+        # Comparison statistics
+        self.compared = 0
+        self.divergent = 0
+
+    def run(self):
+        """Target receiving and comparing digest checkpoints."""
+        while True:
+            self.check(*self.digest_queue.get())
+
+    def check(self, port, exec_count, client_id, rseqno, digests):
+        """Compares a checkpoint with the first report of its position."""
+        checkpoint = self.checkpoints.get(exec_count)
+        if checkpoint is None:
+            self.checkpoints[exec_count] = [(port, client_id, rseqno, digests), 1]
+            self.checkpoint_order.append(exec_count)
+            if len(self.checkpoint_order) > self.history:
+                self.checkpoints.pop(self.checkpoint_order.popleft(), None)
+            return
+
+        (ref_port, ref_client_id, ref_rseqno, ref_digests), reports = checkpoint
+        self.compared += 1
+        if (client_id, rseqno, digests) != (ref_client_id, ref_rseqno, ref_digests):
+            self.divergent += 1
+            print('\nDivergence detected at rseqno {} (command {}): replica {} '
+                  '(client {}, digests {}) differs from replica {} (client {}, '
+                  'rseqno {}, digests {}).'.format(
+                      ref_rseqno, exec_count, port, client_id, digests, ref_port,
+                      ref_client_id, ref_rseqno, ref_digests), flush=True)
+
+        # Forget checkpoints once all replicas have reported
+        checkpoint[1] = reports + 1
+        if checkpoint[1] == self.num_replicas:
+            del self.checkpoints[exec_count]
+
+    def summary(self):
+        """Returns a summary of comparisons made so far."""
+        return 'Compared {} digest checkpoints; {} divergent.'.format(
+            self.compared, self.divergent)
+
+
 class ServerReplica(Process):
-    """State Machine Server Replica class."""
-    def __init__(self, ip, port):
+    """State Machine Server Replica class.
+
+    Requests flow through three stages connected by bounded queues: the
+    ordering stage runs the stability test, the state application stage
+    applies stable commands to the database strictly sequentially, and a
+    pool of reply workers renders, serializes and sends command outputs.
+
+    A port of 0 binds the replica to a port assigned by the OS, which is
+    available as the port attribute once the replica is constructed. An ip
+    of unix_host makes the replica listen on the Unix domain socket at path
+    port instead of over TCP.
+
+    If digest_interval is positive, the replica reports its digests to
+    digest_queue after every digest_interval executed commands.
+
+    With ordering 'sequencer', the ordering stage follows slot assignments
+    of a sequencer replica instead of running the stability test; replicas
+    then connect to the peers given by the peers attribute, a dict from
+    replica ID to (ip, port), and identify themselves by replica_id.
+
+    If lease is positive (stability test only), clients that send nothing
+    for lease seconds are excluded from the stability test until they
+    rejoin; replicas then connect to their peers as in sequencer ordering.
+
+    Commands received but not yet executed are limited per client by
+    client_backlog and in total by backlog (0 for no limit). The ack of a
+    client over its limit, or over its fair share of backlog while the
+    total exceeds it, is delayed until enough of its commands have been
+    executed; meanwhile the client is told to wait every
+    backpressure_interval seconds, so that it does not consider the
+    replica failed. With the stability test, requests of other clients are
+    ordered past a held back client, whose next request goes after them;
+    with sequencer ordering, the limits keep a flooding client from taking
+    all slots.
+
+    Every executed command is streamed, along with its position in the
+    total order (slot), to the learner replicas connected to the replica.
+    A learner takes no part in ordering: it applies the stream of one of
+    the replicas given by the peers attribute, following the next one in
+    ID order when that one fails or its stream goes quiet for
+    stream_timeout seconds (replicas send a heartbeat on a stream idle for
+    a quarter of that), and serves reads ('l', 'v', 's' and 'a') of
+    clients. A read carrying a slot is served once the learner has applied
+    the command at that position.
+
+    If batch_size is positive (voting replicas only), the ordering stage,
+    once a request is stable, also orders the messages already received,
+    and hands the requests stable by then over as one batch of at most
+    batch_size commands. The state
+    application stage executes a batch under one acquisition of its locks,
+    and hands the outputs to the reply workers grouped per client, each
+    group being sent in one write.
+    """
+    def __init__(self, ip, port, render_workers=4, pipeline_depth=1024,
+                 profile_dir=None, profile_window=0, digest_interval=0,
+                 ordering='lamport', peer_timeout=10, lease=0,
+                 client_backlog=0, backlog=0, backpressure_interval=.25,
+                 learner=False, stream_timeout=2, batch_size=0):
         super(ServerReplica, self).__init__()
         # Arguments
         self.ip = ip
         self.port = port
+        self.render_workers = render_workers
+        self.pipeline_depth = pipeline_depth
+        self.profile_dir = profile_dir
+        self.profile_window = profile_window
+        self.digest_interval = digest_interval
+        self.ordering = ordering
+        self.peer_timeout = peer_timeout
+        self.lease = lease
+        self.client_backlog = client_backlog
+        self.backlog = backlog
+        self.backpressure_interval = backpressure_interval
+        self.learner = learner
+        self.stream_timeout = stream_timeout
+        # Learners apply streamed commands one at a time
+        self.batch_size = 0 if learner else batch_size
 
         # Simulated functional status
         self.alive = True
 
-        # Event indicating nonzero client connections
-        self.not_idle = threading.Event()
-
         # Client sockets
         self.client_sockets = {}
-        self.send_lock = threading.Lock()
 
         # Connected clients
         self.connected_clients = set()
@@ -36,171 +536,548 @@ class ServerReplica(Process):
         self.lclock = 0
         self.lclock_lock = threading.Lock()
 
-        # Request queues per client; FIFO Channels (Schneider) assumed
-        self.request_queues = {}
-        self.rq_lock = threading.Lock()
+        # Incoming requests from all clients, and messages from peer replicas
+        # (with client ID None); FIFO Channels (Schneider) assumed
+        self.request_queue = queue.Queue()
+
+        # Stable requests not yet handed to the state application stage, and
+        # messages still to be ordered before they are (batch mode)
+        self.stable_batch = []
+        self.batch_messages = 0
+
+        # Sockets to peer replicas, by replica ID (sequencer ordering or
+        # client leases)
+        self.peer_sockets = {}
+
+        # Client leases of the stability test, set up when started
+        self.leases = None
+
+        # Commands received but not yet executed, per client and in total
+        # (admission control)
+        self.admission = threading.Condition()
+        self.backlogs = {}
+        self.total_backlog = 0
 
         # Database of vaccine site information
-        self.vaccine_availability = {'Harvard University': ['0', '02138']}
+        self.site_store = SiteStore()
+
+        # Queues of executed commands streamed to each connected learner;
+        # the lock makes registering a learner atomic with respect to the
+        # state application stage
+        self.learner_streams = []
+        self.learner_lock = threading.Lock()
 
         # Initialize server socket
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.s.bind((self.ip, self.port))
-        self.s.listen(5)
+        self.s = listening_socket(self.ip, self.port)
+        if self.ip != unix_host:
+            self.port = self.s.getsockname()[1]
 
     def run(self):
         """Main execution thread of process."""
+        threading.current_thread().name = 'run'
+        if self.profile_dir is not None:
+            self.start_profiling()
+
         # Dispatch thread to detect simulated failure
-        detect_failure_thread = threading.Thread(target=self.detect_simulated_failure, daemon=True)
+        detect_failure_thread = threading.Thread(target=self.detect_simulated_failure,
+                                                 name='detect_simulated_failure', daemon=True)
         detect_failure_thread.start()
 
+        # Bounded queues between pipeline stages
+        self.apply_queue = queue.Queue(self.pipeline_depth)
+        self.reply_queues = [queue.Queue(self.pipeline_depth)
+                             for _ in range(self.render_workers)]
+
+        # Dispatch state application stage and reply workers
+        if self.learner:
+            apply_target = self.learn_commands
+        elif self.batch_size > 0:
+            apply_target = self.apply_batches
+        else:
+            apply_target = self.apply_commands
+        apply_thread = threading.Thread(target=apply_target, name='apply_commands',
+                                        daemon=True)
+        apply_thread.start()
+        for reply_queue in self.reply_queues:
+            reply_thread = threading.Thread(target=self.send_replies, args=(reply_queue,),
+                                            name='send_replies', daemon=True)
+            reply_thread.start()
+
+        if self.ordering == 'lamport' and self.lease > 0 and not self.learner:
+            self.leases = ClientLeases(self.replica_id, [self.replica_id] + list(self.peers),
+                                       self.lease)
+
         # Dispatch thread to listen for connections
-        server_socket_thread = threading.Thread(target=self.serve, daemon=True)
+        server_socket_thread = threading.Thread(target=self.serve, name='serve', daemon=True)
         server_socket_thread.start()
 
-        # Execute requests, according to stability test from order protocol
-        execution_queue = {}
-        while True:
-            # If in simulated fail state, do nothing
-            if not self.alive:
-                continue
+        if self.learner:
+            # Follow the total order of the voting replicas
+            self.follow_replicas()
+        elif self.ordering == 'sequencer':
+            # Order requests by slots assigned by the sequencer
+            self.connect_peers()
+            self.sequence_requests()
+        else:
+            # Order requests, according to stability test from order protocol
+            if self.leases is not None:
+                self.connect_peers()
+            self.order_requests()
+
+        # Simulated failure; stay up to notify clients of failure
+        threading.Event().wait()
+
+    def start_profiling(self):
+        """Starts profiling mode; profiles are dumped when terminated."""
+        name = self.port if self.ip != unix_host else os.path.basename(self.port)
+        self.profiler = start_profiling('replica_{}'.format(name),
+                                        self.profile_dir, self.profile_window)
+
+        def sigterm_handler(signum, frame):
+            self.profiler.finish()
+            os._exit(0)
+
+        # Shutdown is driven by the parent process
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, sigterm_handler)
 
-            # Block when there are 0 connections
-            self.not_idle.wait()
+    def order_requests(self):
+        """Ordering stage; forwards stable requests in total order."""
+        orderer = StabilityOrderer()
+        leases = self.leases
+        # With client leases, wake up regularly to check them
+        timeout = None if leases is None else leases.duration / 4
+        while True:
+            try:
+                client_id, fields = self.request_queue.get(timeout=timeout)
+            except queue.Empty:
+                client_id, fields = None, {'transaction': 'd'}
 
-            # Ensure execution queue is filled with one request from every client
-            self.rq_lock.acquire()
-            for client_id, request_queue in self.request_queues.items():
-                if client_id not in execution_queue:
-                    nxt_request = request_queue.get()
-                    execution_queue[client_id] = (int(nxt_request['rseqno']),
-                                                  client_id, nxt_request)
-            self.rq_lock.release()
+            # If in simulated fail state, notify peers and stop ordering
+            if not self.alive:
+                if leases is not None:
+                    self.send_to_peers({'transaction': 'f', 'replica_id': str(self.replica_id)})
+                return
 
-            # Identify request with lowest request ID (stability test)
-            req_id, client_id, fields = min(list(execution_queue.values()),
-                                            key = lambda x: (x[0], x[1]))
+            action = fields['transaction']
+            if action == 'g':
+                stable = orderer.leave(client_id)
+            elif action == 'b':
+                stable = orderer.bound(client_id, int(fields['rseqno']))
+            elif client_id is not None:
+                stable = orderer.offer(client_id, fields)
+            elif action == 'm':
+                stable = self.handle_exclusion(orderer, fields)
+            elif action == 'f' and leases is not None:
+                stable = []
+                took_over, decided = leases.fail(int(fields['replica_id']))
+                for excluded_id, cut in decided:
+                    stable += self.decide_exclusion(orderer, excluded_id, cut, 'commit')
+                if took_over:
+                    # Took over as coordinator; make known decisions agree
+                    for excluded_id, cut in leases.commits:
+                        self.send_exclusion('commit', excluded_id, cut)
+                    for frozen_id in list(orderer.held):
+                        stable += self.decide_exclusion(orderer, frozen_id,
+                                                        orderer.cuts[frozen_id], 'abort')
+            else:
+                stable = []
+
+            # Exclude clients whose leases have lapsed
+            if leases is not None and leases.is_coordinator():
+                for lapsed_id in leases.lapsed([c for c in orderer.pending
+                                                if c not in orderer.cuts]):
+                    stable += self.start_exclusion(orderer, lapsed_id)
+
+            # Commands dropped from excluded clients are no longer backlog
+            for dropped_id in orderer.dropped:
+                self.release_backlog(dropped_id)
+            orderer.dropped.clear()
+
+            self.forward_stable(stable)
+
+    def start_exclusion(self, orderer, client_id):
+        """Coordinates the exclusion of a client after the last request
+        received from it; returns stable requests."""
+        cut = orderer.last_received.get(client_id, -1)
+        if not orderer.freeze(client_id, cut):
+            return []
+        self.send_exclusion('prepare', client_id, cut)
+        if self.leases.start(client_id, cut):
+            return self.decide_exclusion(orderer, client_id, cut, 'commit')
+        return []
+
+    def decide_exclusion(self, orderer, client_id, cut, decision):
+        """Broadcasts and applies the decision on a coordinated exclusion;
+        returns stable requests."""
+        self.send_exclusion(decision, client_id, cut)
+        if decision == 'abort':
+            # Client turned out to be alive; renew its lease
+            self.leases.renew(client_id)
+            return orderer.unfreeze(client_id)
+        self.leases.commits.append((client_id, cut))
+        self.notify_excluded(client_id, cut)
+        return orderer.exclude(client_id)
+
+    def handle_exclusion(self, orderer, fields):
+        """Handles an exclusion message of a peer; returns stable requests."""
+        phase = fields['phase']
+        client_id = fields['client_id']
+        cut = int(fields['rseqno'])
+        sender = int(fields['replica_id'])
+        if phase == 'prepare':
+            vote = 'yes' if orderer.freeze(client_id, cut) else 'no'
+            self.send_exclusion(vote, client_id, cut, [sender])
+            return []
+        if phase in ('yes', 'no'):
+            decision = self.leases.vote(client_id, cut, sender, phase == 'yes')
+            if decision is None:
+                return []
+            return self.decide_exclusion(orderer, client_id, cut, decision)
+
+        # Decision of the coordinator, unless applied already
+        if orderer.cuts.get(client_id) != cut or client_id not in orderer.held:
+            return []
+        if phase == 'abort':
+            return orderer.unfreeze(client_id)
+        self.leases.commits.append((client_id, cut))
+        self.notify_excluded(client_id, cut)
+        return orderer.exclude(client_id)
+
+    def send_exclusion(self, phase, client_id, cut, replica_ids=None):
+        """Sends a message of a coordinated exclusion to peers."""
+        self.send_to_peers({'transaction': 'm', 'phase': phase, 'client_id': client_id,
+                            'rseqno': str(cut), 'replica_id': str(self.replica_id)},
+                           replica_ids)
+
+    def notify_excluded(self, client_id, cut):
+        """Tells an excluded client that its messages after cut are dropped
+        until it rejoins."""
+        scsocket = self.client_sockets.get(client_id)
+        if scsocket is not None:
+            try:
+                scsocket.send(serialize262({'transaction': 'x', 'rseqno': str(cut),
+                                            'lclock': str(self.lclock)}))
+            except (RuntimeError, OSError):
+                pass
+
+    def connect_peers(self):
+        """Connects to all peer replicas, waiting for them to listen.
+
+        Peers that cannot be reached within peer_timeout are considered
+        failed.
+        """
+        deadline = time.time() + self.peer_timeout
+        hello = serialize262({'transaction': 'p', 'replica_id': str(self.replica_id)})
+        for replica_id, (ip, port) in sorted(self.peers.items()):
             while True:
-                if fields['transaction'] == 'q':
-                    # Quit message case - perform cleanup associated with client
-                    self.rq_lock.acquire()
-                    del self.request_queues[client_id]
-                    self.rq_lock.release()
-                    del execution_queue[client_id]
-                    self.client_sockets[client_id].client_socket.close()
-                    del self.client_sockets[client_id]
-
-                    # Check if server replica now idle
-                    if len(self.connected_clients) == 0:
-                        self.not_idle.clear()
-                else:
-                    # Refill execution queue with next request from same client.
-                    # If request is not dummy, this verifies agreement protocol
-                    # by waiting for receipt of nenxt message from same client.
-                    # Otherwise, it refills the execution queue for
-                    # re-identification of next stable non-dummy request
-                    nxt_request = self.request_queues[client_id].get()
-                    execution_queue[client_id] = (int(nxt_request['rseqno']),
-                                                  client_id, nxt_request)
-
-                # Execute if request is not a dummy request (stability test)
-                if (fields['transaction'] != 'd' and
-                    client_id in self.connected_clients) or not self.alive:
+                try:
+                    s = ClientSocket262(ip, port)
+                    s.connect()
+                    s.send(hello)
+                    self.peer_sockets[replica_id] = s
                     break
+                except OSError:
+                    if time.time() > deadline:
+                        self.request_queue.put((None, {'transaction': 'f',
+                                                       'replica_id': str(replica_id)}))
+                        break
+                    time.sleep(.05)
+
+    def send_to_peers(self, msg_dict, replica_ids=None):
+        """Sends a message to all reachable peers (or those among
+        replica_ids), in ascending ID order."""
+        msg = serialize262(msg_dict)
+        if replica_ids is None:
+            replica_ids = self.peer_sockets
+        for replica_id in sorted(set(replica_ids) & set(self.peer_sockets)):
+            try:
+                self.peer_sockets[replica_id].send(msg)
+            except (RuntimeError, OSError):
+                # Failure is reported by the thread receiving from the peer
+                del self.peer_sockets[replica_id]
+
+    def sequence_requests(self):
+        """Ordering stage in sequencer mode; forwards requests in slot order."""
+        orderer = SequencerOrderer(self.replica_id, [self.replica_id] + list(self.peers))
+        while True:
+            client_id, fields = self.request_queue.get()
 
-                # Block when there are 0 connections
-                self.not_idle.wait()
-
-                # Otherwise, refill execution queue if needed...
-                self.rq_lock.acquire()
-                for client_id, request_queue in self.request_queues.items():
-                    if client_id not in execution_queue:
-                        nxt_request = request_queue.get()
-                        execution_queue[client_id] = (int(nxt_request['rseqno']),
-                                                      client_id, nxt_request)
-                self.rq_lock.release()
+            # If in simulated fail state, notify peers and stop ordering
+            if not self.alive:
+                self.send_to_peers({'transaction': 'f', 'replica_id': str(self.replica_id)})
+                return
 
-                # ...and identify request with lowest request ID and repeat
-                req_id, client_id, fields = min(list(execution_queue.values()),
-                                                key = lambda x: (x[0], x[1]))
+            action = fields['transaction']
+            if client_id is not None:
+                # Clients take no part in ordering beyond their requests
+                if action in ('i', 'd'):
+                    self.forward_stable([])
+                    continue
+                if action == 'g':
+                    # The client no longer reads outputs from this
+                    # replica; release its connection
+                    stable = orderer.leave(client_id) + [(client_id, {'transaction': 'q'})]
+                else:
+                    stable = orderer.offer(client_id, fields)
+            elif action == 'o':
+                stable = orderer.learn(int(fields['slot']), fields['client_id'],
+                                       fields['rseqno'])
+            else:
+                assert action == 'f'
+                stable = []
+                if orderer.fail(int(fields['replica_id'])):
+                    # Took over as sequencer; make known assignments agree
+                    for slot, slot_client_id, rseqno in orderer.history:
+                        self.send_assignment(slot, slot_client_id, rseqno)
+
+            # Broadcast new assignments before executing any of them
+            if orderer.is_sequencer():
+                for assignment in orderer.assign():
+                    self.send_assignment(*assignment)
+                stable += orderer.drain()
+
+            self.forward_stable(stable)
+
+    def send_assignment(self, slot, client_id, rseqno):
+        """Broadcasts the slot assigned to a request to all peers."""
+        self.send_to_peers({'transaction': 'o', 'slot': str(slot),
+                            'client_id': client_id, 'rseqno': rseqno})
+
+    def forward_stable(self, stable):
+        """Hands stable requests to the state application stage; in batch
+        mode, they are held back while more messages wait to be ordered."""
+        if self.batch_size <= 0:
+            for stable_request in stable:
+                self.apply_queue.put(stable_request)
+            return
+        if stable and not self.stable_batch:
+            # Messages received before the batch started are ordered before
+            # it is handed over, but later ones are not waited for
+            self.batch_messages = self.request_queue.qsize()
+        else:
+            self.batch_messages -= 1
+        self.stable_batch += stable
+        while self.stable_batch and (len(self.stable_batch) >= self.batch_size or
+                                     self.batch_messages <= 0):
+            self.apply_queue.put(self.stable_batch[:self.batch_size])
+            del self.stable_batch[:self.batch_size]
+
+    def apply_commands(self):
+        """State application stage; executes stable requests sequentially."""
+        while True:
+            client_id, fields = self.apply_queue.get()
 
             # If in simulated fail state, do nothing
             if not self.alive:
+                return
+
+            if fields['transaction'] == 'q':
+                # Release client connection after its outstanding replies
+                self.dispatch_reply((client_id, fields, None, None))
                 continue
 
             # Now prepare to execute request command
             self.lclock_lock.acquire()
             self.lclock += 1
+            lclock = self.lclock
             self.lclock_lock.release()
-            action = fields['transaction']
-            msg_dict = {
-                'transaction': action,
-                'lclock': str(self.lclock),
-                'rseqno': str(req_id),
-            }
-
-            # Execute next command and construct command output
-            if action == 'l':
-                output = 'Availability,ZIP Code,Site Name\n'
-                rows = []
-                for site in sorted(self.vaccine_availability.keys()):
-                    details = self.vaccine_availability[site]
-                    rows.append(','.join(details) + ',' + site)
-                output += '\n'.join(rows)
-
-            elif action == 'v':
-                site_name = fields['site_name']
-
-                # Check if site exists
-                if site_name not in self.vaccine_availability:
-                    output = 'Site does not exist. Choose [l] to view all sites.'
-                else:
-                    site = self.vaccine_availability[site_name]
-                    output = 'Availability at {} (ZIP code {}): {}'.format(
-                        site_name, site[1], site[0])
 
-            elif action == 'e':
-                site_name = fields['site_name']
-                vaccine_no = fields['vaccine_no']
+            # Execute next command, and stream it to learners along with its
+            # position in the total order, which is also sent to the client
+            with self.learner_lock:
+                result = self.site_store.apply(fields)
+                if fields['transaction'] != 'h':
+                    fields['slot'] = str(self.site_store.exec_count)
+                    for stream in self.learner_streams:
+                        stream.put(fields)
+            self.dispatch_reply((client_id, fields, lclock, result))
+            self.release_backlog(client_id)
+
+            # Digest queries are not executed commands
+            if fields['transaction'] != 'h':
+                self.report_digest(client_id, fields)
+
+    def apply_batches(self):
+        """State application stage in batch mode; executes batches of stable
+        requests sequentially, and hands their outputs to the reply workers
+        grouped per client."""
+        while True:
+            batch = self.apply_queue.get()
 
-                # Check if site exists
-                if site_name not in self.vaccine_availability:
-                    output = 'Site does not exist. Choose [l] to view all sites.'
-                else:
-                    self.vaccine_availability[site_name][0] = vaccine_no
-                    output = 'Vaccine availability at {} (ZIP code {}) updated to {}.'.format(
-                        site_name, self.vaccine_availability[site_name][1], vaccine_no)
+            # If in simulated fail state, do nothing
+            if not self.alive:
+                return
+
+            # Logical clock values of the outputs of the batch
+            with self.lclock_lock:
+                lclock = self.lclock
+                self.lclock += len(batch)
+
+            # Replies per client, in execution order, and number of commands
+            # executed per client
+            replies = {}
+            executed = {}
+            with self.learner_lock:
+                for client_id, fields in batch:
+                    if fields['transaction'] == 'q':
+                        # Release client connection after its outstanding replies
+                        replies.setdefault(client_id, []).append((fields, None, None))
+                        continue
+                    lclock += 1
+                    result = self.site_store.apply(fields)
+                    if fields['transaction'] != 'h':
+                        fields['slot'] = str(self.site_store.exec_count)
+                        for stream in self.learner_streams:
+                            stream.put(fields)
+                        self.report_digest(client_id, fields)
+                    replies.setdefault(client_id, []).append((fields, lclock, result))
+                    executed[client_id] = executed.get(client_id, 0) + 1
+
+            for client_id, client_replies in replies.items():
+                self.dispatch_reply((client_id, client_replies))
+            self.release_backlogs(executed)
+
+    def report_digest(self, client_id, fields):
+        """Reports a digest checkpoint after every digest_interval executed
+        commands."""
+        if (self.digest_interval > 0 and
+                self.site_store.exec_count % self.digest_interval == 0):
+            self.digest_queue.put((self.port, self.site_store.exec_count,
+                                   client_id, fields['rseqno'],
+                                   (self.site_store.state_digest,
+                                    self.site_store.sequence_digest)))
+
+    def learn_commands(self):
+        """State application stage of a learner; applies streamed commands
+        in order, and serves each read once the command at its slot has
+        been applied."""
+        # Heap of (slot, arrival, client ID, request) of waiting reads
+        waiting = []
+        arrivals = itertools.count()
+        while True:
+            client_id, fields = self.apply_queue.get()
 
-            elif action == 'n':
-                site_name = fields['site_name']
-                zip_code = fields['zip_code']
+            # If in simulated fail state, do nothing
+            if not self.alive:
+                return
 
-                # Check if site already exists
-                if site_name in self.vaccine_availability:
-                    output = '{} already in database.'.format(site_name)
+            if client_id is None:
+                if 'output_msg' in fields:
+                    # Snapshot of a replica the learner was behind
+                    self.site_store = SiteStore.decode(fields['output_msg'])
                 else:
-                    self.vaccine_availability[site_name] = ['0', zip_code]
-                    output = '{} (ZIP code {}) added with vaccine availability 0.'.format(
-                        site_name, zip_code)
-
-            msg_dict['output_msg'] = output
+                    # Reads of other clients are served by the replicas;
+                    # the learner only folds them into its digests
+                    self.site_store.apply(fields, read=False)
+                    self.report_digest(fields.get('client_id'), fields)
+            elif fields['transaction'] == 'q':
+                # Release client connection after its outstanding replies
+                self.dispatch_reply((client_id, fields, None, None))
+            else:
+                heapq.heappush(waiting, (int(fields.get('slot', '0')), next(arrivals),
+                                         client_id, fields))
+
+            while waiting and waiting[0][0] <= self.site_store.exec_count:
+                _, _, read_client_id, read_fields = heapq.heappop(waiting)
+                self.lclock_lock.acquire()
+                self.lclock += 1
+                lclock = self.lclock
+                self.lclock_lock.release()
+                read_fields['slot'] = str(self.site_store.exec_count)
+                self.dispatch_reply((read_client_id, read_fields, lclock,
+                                     self.site_store.read(read_fields)))
+
+    def dispatch_reply(self, reply):
+        """Hands an applied command (in batch mode, the group of applied
+        commands of a client) to the reply worker of its client."""
+        if not self.reply_queues:
+            # No reply workers; render and send inline
+            self.handle_reply(reply)
+            return
+        # Replies to the same client are handled by the same worker, in order
+        index = hash(reply[0]) % len(self.reply_queues)
+        self.reply_queues[index].put(reply)
+
+    def send_replies(self, reply_queue):
+        """Reply worker; renders and sends outputs of applied commands."""
+        while True:
+            self.handle_reply(reply_queue.get())
 
-            # Send output of command to appropriate client
-            self.send_lock.acquire()
-            self.client_sockets[client_id].send(serialize262(msg_dict))
-            self.send_lock.release()
+    def handle_reply(self, reply):
+        """Sends the output of an applied command, or in batch mode the
+        outputs of a group of them."""
+        if self.batch_size > 0:
+            self.send_reply_group(*reply)
+        else:
+            self.send_reply(*reply)
+
+    def send_reply(self, client_id, fields, lclock, result):
+        """Renders, serializes and sends the output of a command."""
+        if fields['transaction'] == 'q':
+            self.close_client(client_id)
+            return
+        self.send_outputs(client_id, [self.render_reply(fields, lclock, result)])
+
+    def send_reply_group(self, client_id, replies):
+        """Renders and serializes the outputs of commands of a client, and
+        sends them in one write."""
+        msgs = [self.render_reply(fields, lclock, result)
+                for fields, lclock, result in replies if fields['transaction'] != 'q']
+        if msgs:
+            self.send_outputs(client_id, msgs)
+        if replies[-1][0]['transaction'] == 'q':
+            self.close_client(client_id)
+
+    def close_client(self, client_id):
+        """Quit message case - performs cleanup associated with a client."""
+        scsocket = self.client_sockets.pop(client_id, None)
+        if scsocket is not None:
+            scsocket.client_socket.close()
 
-            if test_mode:
-                with open('test_log_{}.txt'.format(self.port), 'a') as f:
-                    f.write(str(req_id) + ': ' + output + '\n')
+    def render_reply(self, fields, lclock, result):
+        """Renders and serializes the output of a command."""
+        # Construct command output; reads also carry the version they
+        # observed, and no output if the client has it cached already, and
+        # conditional updates and transactions carry their result codes
+        msg_dict = {
+            'transaction': fields['transaction'],
+            'lclock': str(lclock),
+            'rseqno': fields['rseqno'],
+        }
+        if fields['transaction'] in ('v', 'l'):
+            version, result = result
+            msg_dict['version'] = str(version)
+        elif fields['transaction'] in ('c', 'u', 't'):
+            msg_dict['status'] = ','.join(result[0])
+        if 'slot' in fields:
+            msg_dict['slot'] = fields['slot']
+        if result is not not_modified:
+            msg_dict['output_msg'] = render_output(fields, result)
+        return serialize262(msg_dict)
+
+    def send_outputs(self, client_id, msgs):
+        """Sends serialized command outputs to a client in one write."""
+        scsocket = self.client_sockets.get(client_id)
+        if scsocket is not None:
+            try:
+                scsocket.send_many(msgs)
+            except OSError:
+                # Client went away without waiting for its outputs; drop it
+                # rather than lose the reply worker shared with other clients
+                self.client_sockets.pop(client_id, None)
 
     def serve(self):
         """Server socket loop."""
         while True:
             clientsocket, address = self.s.accept()
+            if self.ip == unix_host:
+                # Peers of Unix domain sockets are unnamed
+                address = (unix_host, self.port)
             clientsocket_object = ClientSocket262(address[0], address[1], clientsocket)
             # Dispatch execution of each client socket in its own thread
-            client_thread = threading.Thread(target=self.communicate, args=(clientsocket_object,), daemon=True)
+            client_thread = threading.Thread(target=self.communicate, args=(clientsocket_object,),
+                                             name='communicate', daemon=True)
             client_thread.start()
 
     def communicate(self, scsocket):
@@ -208,68 +1085,86 @@ class ServerReplica(Process):
         # Receive initial message containing unique client ID
         initial_msg = scsocket.receive()
         initial_fields = deserialize262(initial_msg)
+        if initial_fields['transaction'] == 'p':
+            # Connection from a peer replica
+            self.communicate_peer(scsocket, initial_fields['replica_id'])
+            return
+        if initial_fields['transaction'] == 'r':
+            # Connection from a learner replica
+            self.stream_to_learner(scsocket, int(initial_fields['slot']))
+            return
         assert initial_fields['transaction'] == 'i'
         client_id = initial_fields['client_id']
 
-        # Update client connections
-        self.rq_lock.acquire()
-        self.request_queues[client_id] = Queue()
-        self.connected_clients.add(client_id)
-        self.rq_lock.release()
-        self.not_idle.set()
-
-        # Update logical clock
-        self.lclock_lock.acquire()
-        self.lclock = max(self.lclock, int(initial_fields['lclock'])) + 1
-        self.lclock += 1
-        self.lclock_lock.release()
-
-        # Reply with initial ack to update client logical clock
-        self.send_lock.acquire()
-        if self.alive:
-            msg_dict = {'transaction': 'i', 'lclock': str(self.lclock)}
-            scsocket.send(serialize262(msg_dict))
-        self.send_lock.release()
-
         # Add socket to dict of sockets
         self.client_sockets[client_id] = scsocket
 
-        # Main communication loop
-        while True:
-            # Exit if simulated failure
-            if not self.alive:
-                break
+        if self.learner:
+            self.serve_reads(scsocket, client_id, initial_fields)
+            return
 
-            # Receive message
-            incoming_msg = scsocket.receive()
-            fields = deserialize262(incoming_msg)
-            action = fields['transaction']
-
-            # Update logical clock
-            self.lclock_lock.acquire()
-            self.lclock = max(self.lclock, int(fields['rseqno'])) + 1
-            fields['lclock'] = str(self.lclock)
-            self.lclock += 1
-            self.lclock_lock.release()
-
-            # Add request to appropriate client request queue
-            self.request_queues[client_id].put(fields)
+        # Update client connections
+        self.connected_clients.add(client_id)
+        self.request_queue.put((client_id, initial_fields))
+        self.greet(scsocket, initial_fields)
 
-            # Send ack (agreement protocol)
-            self.send_lock.acquire()
-            scsocket.send(serialize262({'transaction': 'k', 'rseqno': fields['rseqno'], 'lclock': str(self.lclock)}))
-            self.send_lock.release()
+        # Main communication loop
+        try:
+            while True:
+                # Exit if simulated failure
+                if not self.alive:
+                    break
 
-            # Exit if client is quitting
-            if action == 'q':
-                break
+                # Receive message
+                incoming_msg = scsocket.receive()
+                fields = deserialize262(incoming_msg)
+                action = fields['transaction']
+                if self.leases is not None:
+                    self.leases.renew(client_id)
+
+                # Update logical clock
+                self.lclock_lock.acquire()
+                self.lclock = max(self.lclock, int(fields['rseqno'])) + 1
+                fields['lclock'] = str(self.lclock)
+                self.lclock += 1
+                self.lclock_lock.release()
+
+                # Hand request to ordering stage and send ack (agreement
+                # protocol); quits are acked first, since they release the
+                # connection. The ack of a command waits for admission, which
+                # keeps the client from sending more (Broadcast Sequencing
+                # Restriction)
+                ack = {'transaction': 'k', 'rseqno': fields['rseqno']}
+                if action == 'q':
+                    scsocket.send(serialize262(dict(ack, lclock=str(self.lclock))))
+                elif action not in ('d', 'i'):
+                    self.add_backlog(client_id)
+                self.request_queue.put((client_id, fields))
+                if action not in ('d', 'i', 'q'):
+                    self.await_admission(client_id, scsocket, fields['rseqno'])
+                if action != 'q':
+                    # Taken after admission, the logical clock of the ack is
+                    # above the bounds given to the ordering stage meanwhile
+                    scsocket.send(serialize262(dict(ack, lclock=str(self.lclock))))
+
+                # Exit if client is quitting
+                if action == 'q':
+                    break
+        except (RuntimeError, OSError):
+            # The client went away without quitting, or considered this
+            # replica failed after its ack timeout and dropped it. Either
+            # way no more of its requests arrive here, so it leaves the
+            # total order of this replica (ordering stage message 'g');
+            # otherwise the stability test, or the slots assigned to its
+            # later requests, would wait on it forever
+            self.request_queue.put((client_id, {'transaction': 'g'}))
+            self.connected_clients.discard(client_id)
+            return
 
         if not self.alive:
             # Send failure message
-            self.send_lock.acquire()
             msg_dict = {'transaction': 'f', 'lclock': str(self.lclock)}
             scsocket.send(serialize262(msg_dict))
-            self.send_lock.release()
 
             # Wait for client quit signal to clean up sockets
             fields = deserialize262(scsocket.receive())
@@ -277,112 +1172,455 @@ class ServerReplica(Process):
                 fields = deserialize262(scsocket.receive())
 
             # Dummy ack to unblock receiving thread of client
-            self.send_lock.acquire()
             msg_dict = {'transaction': 'd', 'lclock': str(self.lclock)}
             scsocket.send(serialize262(msg_dict))
-            self.send_lock.release()
 
             # Socket hygiene
             scsocket.client_socket.close()
-            del self.client_sockets[client_id]
+            self.client_sockets.pop(client_id, None)
             self.connected_clients.discard(client_id)
         else:
             assert action == 'q'
             self.connected_clients.discard(client_id)
 
+    def greet(self, scsocket, initial_fields):
+        """Updates the logical clock with the initial message of a client."""
+        self.lclock_lock.acquire()
+        self.lclock = max(self.lclock, int(initial_fields['lclock'])) + 1
+        self.lclock += 1
+        self.lclock_lock.release()
+
+        # Reply with initial ack to update client logical clock, agreeing on
+        # the compression of large frames
+        if self.alive:
+            msg_dict = {'transaction': 'i', 'lclock': str(self.lclock)}
+            codec = choose_codec(initial_fields.get('compression', ''))
+            if codec is not None:
+                msg_dict['compression'] = codec
+            scsocket.send(serialize262(msg_dict))
+            scsocket.set_codec(codec)
+
+    def serve_reads(self, scsocket, client_id, initial_fields):
+        """Client communication logic of a learner; reads are acked on
+        receipt and served by the state application stage."""
+        self.greet(scsocket, initial_fields)
+        while self.alive:
+            try:
+                fields = deserialize262(scsocket.receive())
+            except (RuntimeError, OSError):
+                break
+            action = fields['transaction']
+
+            # Update logical clock
+            self.lclock_lock.acquire()
+            self.lclock = max(self.lclock, int(fields['rseqno'])) + 1
+            self.lclock += 1
+            self.lclock_lock.release()
+
+            try:
+                scsocket.send(serialize262({'transaction': 'k', 'rseqno': fields['rseqno'],
+                                            'lclock': str(self.lclock)}))
+            except OSError:
+                break
+            if action in read_actions or action == 'q':
+                self.apply_queue.put((client_id, fields))
+            if action == 'q':
+                return
+
+        # Failed learner, or client went away
+        self.client_sockets.pop(client_id, None)
+        scsocket.client_socket.close()
+
+    def stream_to_learner(self, scsocket, position):
+        """Streams executed commands to a learner that has applied the
+        first position of them; a learner that is further behind is first
+        sent a snapshot of the database."""
+        stream = queue.Queue()
+        snapshot = None
+        with self.learner_lock:
+            if self.alive and self.site_store.exec_count > position:
+                snapshot = self.site_store.encode()
+                position = self.site_store.exec_count
+            self.learner_streams.append(stream)
+        try:
+            if snapshot is not None:
+                scsocket.send(serialize262({'transaction': 'r', 'slot': str(position),
+                                            'output_msg': snapshot}))
+            while self.alive:
+                try:
+                    fields = stream.get(timeout=self.stream_timeout / 4)
+                except queue.Empty:
+                    # Heartbeat, telling the learner this replica is alive
+                    scsocket.send(serialize262({'transaction': 'd'}))
+                    continue
+                if fields is None:
+                    break
+                # Commands the learner applied already are skipped
+                if int(fields['slot']) > position:
+                    scsocket.send(serialize262(fields))
+        except (RuntimeError, OSError):
+            # Learner went away
+            pass
+        with self.learner_lock:
+            self.learner_streams.remove(stream)
+        scsocket.client_socket.close()
+
+    def follow_replicas(self):
+        """Ordering stage of a learner; forwards the commands executed by a
+        voting replica, in order, and follows the next replica in ID order
+        when the connection breaks or the stream goes quiet."""
+        position = 0
+        replica_ids = itertools.cycle(sorted(self.peers))
+        while self.alive:
+            replica_id = next(replica_ids)
+            s = ClientSocket262(*self.peers[replica_id])
+            try:
+                s.connect()
+                s.send(serialize262({'transaction': 'r', 'replica_id': str(self.replica_id),
+                                     'slot': str(position)}))
+                s.client_socket.settimeout(self.stream_timeout)
+                while self.alive:
+                    fields = deserialize262(s.receive())
+                    if fields['transaction'] == 'd':
+                        continue
+                    position = int(fields['slot'])
+                    self.apply_queue.put((None, fields))
+            except (RuntimeError, OSError):
+                # Replica failed, is not listening yet, or its stream went
+                # quiet (socket timeout)
+                time.sleep(.05)
+            s.client_socket.close()
+
+    def add_backlog(self, client_id):
+        """Counts a received command of a client as backlog."""
+        with self.admission:
+            self.backlogs[client_id] = self.backlogs.get(client_id, 0) + 1
+            self.total_backlog += 1
+
+    def release_backlog(self, client_id):
+        """Counts a command of a client as executed (or dropped)."""
+        self.release_backlogs({client_id: 1})
+
+    def release_backlogs(self, counts):
+        """Counts commands of several clients as executed, given as a dict
+        {client ID: number of commands}."""
+        with self.admission:
+            for client_id, count in counts.items():
+                self.backlogs[client_id] -= count
+                self.total_backlog -= count
+                if not self.backlogs[client_id]:
+                    del self.backlogs[client_id]
+            self.admission.notify_all()
+
+    def admissible(self, client_id):
+        """Whether the backlog of a client admits its next message; the
+        caller holds the admission lock."""
+        client_backlog = self.backlogs.get(client_id, 0)
+        if self.client_backlog and client_backlog > self.client_backlog:
+            return False
+        if self.backlog and self.total_backlog > self.backlog:
+            # Overload: only clients within their fair share are admitted
+            return client_backlog <= max(1, self.backlog // max(1, len(self.backlogs)))
+        return True
+
+    def await_admission(self, client_id, scsocket, rseqno):
+        """Waits until the backlog of a client admits its next message,
+        telling the client to wait meanwhile (backpressure).
+
+        With the stability test, the held back client would keep requests
+        of other clients from becoming stable; since it sends nothing before
+        the ack (Broadcast Sequencing Restriction), the current logical
+        clock bounds the request ID of its next message, which the ordering
+        stage is given instead. A client that sent more already gets no
+        bound, as its next message may carry a lower request ID.
+        """
+        bounded = None
+        while True:
+            with self.admission:
+                if self.admissible(client_id) or not self.alive:
+                    return
+                if bounded is None:
+                    bounded = self.ordering == 'lamport' and not scsocket.has_pending()
+                if bounded:
+                    with self.lclock_lock:
+                        self.lclock += 1
+                        bound = self.lclock
+                    self.request_queue.put((client_id, {'transaction': 'b', 'rseqno': str(bound)}))
+                if self.admission.wait(self.backpressure_interval):
+                    continue
+            scsocket.send(serialize262({'transaction': 'w', 'rseqno': rseqno,
+                                        'lclock': str(self.lclock)}))
+            # Client is alive; it is held back by this replica
+            if self.leases is not None:
+                self.leases.renew(client_id)
+
+    def communicate_peer(self, scsocket, replica_id):
+        """Receives ordering messages and failure notice of a peer replica."""
+        while True:
+            try:
+                fields = deserialize262(scsocket.receive())
+            except (RuntimeError, OSError):
+                # Crashed peer (Failure Detection Assumption, Schneider)
+                fields = {'transaction': 'f', 'replica_id': replica_id}
+            self.request_queue.put((None, fields))
+            if fields['transaction'] == 'f':
+                break
+        scsocket.client_socket.close()
+
     def detect_simulated_failure(self):
         """Target to detect simulated server replica failure."""
         while True:
             val = self.failure_notice_queue.get()
             if val:
                 self.alive = False
+                # Wake up ordering stage to notice the failure
+                self.request_queue.put((None, {'transaction': 'd'}))
+                # End streams to learners, which then follow another replica
+                with self.learner_lock:
+                    for stream in self.learner_streams:
+                        stream.put(None)
+                if self.learner:
+                    # Clients of a failed learner read from replicas instead
+                    for scsocket in list(self.client_sockets.values()):
+                        try:
+                            scsocket.client_socket.shutdown(socket.SHUT_RDWR)
+                        except OSError:
+                            pass
                 break
 
 
 if __name__ == "__main__":
     # Check for correct usage
-    if len(sys.argv) != 2 and len(sys.argv) != 3:
-        print("Usage: servers.py <# of server replicas>")
-        print("Testing Usage: servers.py <# of server replicas> TEST")
-        sys.exit()
-
-    if len(sys.argv) == 2 and (not sys.argv[1].isdigit() or int(sys.argv[1]) <= 0):
-        print('# of server replicas must be a positive integer!')
-        sys.exit()
-
+    parser = argparse.ArgumentParser(
+        usage='servers.py <# of server replicas> [TEST] [options]\n'
+              '       servers.py --config PATH [--local ID [ID ...]] [options]')
+    parser.add_argument('num_replicas', type=int, nargs='?',
+                        help='# of server replicas')
     # Only used by tests.py
-    if len(sys.argv) == 3 and str(sys.argv[2]) != "TEST":
-        print("Did you actually mean to test?")
-        print("Usage: servers.py <# of server replicas>")
-        print("Testing Usage: servers.py <# of server replicas> TEST")
-        sys.exit()
+    parser.add_argument('test', nargs='?', choices=['TEST'],
+                        help='testing mode')
+    parser.add_argument('--port', type=int, default=8892,
+                        help='port of the first replica; replicas listen on '
+                             'consecutive ports (0 uses ports assigned by '
+                             'the OS)')
+    parser.add_argument('--learners', type=int, default=0, metavar='N',
+                        help='also start N learner replicas, which serve '
+                             'reads without taking part in ordering, with '
+                             'IDs, and ports, following those of the '
+                             'replicas (default: %(default)s)')
+    parser.add_argument('--unix', metavar='DIR',
+                        help='replicas listen on Unix domain sockets '
+                             'DIR/replica<ID>.sock instead of TCP ports')
+    parser.add_argument('--config', metavar='PATH',
+                        help='cluster configuration listing the ID and '
+                             'host:port (or unix:PATH) address of every '
+                             'replica, and of learners (marked learner)')
+    parser.add_argument('--local', type=int, nargs='+', metavar='ID',
+                        help='with --config, IDs of the replicas to start on '
+                             'this host (default: all)')
+    parser.add_argument('--ready-file', metavar='PATH',
+                        help='file to which replica addresses are written '
+                             'once all replicas are listening')
+    parser.add_argument('--render-workers', type=int, default=4,
+                        help='reply workers per replica rendering and '
+                             'sending outputs (0 renders inline)')
+    parser.add_argument('--batch', type=int, default=0, metavar='N',
+                        help='execute stable requests in batches of up to N '
+                             'commands, with the outputs to each client sent '
+                             'in one write (default: 0, disabled)')
+    parser.add_argument('--ordering', choices=['lamport', 'sequencer'], default='lamport',
+                        help='total order by the stability test of client '
+                             'logical clocks, or by slots assigned by a '
+                             'sequencer replica (default: %(default)s)')
+    parser.add_argument('--lease', type=float, default=0, metavar='SECONDS',
+                        help='exclude clients that send nothing for SECONDS '
+                             'from the stability test until they rejoin '
+                             '(default: 0, disabled)')
+    parser.add_argument('--client-backlog', type=int, default=0, metavar='N',
+                        help='commands of a client received but not yet '
+                             'executed before its acks are delayed (default: '
+                             '0, no limit)')
+    parser.add_argument('--backlog', type=int, default=0, metavar='N',
+                        help='commands received but not yet executed, in '
+                             'total, before acks of clients over their fair '
+                             'share are delayed (default: 0, no limit)')
+    parser.add_argument('--digest-interval', type=int, metavar='N',
+                        help='compare replica digests every N executed '
+                             'commands (default: 1 in testing mode, '
+                             'otherwise 0, disabled)')
+    add_profiling_arguments(parser)
+    args = parser.parse_args()
+
+    test_mode = args.test is not None
+    port_num0 = args.port
+
+    # Addresses of all replicas and learners of the cluster, and IDs of
+    # those started here
+    if args.config is not None:
+        cluster = read_cluster_config(args.config)
+        learner_cluster = read_cluster_config(args.config, 'learner')
+        local_ids = (args.local if args.local is not None
+                     else list(cluster) + list(learner_cluster))
+        if not cluster or any(i not in cluster and i not in learner_cluster
+                              for i in local_ids):
+            print('Local replica IDs must be listed in the cluster configuration!')
+            sys.exit()
+    else:
+        if args.num_replicas is None or args.num_replicas <= 0:
+            print('# of server replicas must be a positive integer!')
+            sys.exit()
+
+        # localhost used for demonstration
+        def local_address(i):
+            if args.unix is not None:
+                return unix_host, os.path.join(args.unix, 'replica{}.sock'.format(i))
+            return 'localhost', 0 if port_num0 == 0 else port_num0 + i
+
+        cluster = {i: local_address(i) for i in range(args.num_replicas)}
+        learner_cluster = {i: local_address(i) for i in
+                           range(args.num_replicas, args.num_replicas + args.learners)}
+        local_ids = list(cluster) + list(learner_cluster)
+
+    digest_interval = args.digest_interval
+    if digest_interval is None:
+        digest_interval = 1 if test_mode else 0
+
+    num_replicas = len(cluster)
+    sm_replicas = []
+    failure_notice_queues = {}
 
-    test_mode = len(sys.argv) == 3
-    port_num0 = 8892
+    # Compare digest checkpoints of all replicas
+    digest_checker = None
+    if digest_interval > 0:
+        digest_queue = Queue()
+        digest_checker = DigestChecker(digest_queue, len(local_ids))
+        digest_checker_thread = threading.Thread(target=digest_checker.run, daemon=True)
+        digest_checker_thread.start()
 
-    num_replicas = int(sys.argv[1])
-    sm_replicas = []
-    failure_notice_queues = []
+    def shutdown():
+        if digest_checker is not None:
+            print(digest_checker.summary())
+
+        # Replicas are no longer ready
+        if args.ready_file is not None and os.path.exists(args.ready_file):
+            os.remove(args.ready_file)
 
-    def sigterm_handler(signal, frame):
         # Terminate any subprocesses
         for smr in sm_replicas:
             if smr.is_alive():
                 smr.terminate()
-        time.sleep(3)
         for smr in sm_replicas:
+            smr.join()
             smr.close()
 
+        # Remove socket files of replicas listening on Unix domain sockets
+        for smr in sm_replicas:
+            if smr.ip == unix_host and os.path.exists(smr.port):
+                os.remove(smr.port)
+
         sys.exit()
 
+    def sigterm_handler(signal, frame):
+        shutdown()
+
     if test_mode:
         signal.signal(signal.SIGTERM, sigterm_handler)
-        for i in range(num_replicas):
-            f = open('test_log_{}.txt'.format(port_num0 + i), 'w')
-            f.close()
+
+    # Remove stale readiness file of a previous deployment
+    if args.ready_file is not None and os.path.exists(args.ready_file):
+        os.remove(args.ready_file)
 
     try:
         # Initialize server replicas and associated failure simulation channel
-        for i in range(num_replicas):
-            # localhost used for demonstration
-            smr = ServerReplica('localhost', port_num0 + i)
+        for i in local_ids:
+            ip, port = cluster[i] if i in cluster else learner_cluster[i]
+            smr = ServerReplica(ip, port,
+                                render_workers=args.render_workers,
+                                profile_dir=args.profile,
+                                profile_window=args.profile_window,
+                                digest_interval=digest_interval,
+                                ordering=args.ordering,
+                                lease=args.lease,
+                                client_backlog=args.client_backlog,
+                                backlog=args.backlog,
+                                learner=i in learner_cluster,
+                                batch_size=args.batch)
             smr.daemon = True
+            if digest_interval > 0:
+                smr.digest_queue = digest_queue
             failure_notice_queue = Queue()
             smr.failure_notice_queue = failure_notice_queue
-            failure_notice_queues.append(failure_notice_queue)
+            failure_notice_queues[i] = failure_notice_queue
+            smr.replica_id = i
             sm_replicas.append(smr)
 
+        # Peer replicas, at the ports local replicas are bound to; learners
+        # follow all replicas
+        for smr in sm_replicas:
+            (learner_cluster if smr.learner else cluster)[smr.replica_id] = (smr.ip, smr.port)
+        for smr in sm_replicas:
+            smr.peers = {i: address for i, address in cluster.items()
+                         if i != smr.replica_id}
+
         # Start listening for client connections
         for smr in sm_replicas:
             smr.start()
 
-        # Print ip and port of server replicas
+        # Forward profiling signals to replicas
+        if args.profile is not None:
+            def forward_signal(signum, frame):
+                for smr in sm_replicas:
+                    if smr.is_alive():
+                        os.kill(smr.pid, signum)
+
+            signal.signal(signal.SIGUSR1, forward_signal)
+            signal.signal(signal.SIGUSR2, forward_signal)
+
+        # Publish ip and port of server replicas; they are listening already
+        voters = [smr for smr in sm_replicas if not smr.learner]
+        learners = [smr for smr in sm_replicas if smr.learner]
+        if args.ready_file is not None:
+            write_ready_file(args.ready_file,
+                             {smr.replica_id: (smr.ip, smr.port) for smr in voters},
+                             {smr.replica_id: (smr.ip, smr.port) for smr in learners})
         address = "{} state machine replicas initialized at {}.".format(
-            num_replicas, ", ".join(["{}:{}".format(smr.ip, smr.port)
-                                     for smr in sm_replicas]))
-        print(address)
+            len(voters), ", ".join(["{}:{}".format(smr.ip, smr.port)
+                                    for smr in voters]))
+        if learners:
+            address += " {} learners initialized at {}.".format(
+                len(learners), ", ".join(["{}:{}".format(smr.ip, smr.port)
+                                          for smr in learners]))
+        print(address, flush=True)
 
         # Continuously receive input about which server replica to "disable"
         failed = set()
         while True:
             # Prompt for replica index
             index = input('Enter the index of a SM to disable: ').strip()
-            while (not index.isdigit() or int(index) >= num_replicas or
-                   int(index) < 0 or index in failed):
+            while (not index.isdigit() or int(index) not in failure_notice_queues or
+                   int(index) in failed):
                 if not index.isdigit():
                     prompt = 'Index is a nonegative integer: '
-                elif int(index) >= num_replicas or int(index) < 0:
-                    prompt = 'Please enter a valid index ([1, N - 1]): '
+                elif int(index) not in failure_notice_queues:
+                    prompt = 'Please enter the index of a replica started here ({}): '.format(
+                        ', '.join(str(i) for i in local_ids))
                 else:
                     prompt = f'Replica {index} has already failed. Enter a different SM index: '
                 index = input(prompt).strip()
 
             # Simulate replica failure
             failure_notice_queues[int(index)].put(True)
-            failed.add(index)
-
-            # System is only num_replicas - 1 fault-tolerant
-            if len(failed) >= num_replicas - 1:
+            failed.add(int(index))
+
+            # System is only num_replicas - 1 fault-tolerant; learners do not
+            # count, but once no more replicas may fail, none can be chosen
+            local_voter_ids = set(local_ids) & set(cluster)
+            if local_voter_ids:
+                done = len(failed & local_voter_ids) >= min(num_replicas - 1,
+                                                            len(local_voter_ids))
+            else:
+                done = failed == set(local_ids)
+            if done:
                 print('Maximum fault tolerance achieved.')
                 break
 
@@ -392,13 +1630,4 @@ if __name__ == "__main__":
 
     except KeyboardInterrupt:
         print("\nCtrl C pressed, cleaning up and exiting...")
-
-        # Terminate any subprocesses
-        for smr in sm_replicas:
-            if smr.is_alive():
-                smr.terminate()
-        time.sleep(3)
-        for smr in sm_replicas:
-            smr.close()
-
-        sys.exit()
+        shutdown()
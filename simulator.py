@@ -0,0 +1,463 @@
+import time
+import heapq
+import random
+import argparse
+from collections import deque
+from servers import StabilityOrderer, SequencerOrderer
+from site_store import SiteStore
+from benchmarks import percentile
+
+# Deterministic simulation of server replicas and clients: the ordering and
+# execution logic of servers.py and the broadcast and ack logic of client.py
+# run over an in-memory network on a virtual clock. A run is a function of
+# its arguments and seed alone, so latency and throughput numbers are
+# reproducible, and thousands of replicas and clients fit in one process.
+
+
+class Simulation:
+    """Virtual clock, event queue and network of FIFO links.
+
+    Every link delivers messages in the order they were sent (FIFO Channels,
+    Schneider) after latency plus a uniformly random jitter of at most
+    jitter seconds. Messages to or from a crashed node are lost.
+    """
+    def __init__(self, seed=0, latency=.0005, jitter=.0001):
+        self.rng = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.now = 0.0
+        self.events = []
+        self.seq = 0
+        self.event_count = 0
+        # Delivery time of the last message sent over each link
+        self.last_delivery = {}
+
+    def schedule(self, delay, callback, *args):
+        """Runs callback(*args) after delay seconds of virtual time."""
+        self.seq += 1
+        heapq.heappush(self.events, (self.now + delay, self.seq, callback, args))
+
+    def run(self, until):
+        """Processes events in time order until the virtual clock reaches until."""
+        events = self.events
+        while events and events[0][0] <= until:
+            self.now, _, callback, args = heapq.heappop(events)
+            self.event_count += 1
+            callback(*args)
+        self.now = until
+
+    def send(self, source, destination, msg):
+        """Sends a message over the link from source to destination."""
+        if not source.alive:
+            return
+        link = (source.node_id, destination.node_id)
+        delivery = self.now + self.latency + self.rng.random() * self.jitter
+        delivery = max(delivery, self.last_delivery.get(link, 0.0))
+        self.last_delivery[link] = delivery
+        self.seq += 1
+        heapq.heappush(self.events, (delivery, self.seq, destination.receive, (source, msg)))
+
+
+class SimReplica:
+    """Server replica processing one message at a time.
+
+    Each message occupies the replica for message_cost seconds, plus
+    command_cost seconds per command it makes stable; messages sent while
+    handling it leave when it is done. Stable commands are applied to a
+    SiteStore as by the state application stage, and a checkpoint of the
+    sequence digest is kept every digest_interval commands.
+    """
+    def __init__(self, sim, replica_id, replica_ids, ordering='lamport',
+                 message_cost=.00002, command_cost=.00005, digest_interval=100):
+        self.sim = sim
+        self.node_id = ('replica', replica_id)
+        self.replica_id = replica_id
+        self.ordering = ordering
+        self.message_cost = message_cost
+        self.command_cost = command_cost
+        self.digest_interval = digest_interval
+        self.alive = True
+        self.lclock = 0
+        if ordering == 'sequencer':
+            self.orderer = SequencerOrderer(replica_id, replica_ids)
+        else:
+            self.orderer = StabilityOrderer()
+        self.site_store = SiteStore()
+        self.peers = []
+        self.clients = {}
+        self.checkpoints = {}
+        self.inbox = deque()
+        self.busy = False
+
+    def receive(self, source, msg):
+        """Queues a delivered message until the replica is free to handle it."""
+        if not self.alive:
+            return
+        self.inbox.append((source, msg))
+        if not self.busy:
+            self.busy = True
+            self.handle_next()
+
+    def handle_next(self):
+        """Handles the next queued message and holds its output until done."""
+        if not self.alive or not self.inbox:
+            self.busy = False
+            return
+        source, fields = self.inbox.popleft()
+        outbox = []
+        stable = self.handle(source, fields, outbox)
+        for client_id, stable_fields in stable:
+            self.execute(client_id, stable_fields, outbox)
+        self.sim.schedule(self.message_cost + self.command_cost * len(stable),
+                          self.finish, outbox)
+
+    def finish(self, outbox):
+        """Sends the messages of a handled message and moves on."""
+        for destination, msg in outbox:
+            self.sim.send(self, destination, msg)
+        self.handle_next()
+
+    def handle(self, source, fields, outbox):
+        """Handles a message as the communication and ordering stages do;
+        returns stable requests."""
+        action = fields['transaction']
+        if source.node_id[0] == 'replica':
+            return self.handle_peer(fields, outbox)
+        client_id = source.client_id
+
+        if action == 'i' and 'rseqno' not in fields:
+            # Initial message of a newly connected client
+            self.clients[client_id] = source
+            self.lclock = max(self.lclock, int(fields['lclock'])) + 1
+            self.lclock += 1
+            outbox.append((source, {'transaction': 'i', 'lclock': str(self.lclock)}))
+            if self.ordering == 'sequencer':
+                return []
+            return self.orderer.offer(client_id, fields)
+
+        # Update logical clock and ack (agreement protocol)
+        self.lclock = max(self.lclock, int(fields['rseqno'])) + 1
+        fields['lclock'] = str(self.lclock)
+        self.lclock += 1
+        outbox.append((source, {'transaction': 'k', 'rseqno': fields['rseqno'],
+                                'lclock': str(self.lclock)}))
+
+        if self.ordering != 'sequencer':
+            return self.orderer.offer(client_id, fields)
+        if action in ('i', 'd'):
+            return []
+        return self.sequence(self.orderer.offer(client_id, fields), outbox)
+
+    def handle_peer(self, fields, outbox):
+        """Handles an assignment or failure notice of a peer (sequencer
+        ordering); returns stable requests."""
+        orderer = self.orderer
+        if fields['transaction'] == 'o':
+            stable = orderer.learn(fields['slot'], fields['client_id'], fields['rseqno'])
+        else:
+            stable = []
+            if orderer.fail(fields['replica_id']):
+                # Took over as sequencer; make known assignments agree
+                for assignment in orderer.history:
+                    self.send_assignment(assignment, outbox)
+        return self.sequence(stable, outbox)
+
+    def sequence(self, stable, outbox):
+        """Broadcasts new assignments if sequencer; returns stable requests."""
+        if self.orderer.is_sequencer():
+            for assignment in self.orderer.assign():
+                self.send_assignment(assignment, outbox)
+            stable += self.orderer.drain()
+        return stable
+
+    def send_assignment(self, assignment, outbox):
+        slot, client_id, rseqno = assignment
+        for peer in self.peers:
+            outbox.append((peer, {'transaction': 'o', 'slot': slot,
+                                  'client_id': client_id, 'rseqno': rseqno}))
+
+    def execute(self, client_id, fields, outbox):
+        """Applies a stable command and queues its output to the client."""
+        if fields['transaction'] == 'q':
+            return
+        self.lclock += 1
+        self.site_store.apply(fields)
+        outbox.append((self.clients[client_id], {'transaction': fields['transaction'],
+                                                 'rseqno': fields['rseqno'],
+                                                 'lclock': str(self.lclock)}))
+        exec_count = self.site_store.exec_count
+        if exec_count % self.digest_interval == 0:
+            self.checkpoints[exec_count] = self.site_store.sequence_digest
+
+    def crash(self, kill=True):
+        """Stops the replica; if killed, its connections break, which
+        clients and (with sequencer ordering) peers notice."""
+        self.alive = False
+        self.inbox.clear()
+        if not kill:
+            return
+        for client in self.clients.values():
+            self.sim.schedule(self.sim.latency, client.connection_lost, self)
+        if self.ordering == 'sequencer':
+            notice = {'transaction': 'f', 'replica_id': self.replica_id}
+            for peer in self.peers:
+                self.sim.schedule(self.sim.latency, peer.receive, self, dict(notice))
+
+
+class SimClient:
+    """Client broadcasting requests and dummy requests to all replicas.
+
+    Broadcasts are sequential (Broadcast Sequencing Restriction): each waits
+    for acks from all replicas considered live, against a common deadline of
+    ack_timeout seconds, and replicas missing it are considered failed. As
+    in client.py, dummy requests go out every heartbeat_interval seconds,
+    and a request is complete at the first output received for it. Requests
+    are issued think_time seconds apart on average, with a fraction
+    write_ratio of them edits and the rest views of random sites.
+    """
+    def __init__(self, sim, client_id, replicas, sites, ack_timeout=2.0,
+                 heartbeat_interval=.1, think_time=.1, write_ratio=.1):
+        self.sim = sim
+        self.node_id = ('client', client_id)
+        self.client_id = client_id
+        self.replicas = replicas
+        self.sites = sites
+        self.ack_timeout = ack_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.think_time = think_time
+        self.write_ratio = write_ratio
+        self.alive = True
+        self.lclock = 0
+        self.statuses = [True] * len(replicas)
+        # Broadcasts waiting for the current one to be acked by all replicas
+        self.broadcasts = deque()
+        self.awaiting = None        # Replicas yet to ack the current broadcast
+        self.broadcast_id = 0
+        self.joining = len(replicas)
+        self.request = None         # Outstanding request
+        self.latencies = []
+        self.completed_at = []
+
+    def start(self):
+        """Connects to all replicas; starts issuing once all have answered."""
+        for replica in self.replicas:
+            self.sim.send(self, replica, {'transaction': 'i', 'client_id': self.client_id,
+                                          'lclock': str(self.lclock)})
+
+    def receive(self, source, fields):
+        if not self.alive:
+            return
+        self.lclock = max(self.lclock, int(fields['lclock'])) + 1
+        action = fields['transaction']
+        if action == 'k':
+            if self.awaiting is not None:
+                self.awaiting.discard(source.replica_id)
+                if not self.awaiting:
+                    self.acked()
+        elif action == 'i':
+            self.joining -= 1
+            if self.joining == 0:
+                self.dummy_request()
+                self.sim.schedule(self.sim.rng.random() * self.think_time, self.issue)
+        elif self.request is not None and fields['rseqno'] == self.request[0].get('rseqno'):
+            # First output of the outstanding request, which may arrive
+            # before the acks of some replicas
+            self.request[2] = True
+            self.complete()
+
+    def broadcast(self, fields, on_acked=None):
+        """Sends a request to all live replicas once earlier ones are acked."""
+        self.broadcasts.append((fields, on_acked))
+        if self.awaiting is None:
+            self.next_broadcast()
+
+    def next_broadcast(self):
+        fields, self.on_acked = self.broadcasts.popleft()
+        # Use logical clock value as request ID (order protocol)
+        self.lclock += 1
+        fields['rseqno'] = str(self.lclock)
+        self.awaiting = set()
+        for replica in self.replicas:
+            if self.statuses[replica.replica_id]:
+                self.awaiting.add(replica.replica_id)
+                self.sim.send(self, replica, dict(fields))
+        self.broadcast_id += 1
+        self.sim.schedule(self.ack_timeout, self.ack_deadline, self.broadcast_id)
+        if not self.awaiting:
+            self.acked()
+
+    def ack_deadline(self, broadcast_id):
+        """Marks replicas that have not acked in time failed (Failure
+        Detection Assumption, Schneider)."""
+        if broadcast_id != self.broadcast_id or self.awaiting is None or not self.alive:
+            return
+        for replica_id in self.awaiting:
+            self.statuses[replica_id] = False
+        self.acked()
+
+    def acked(self):
+        """Completes the current broadcast and starts the next one."""
+        self.awaiting = None
+        self.broadcast_id += 1
+        if self.on_acked is not None:
+            self.on_acked()
+        if self.broadcasts and self.awaiting is None:
+            self.next_broadcast()
+
+    def connection_lost(self, replica):
+        if not self.alive:
+            return
+        self.statuses[replica.replica_id] = False
+        if self.awaiting is not None and replica.replica_id in self.awaiting:
+            self.awaiting.discard(replica.replica_id)
+            if not self.awaiting:
+                self.acked()
+
+    def dummy_request(self):
+        """Dummy requests advance the stability test and serve as heartbeats."""
+        if not self.alive:
+            return
+        self.broadcast({'transaction': 'd', 'client_id': self.client_id},
+                       lambda: self.sim.schedule(self.heartbeat_interval, self.dummy_request))
+
+    def issue(self):
+        """Issues the next request: an edit or a view of a random site."""
+        if not self.alive:
+            return
+        rng = self.sim.rng
+        site_name = self.sites[rng.randrange(len(self.sites))]
+        if rng.random() < self.write_ratio:
+            fields = {'transaction': 'e', 'client_id': self.client_id, 'site_name': site_name,
+                      'vaccine_no': str(rng.randrange(1000))}
+        else:
+            fields = {'transaction': 'v', 'client_id': self.client_id, 'site_name': site_name}
+        # Request, issue time, and whether it has an output and all its acks
+        self.request = [fields, self.sim.now, False, False]
+        self.broadcast(fields, self.sent)
+
+    def sent(self):
+        self.request[3] = True
+        self.complete()
+
+    def complete(self):
+        """Records the outstanding request once it has an output and all
+        its acks, and schedules the next one."""
+        fields, issued_at, output, acked = self.request
+        if output and acked:
+            self.latencies.append(self.sim.now - issued_at)
+            self.completed_at.append(self.sim.now)
+            self.request = None
+            self.sim.schedule(self.sim.rng.expovariate(1 / self.think_time), self.issue)
+
+    def crash(self):
+        self.alive = False
+
+
+def parse_crash(value):
+    """Parses a crash injection given as TIME:REPLICA or TIME:cCLIENT."""
+    at, _, target = value.partition(':')
+    if target.startswith('c'):
+        return float(at), 'client', int(target[1:])
+    return float(at), 'replica', int(target)
+
+
+def simulate(num_replicas=3, num_clients=10, duration=10.0, ordering='lamport', seed=0,
+             latency=.0005, jitter=.0001, message_cost=.00002, command_cost=.00005,
+             ack_timeout=2.0, heartbeat_interval=.1, think_time=.1, write_ratio=.1,
+             num_sites=100, crashes=(), fault='kill', warmup=1.0):
+    """Runs a simulation and returns its replicas and clients."""
+    sim = Simulation(seed, latency, jitter)
+    replica_ids = list(range(num_replicas))
+    replicas = [SimReplica(sim, i, replica_ids, ordering, message_cost, command_cost)
+                for i in replica_ids]
+    sites = ['Site {}'.format(i) for i in range(num_sites)]
+    for replica in replicas:
+        replica.peers = [peer for peer in replicas if peer is not replica]
+        for site_name in sites:
+            replica.site_store.set_site(site_name, ('100', '02138'))
+    clients = [SimClient(sim, 'c{:05d}'.format(i), replicas, sites, ack_timeout,
+                         heartbeat_interval, think_time, write_ratio)
+               for i in range(num_clients)]
+    # Clients connect at random times during the first heartbeat interval
+    for client in clients:
+        sim.schedule(sim.rng.random() * heartbeat_interval, client.start)
+    for at, kind, index in crashes:
+        if kind == 'client':
+            sim.schedule(at, clients[index].crash)
+        else:
+            sim.schedule(at, replicas[index].crash, fault == 'kill')
+    sim.run(warmup + duration)
+    return sim, replicas, clients
+
+
+def check_agreement(replicas):
+    """Returns the number of digest checkpoints shared by at least two
+    replicas, or raises AssertionError if any of them differ."""
+    checked = 0
+    exec_counts = set()
+    for replica in replicas:
+        exec_counts.update(replica.checkpoints)
+    for exec_count in sorted(exec_counts):
+        digests = [r.checkpoints[exec_count] for r in replicas if exec_count in r.checkpoints]
+        assert len(set(digests)) == 1, 'replicas diverged by command {}'.format(exec_count)
+        checked += len(digests) > 1
+    return checked
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage='simulator.py [options]')
+    parser.add_argument('--replicas', type=int, default=3)
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=10,
+                        help='virtual seconds measured after a warmup second')
+    parser.add_argument('--ordering', choices=['lamport', 'sequencer'], default='lamport')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=.0005, metavar='SECONDS',
+                        help='one-way latency of every link (default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=.0001, metavar='SECONDS',
+                        help='most random delay added to latency; links stay '
+                             'FIFO (default: %(default)s)')
+    parser.add_argument('--message-cost', type=float, default=.00002, metavar='SECONDS',
+                        help='replica time to handle a message (default: %(default)s)')
+    parser.add_argument('--command-cost', type=float, default=.00005, metavar='SECONDS',
+                        help='replica time to execute a command (default: %(default)s)')
+    parser.add_argument('--ack-timeout', type=float, default=2.0, metavar='SECONDS')
+    parser.add_argument('--heartbeat-interval', type=float, default=.1, metavar='SECONDS')
+    parser.add_argument('--think-time', type=float, default=.1, metavar='SECONDS',
+                        help='mean time between a response and the next request '
+                             'of a client (default: %(default)s)')
+    parser.add_argument('--write-ratio', type=float, default=.1)
+    parser.add_argument('--sites', type=int, default=100)
+    parser.add_argument('--crash', type=parse_crash, action='append', default=[],
+                        metavar='TIME:TARGET',
+                        help='crash replica TARGET (or client cTARGET) at virtual '
+                             'time TIME; may be repeated')
+    parser.add_argument('--fault', choices=['kill', 'stop'], default='kill',
+                        help='crashed replicas break their connections (kill) or '
+                             'hang (stop)')
+    args = parser.parse_args()
+
+    warmup = 1.0
+    started = time.perf_counter()
+    sim, replicas, clients = simulate(
+        args.replicas, args.clients, args.duration, args.ordering, args.seed,
+        args.latency, args.jitter, args.message_cost, args.command_cost,
+        args.ack_timeout, args.heartbeat_interval, args.think_time, args.write_ratio,
+        args.sites, args.crash, args.fault, warmup)
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for client in clients
+                 for latency, at in zip(client.latencies, client.completed_at) if at > warmup]
+    label = '{}, {} replicas, {} clients'.format(args.ordering, args.replicas, args.clients)
+    if latencies:
+        print('{}: {} requests in {:.1f}s ({:.1f} req/s), p50 {:.2f} ms, p99 {:.2f} ms, '
+              'max {:.2f} ms'.format(
+                  label, len(latencies), args.duration, len(latencies) / args.duration,
+                  percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+                  max(latencies) * 1000))
+    else:
+        print('{}: no requests completed'.format(label))
+    exec_counts = [r.site_store.exec_count for r in replicas]
+    print('Executed commands per replica: {} to {}'.format(min(exec_counts), max(exec_counts)))
+    print('Replica digests agree at {} checkpoints'.format(check_agreement(replicas)))
+    print('Simulated {} events in {:.1f}s'.format(sim.event_count, elapsed))
@@ -0,0 +1,604 @@
+import hashlib
+from array import array
+from bisect import bisect_right
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Request fields identifying an executed command; lclock differs per replica
+command_fields = ('transaction', 'client_id', 'rseqno', 'site_name',
+                  'vaccine_no', 'zip_code', 'expected', 'delta', 'operations')
+
+# Commands that only read the database
+read_actions = ('l', 'v', 's', 'a')
+
+# Separators of operations of a multi-site transaction, and of their fields
+operation_separator = '\x1e'
+operation_field_separator = '\x1f'
+
+
+# Result of a conditional read whose cached version is current
+not_modified = object()
+
+# Lower bounds of the histogram bins of aggregate queries, and bin labels
+histogram_bins = (0, 1, 10, 100, 1000)
+histogram_labels = ['0', '1-9', '10-99', '100-999', '1000+']
+
+unknown_doses = -1      # Doses column value of sites without a known count
+max_doses = 2 ** 40     # Counts from here on are not stored (unknown)
+
+max_search_limit = 1000     # Most site names returned by a search
+
+
+def entry_hash(site_name, site):
+    """64-bit hash of a database entry, stable across processes and hosts."""
+    entry = '\x1f'.join((site_name,) + site).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(entry, digest_size=8).digest(), 'big')
+
+
+class SiteStore:
+    """Deterministic database of vaccine site information.
+
+    Commands are applied strictly sequentially, in the total order given by
+    the order protocol. Site details are stored as immutable (availability,
+    ZIP code) tuples, so a shallow copy of the database is a consistent
+    snapshot that can be rendered outside of the state application stage.
+
+    The store also maintains two digests, updated in O(1) per command: a
+    digest of the database, the sum of the hashes of its entries, and a
+    hash chain over the sequence of executed commands. Replicas that
+    executed the same commands in the same order have equal digests.
+
+    Every site, and the database as a whole, has a version: the position in
+    the total order (exec_count) of the last command that modified it, or 0.
+    Reads ('v' and 'l') return the version they observed along with their
+    result; a read carrying a version field equal to the current version
+    returns not_modified instead of the result.
+
+    Updates ('e' and 'n'), conditional updates ('c' and 'u') and multi-site
+    transactions ('t') are applied at their position in the total order;
+    'c', 'u' and 't' are applied all or none and return a result code per
+    operation ('ok', 'missing', 'conflict', 'insufficient' or 'invalid';
+    'aborted' for operations that would have succeeded in a transaction
+    that did not) along with the resulting (or, if aborted, unchanged)
+    (site name, site) pairs.
+
+    Availability is also kept in typed columns (see AvailabilityColumns),
+    which aggregate queries ('a') copy and aggregate outside of the state
+    application stage. Site names are indexed for searches ('s'), which
+    also run outside of it, over the names added before them.
+
+    Reads can also be served by read without being executed, which leaves
+    the digests and versions unchanged (learner replicas). A store is
+    transferred to a learner by encode and decode.
+    """
+    def __init__(self, populate=True):
+        self.vaccine_availability = {}
+        self.columns = AvailabilityColumns()
+        self.name_index = SiteNameIndex()
+        self.site_versions = {}
+        self.version = 0
+        self.state_digest = 0
+        self.sequence_digest = b''
+        self.exec_count = 0
+        if populate:
+            self.set_site('Harvard University', ('0', '02138'))
+
+    def apply(self, fields, read=True):
+        """Applies a command to the database and returns its result.
+
+        Reads are only folded into the digests, without building their
+        result, unless read is true.
+        """
+        action = fields['transaction']
+
+        if action == 'h':
+            # Digests of all commands executed so far
+            return (self.exec_count, self.state_digest,
+                    self.sequence_digest.hex())
+
+        # Fold command into digest of executed command sequence
+        command = '\x1f'.join(fields.get(f, '') for f in command_fields)
+        self.sequence_digest = hashlib.blake2b(
+            self.sequence_digest + command.encode('utf-8'), digest_size=16).digest()
+        self.exec_count += 1
+
+        if action in read_actions:
+            return self.read(fields) if read else None
+
+        if action == 't':
+            return self.transact(decode_operations(fields['operations']))
+
+        site_name = fields['site_name']
+        site = self.vaccine_availability.get(site_name)
+
+        if action == 'e':
+            # Check if site exists
+            if site is None:
+                return None
+            site = (fields['vaccine_no'], site[1])
+            self.set_site(site_name, site)
+            return site
+
+        elif action == 'n':
+            # Check if site already exists
+            if site is not None:
+                return None
+            site = ('0', fields['zip_code'])
+            self.set_site(site_name, site)
+            return site
+
+        elif action == 'c':
+            return self.transact([('c', site_name, fields['expected'], fields['vaccine_no'])])
+
+        elif action == 'u':
+            return self.transact([('u', site_name, fields['delta'])])
+
+    def read(self, fields):
+        """Returns the result of a read ('l', 'v', 's' or 'a') at the
+        current state of the database."""
+        action = fields['transaction']
+
+        if action == 'l':
+            # Snapshot of database for rendering, unless cached by client
+            if fields.get('version') == str(self.version):
+                return self.version, not_modified
+            return self.version, dict(self.vaccine_availability)
+
+        if action == 'a':
+            # Snapshot of availability columns for aggregation
+            return self.columns.snapshot()
+
+        if action == 's':
+            # Index and number of names to search, which only grows
+            return self.name_index, len(self.name_index.names)
+
+        # View of a single site
+        site_name = fields['site_name']
+        version = self.site_versions.get(site_name, 0)
+        if fields.get('version') == str(version):
+            return version, not_modified
+        return version, self.vaccine_availability.get(site_name)
+
+    def encode(self):
+        """Encodes the database, with its versions and digests, as a string."""
+        records = [operation_field_separator.join((
+            str(self.exec_count), str(self.version), str(self.state_digest),
+            self.sequence_digest.hex()))]
+        # Sites in order of addition, which orders search results
+        for site_name, site in self.vaccine_availability.items():
+            records.append(operation_field_separator.join(
+                (site_name,) + site + (str(self.site_versions[site_name]),)))
+        return operation_separator.join(records)
+
+    @classmethod
+    def decode(cls, value):
+        """Returns the store encoded by encode."""
+        store = cls(populate=False)
+        header, *records = value.split(operation_separator)
+        exec_count, version, state_digest, sequence_digest = header.split(
+            operation_field_separator)
+        for record in records:
+            site_name, vaccine_no, zip_code, site_version = record.split(
+                operation_field_separator)
+            store.exec_count = int(site_version)
+            store.set_site(site_name, (vaccine_no, zip_code))
+        store.exec_count = int(exec_count)
+        store.version = int(version)
+        assert store.state_digest == int(state_digest)
+        store.sequence_digest = bytes.fromhex(sequence_digest)
+        return store
+
+    def transact(self, operations):
+        """Applies (kind, site name, argument...) operations all or none;
+        returns their result codes and resulting (site name, site) pairs."""
+        # Details of updated sites; later operations see earlier updates
+        updates = {}
+        codes = []
+        results = []
+        for kind, site_name, *arguments in operations:
+            site = updates.get(site_name, self.vaccine_availability.get(site_name))
+            code, site = update_site(site, kind, arguments)
+            if code == 'ok':
+                updates[site_name] = site
+            codes.append(code)
+            results.append((site_name, site))
+
+        if all(code == 'ok' for code in codes):
+            for site_name, site in updates.items():
+                self.set_site(site_name, site)
+        else:
+            # Nothing was updated; report the unchanged details
+            codes = ['aborted' if code == 'ok' else code for code in codes]
+            results = [(site_name, self.vaccine_availability.get(site_name))
+                       for site_name, _ in results]
+        return codes, results
+
+    def set_site(self, site_name, site):
+        """Stores the details of a site and updates the state digest."""
+        old_site = self.vaccine_availability.get(site_name)
+        if old_site is not None:
+            self.state_digest -= entry_hash(site_name, old_site)
+        else:
+            self.name_index.add(site_name)
+        self.state_digest += entry_hash(site_name, site)
+        self.state_digest %= 2 ** 64
+        self.vaccine_availability[site_name] = site
+        self.columns.set(site_name, site)
+        self.site_versions[site_name] = self.version = self.exec_count
+
+
+def update_site(site, kind, arguments):
+    """Result code and resulting details of an operation on a site:
+    'e' (set availability), 'c' (set availability if it is the expected
+    one) or 'u' (add a possibly negative number of doses to a count)."""
+    if site is None:
+        return 'missing', None
+    if kind == 'e' and len(arguments) == 1:
+        return 'ok', (arguments[0], site[1])
+    if kind == 'c' and len(arguments) == 2:
+        if site[0] != arguments[0]:
+            return 'conflict', site
+        return 'ok', (arguments[1], site[1])
+    if kind == 'u' and len(arguments) == 1:
+        doses = parse_doses(site[0])
+        try:
+            delta = int(arguments[0])
+        except ValueError:
+            return 'invalid', site
+        if doses == unknown_doses or doses + delta >= max_doses:
+            return 'invalid', site
+        if doses + delta < 0:
+            return 'insufficient', site
+        return 'ok', (str(doses + delta), site[1])
+    return 'invalid', site
+
+
+def encode_operations(operations):
+    """Wire format of the (kind, site name, argument...) operations of a
+    multi-site transaction."""
+    return operation_separator.join(operation_field_separator.join(operation)
+                                    for operation in operations)
+
+
+def decode_operations(value):
+    """Operations of a multi-site transaction from their wire format."""
+    operations = []
+    for operation in value.split(operation_separator):
+        operation = operation.split(operation_field_separator)
+        if len(operation) < 2:
+            operation += [''] * (2 - len(operation))
+        operations.append(operation)
+    return operations
+
+
+def parse_doses(availability):
+    """Doses column value of an availability string."""
+    if availability == 'False':
+        return 0
+    try:
+        doses = int(availability)
+    except ValueError:
+        # 'True', or not a count at all
+        return unknown_doses
+    return doses if 0 <= doses < max_doses else unknown_doses
+
+
+class AvailabilityColumns:
+    """Availability of all sites in typed columns, one row per site.
+
+    The doses column holds the number of available vaccines of each site,
+    0 for 'False' and unknown_doses for 'True'. ZIP codes are dictionary
+    encoded: the ZIP column holds the index of each site's ZIP code in the
+    list of distinct ZIP codes. Rows are appended as sites are added and
+    never removed.
+    """
+    def __init__(self):
+        self.rows = {}
+        self.doses = array('q')
+        self.zip_ids = array('i')
+        self.zip_codes = []
+        self.zip_index = {}
+
+    def set(self, site_name, site):
+        """Stores the availability and ZIP code of a site."""
+        availability, zip_code = site
+        zip_id = self.zip_index.get(zip_code)
+        if zip_id is None:
+            zip_id = self.zip_index[zip_code] = len(self.zip_codes)
+            self.zip_codes.append(zip_code)
+
+        row = self.rows.get(site_name)
+        if row is None:
+            self.rows[site_name] = len(self.doses)
+            self.doses.append(parse_doses(availability))
+            self.zip_ids.append(zip_id)
+        else:
+            self.doses[row] = parse_doses(availability)
+            self.zip_ids[row] = zip_id
+
+    def snapshot(self):
+        """Copies of the columns and of the ZIP code list."""
+        return self.doses[:], self.zip_ids[:], self.zip_codes[:]
+
+
+def trigrams(text):
+    """Substrings of three characters of a text, in order."""
+    return [text[i:i + 3] for i in range(len(text) - 2)]
+
+
+class SiteNameIndex:
+    """Index of site names for case-insensitive prefix, substring and
+    token (whole word) search.
+
+    Names are numbered in order of addition. Each trigram of a casefolded
+    name, padded at the start so that prefixes of one or two characters
+    are trigrams too, and each of its words map to the numbers of the
+    names containing them, in increasing order (a single number is stored
+    as such, since most words occur only once). A search verifies the
+    names of the rarest trigram or word of its query (or every name, for
+    substrings too short to have trigrams) until it has enough matches.
+
+    Names are never removed, so a search can run concurrently with
+    additions by only considering the names added before it.
+    """
+    padding = '\x02\x02'
+
+    def __init__(self):
+        self.names = []
+        self.grams = {}
+        self.words = {}
+
+    def add(self, site_name):
+        """Indexes the name of a new site."""
+        number = len(self.names)
+        folded = site_name.casefold()
+        for keys, index in ((trigrams(self.padding + folded), self.grams),
+                            (folded.split(), self.words)):
+            for key in set(keys):
+                postings = index.get(key)
+                if postings is None:
+                    index[key] = number
+                elif type(postings) is int:
+                    index[key] = array('i', (postings, number))
+                else:
+                    postings.append(number)
+        self.names.append(site_name)
+
+    def search(self, query, match='substring', limit=20, count=None):
+        """Returns the first limit of the first count names (by default,
+        all) that match a query, in order of addition, and whether more do.
+
+        match is 'prefix', 'substring' or 'token' (names containing every
+        word of the query).
+        """
+        if count is None:
+            count = len(self.names)
+        folded = query.casefold()
+        if match == 'token':
+            keys, index = set(folded.split()), self.words
+        elif match == 'prefix':
+            keys, index = set(trigrams(self.padding + folded)), self.grams
+        else:
+            keys, index = set(trigrams(folded)), self.grams
+
+        if keys:
+            postings = [index.get(key, ()) for key in keys]
+            candidates = min((p if type(p) is not int else (p,) for p in postings), key=len)
+        else:
+            candidates = range(count)
+        matches = []
+        for number in candidates:
+            if number >= count:
+                break
+            if self.name_matches(self.names[number], folded, match):
+                matches.append(self.names[number])
+                if len(matches) > limit:
+                    break
+        return matches[:limit], len(matches) > limit
+
+    @staticmethod
+    def name_matches(site_name, folded_query, match):
+        """Whether a site name matches a casefolded query."""
+        folded = site_name.casefold()
+        if match == 'token':
+            return set(folded_query.split()) <= set(folded.split())
+        if match == 'prefix':
+            return folded.startswith(folded_query)
+        return folded_query in folded
+
+
+def aggregate(columns, zip_prefix='', zip_digits=0, vectorized=True):
+    """Aggregates the availability of sites whose ZIP codes start with
+    zip_prefix, grouped by the first zip_digits digits of their ZIP codes
+    (or by zip_prefix alone, if longer).
+
+    Returns (group, sites, counted, total, min, max, histogram) tuples in
+    group order, where counted sites are those with a known count, and
+    total, min, max and histogram (over histogram_bins) are over those.
+    Passes are vectorized with NumPy if available, unless vectorized is
+    false.
+    """
+    doses, zip_ids, zip_codes = columns
+
+    # Group of each distinct ZIP code, or -1 if filtered out
+    length = max(zip_digits, len(zip_prefix))
+    groups = sorted({z[:length] for z in zip_codes if z.startswith(zip_prefix)})
+    group_index = {group: i for i, group in enumerate(groups)}
+    zip_groups = [group_index[z[:length]] if z.startswith(zip_prefix) else -1
+                  for z in zip_codes]
+
+    if vectorized and numpy is not None:
+        stats = aggregate_numpy(doses, zip_ids, zip_groups, len(groups))
+    else:
+        stats = aggregate_python(doses, zip_ids, zip_groups, len(groups))
+    # Groups of ZIP codes without sites left are omitted
+    return [(group,) + group_stats for group, group_stats in zip(groups, stats)
+            if group_stats[0]]
+
+
+def aggregate_numpy(doses, zip_ids, zip_groups, num_groups):
+    """Per-group statistics of aggregate by vectorized passes over columns."""
+    num_bins = len(histogram_bins)
+    doses = numpy.frombuffer(doses, dtype=numpy.int64)
+    groups = numpy.array(zip_groups, dtype=numpy.intp)[
+        numpy.frombuffer(zip_ids, dtype=numpy.intc)]
+    selected = groups >= 0
+    groups, doses = groups[selected], doses[selected]
+    sites = numpy.bincount(groups, minlength=num_groups)
+
+    known = doses >= 0
+    groups, doses = groups[known], doses[known]
+    counted = numpy.bincount(groups, minlength=num_groups)
+    bins = numpy.searchsorted(histogram_bins, doses, side='right') - 1
+    histograms = numpy.bincount(groups * num_bins + bins, minlength=num_groups * num_bins)
+
+    # Sums and extremes over runs of equal groups; bincount only sums floats
+    totals, mins, maxs = [0] * num_groups, [None] * num_groups, [None] * num_groups
+    if len(doses):
+        order = numpy.argsort(groups)
+        groups, doses = groups[order], doses[order]
+        starts = numpy.flatnonzero(numpy.diff(groups, prepend=-1))
+        for group, total, low, high in zip(groups[starts].tolist(),
+                                           numpy.add.reduceat(doses, starts).tolist(),
+                                           numpy.minimum.reduceat(doses, starts).tolist(),
+                                           numpy.maximum.reduceat(doses, starts).tolist()):
+            totals[group], mins[group], maxs[group] = total, low, high
+
+    histograms = histograms.reshape(num_groups, num_bins).tolist()
+    return list(zip(sites.tolist(), counted.tolist(), totals, mins, maxs,
+                    map(tuple, histograms)))
+
+
+def aggregate_python(doses, zip_ids, zip_groups, num_groups):
+    """Per-group statistics of aggregate by a single pass over columns."""
+    sites, counted, totals = [0] * num_groups, [0] * num_groups, [0] * num_groups
+    mins, maxs = [None] * num_groups, [None] * num_groups
+    histograms = [[0] * len(histogram_bins) for _ in range(num_groups)]
+    for zip_id, site_doses in zip(zip_ids, doses):
+        group = zip_groups[zip_id]
+        if group < 0:
+            continue
+        sites[group] += 1
+        if site_doses < 0:
+            continue
+        counted[group] += 1
+        totals[group] += site_doses
+        if mins[group] is None or site_doses < mins[group]:
+            mins[group] = site_doses
+        if maxs[group] is None or site_doses > maxs[group]:
+            maxs[group] = site_doses
+        histograms[group][bisect_right(histogram_bins, site_doses) - 1] += 1
+    return list(zip(sites, counted, totals, mins, maxs, map(tuple, histograms)))
+
+
+def parse_count(value):
+    """Parses a nonnegative integer request field; returns None if it is
+    not one."""
+    try:
+        count = int(value)
+    except ValueError:
+        return None
+    return count if count >= 0 else None
+
+
+def render_output(fields, result):
+    """Renders the output message of an applied command."""
+    action = fields['transaction']
+
+    if action == 'l':
+        output = 'Availability,ZIP Code,Site Name\n'
+        rows = []
+        for site in sorted(result.keys()):
+            details = result[site]
+            rows.append(','.join(details) + ',' + site)
+        output += '\n'.join(rows)
+
+    elif action == 'v':
+        if result is None:
+            output = 'Site does not exist. Choose [s] to search site names.'
+        else:
+            output = 'Availability at {} (ZIP code {}): {}'.format(
+                fields['site_name'], result[1], result[0])
+
+    elif action == 'e':
+        if result is None:
+            output = 'Site does not exist. Choose [s] to search site names.'
+        else:
+            output = 'Vaccine availability at {} (ZIP code {}) updated to {}.'.format(
+                fields['site_name'], result[1], result[0])
+
+    elif action == 'n':
+        if result is None:
+            output = '{} already in database.'.format(fields['site_name'])
+        else:
+            output = '{} (ZIP code {}) added with vaccine availability 0.'.format(
+                fields['site_name'], result[1])
+
+    elif action == 'a':
+        zip_digits = parse_count(fields.get('zip_digits', '0'))
+        if zip_digits is None:
+            output = 'Number of digits must be a nonnegative integer.'
+        else:
+            output = 'ZIP Prefix,Sites,Counted,Total,Min,Max,{}\n'.format(
+                ','.join(histogram_labels))
+            rows = []
+            for group, sites, counted, total, low, high, histogram in aggregate(
+                    result, fields.get('zip_code', ''), zip_digits):
+                rows.append(','.join([group + '*', str(sites), str(counted), str(total),
+                                      '' if low is None else str(low),
+                                      '' if high is None else str(high)] +
+                                     [str(n) for n in histogram]))
+            output += '\n'.join(rows)
+
+    elif action in ('c', 'u'):
+        codes, [(site_name, site)] = result
+        if codes[0] == 'ok':
+            output = 'Vaccine availability at {} (ZIP code {}) updated to {}.'.format(
+                site_name, site[1], site[0])
+        elif codes[0] == 'missing':
+            output = 'Site does not exist. Choose [s] to search site names.'
+        elif codes[0] == 'conflict':
+            output = 'Vaccine availability at {} is {}, not {}; not updated.'.format(
+                site_name, site[0], fields['expected'])
+        elif codes[0] == 'insufficient':
+            output = 'Only {} vaccines available at {}; not updated.'.format(
+                site[0], site_name)
+        else:
+            output = 'Vaccine availability at {} ({}) cannot be changed by {}; not updated.'.format(
+                site_name, site[0], fields['delta'])
+
+    elif action == 't':
+        codes, results = result
+        if all(code == 'ok' for code in codes):
+            output = 'Transaction committed.\n'
+        else:
+            output = 'Transaction aborted; no site was updated.\n'
+        output += 'Result,Availability,Site Name\n'
+        output += '\n'.join('{},{},{}'.format(code, '' if site is None else site[0], site_name)
+                             for code, (site_name, site) in zip(codes, results))
+
+    elif action == 's':
+        index, count = result
+        limit = parse_count(fields.get('limit', '20'))
+        if not limit:
+            output = 'Search limit must be a positive integer.'
+        else:
+            limit = min(limit, max_search_limit)
+            site_names, more = index.search(fields['query'], fields.get('match', 'substring'),
+                                            limit, count)
+            if not site_names:
+                output = 'No site name matches. Choose [l] to view all sites.'
+            else:
+                output = 'Site Name\n' + '\n'.join(sorted(site_names))
+                if more:
+                    output += '\n(more than {} sites match)'.format(limit)
+
+    elif action == 'h':
+        output = 'State digest after {} commands: {:016x} (command sequence {}).'.format(
+            result[0], result[1], result[2])
+
+    return output
@@ -1,62 +1,282 @@
-import socket
+import os
 import re
+import stat
+import time
+import zlib
+import socket
+import selectors
+import threading
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Codecs for frame compression: name -> (frame delimiter, compress, decompress)
+codecs = {'zlib': (b'z', lambda data: zlib.compress(data, 1), zlib.decompress)}
+if lz4 is not None:
+    codecs['lz4'] = (b'L', lz4.frame.compress, lz4.frame.decompress)
+delimiters = {delimiter: decompress for delimiter, _, decompress in codecs.values()}
+
+compression_threshold = 1024    # Frames of at most this many bytes are sent uncompressed
+receive_size = 65536            # Bytes requested from the socket at a time by receive
+nonblocking_flag = getattr(socket, 'MSG_DONTWAIT', None)  # Per-call non-blocking sends
+unix_host = 'unix'              # Host of Unix domain socket addresses, whose port is a path
+
+
+def parse_address(address):
+    """Parses a host:port address, or unix:PATH for a Unix domain socket;
+    returns (host, port), or (unix_host, PATH)."""
+    if address.startswith(unix_host + ':'):
+        return unix_host, address[len(unix_host) + 1:]
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def is_stale_socket(path):
+    """Whether path is a Unix domain socket file nothing listens on."""
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            return False
+    except FileNotFoundError:
+        return False
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        return True
+    except OSError:
+        return False
+    finally:
+        probe.close()
+    return False
+
+
+def listening_socket(ip, port, backlog=5):
+    """Returns a socket listening at (ip, port), or at the Unix domain socket
+    path port if ip is unix_host; a stale socket file at the path is replaced,
+    while any other file there makes binding fail."""
+    if ip == unix_host:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if is_stale_socket(port):
+            os.remove(port)
+        s.bind(port)
+    else:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((ip, port))
+    s.listen(backlog)
+    return s
+
+
+def choose_codec(offered):
+    """Picks the first supported codec of a comma-separated list offered
+    during the handshake; returns None if there is none."""
+    for codec in offered.split(','):
+        if codec in codecs:
+            return codec
+    return None
+
 
 class ClientSocket262:
-    """Custom wrapper object for client sockets."""
+    """Custom wrapper object for client sockets.
+
+    Frames are prefixed with their length and a delimiter, which is a
+    backtick for plain frames or identifies the codec of compressed ones.
+    Once a codec is agreed on with set_codec, frames longer than
+    compression_threshold are sent compressed.
+
+    An ip of unix_host connects to the Unix domain socket at path port
+    instead of over TCP; frames are the same.
+    """
     def __init__(self, ip, port, clientsocket=None):
         if clientsocket is not None:
             self.client_socket = clientsocket
+        elif ip == unix_host:
+            self.client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         else:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.client_socket.family != socket.AF_UNIX:
+            # Acks and command outputs are small back-to-back writes; disable
+            # Nagle's algorithm so they are not held back by delayed ACKs
+            self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.ip = ip
         self.port = port
 
+        # Serializes concurrent senders on the same connection
+        self.send_lock = threading.Lock()
+
+        # Compression of sent frames, if agreed on
+        self.compress = None
+        self.compress_delimiter = None
+
+        # Bytes received past the last message returned by receive
+        self.recv_buffer = b''
+
+    def set_codec(self, codec):
+        """Compresses large frames sent from now on with an agreed codec."""
+        if codec is not None:
+            self.compress_delimiter, self.compress, _ = codecs[codec]
+
     def connect(self):
-        self.client_socket.connect((self.ip, self.port))
+        if self.ip == unix_host:
+            self.client_socket.connect(self.port)
+        else:
+            self.client_socket.connect((self.ip, self.port))
 
     def receive(self):
         """Receives a variable length bytes string literal message."""
-        chunks = []
-        total_received = 0
-        msglen_array = []
-        b = None
-
-        # Read length of message in first few bytes
-        while b != b'`':
-            b = self.client_socket.recv(1)
-            msglen_array.append(b.decode('utf-8'))
+        buffer = self.recv_buffer
 
-        del msglen_array[-1] # Delete the backtick delimiter
-        msglen = int(''.join(msglen_array))
+        # Read length of message in first few bytes, up to the delimiter
+        start = 0
+        while True:
+            while start < len(buffer) and buffer[start] in b'0123456789':
+                start += 1
+            if start < len(buffer):
+                break
+            buffer += self.recv_chunk(receive_size)
+        msglen = int(buffer[:start])
+        b = buffer[start:start + 1]
 
         # Read message
+        chunks = [buffer[start + 1:]]
+        total_received = len(chunks[0])
         while total_received < msglen:
-            chunk = self.client_socket.recv(min(msglen - total_received, 2048))
-            if chunk == b'':
-                raise RuntimeError("Socket connection broken.")
+            chunk = self.recv_chunk(max(msglen - total_received, receive_size))
             chunks.append(chunk)
             total_received += len(chunk)
+        buffer = b''.join(chunks)
+        msg, self.recv_buffer = buffer[:msglen], buffer[msglen:]
+
+        if b != b'`':
+            # Compressed message
+            return delimiters[b](msg)
+        return msg
+
+    def has_pending(self):
+        """Whether data from the peer is waiting to be received."""
+        if self.recv_buffer:
+            return True
+        try:
+            return bool(self.client_socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT))
+        except (BlockingIOError, InterruptedError):
+            return False
+
+    def recv_chunk(self, size):
+        """Receives at most size bytes, at least one."""
+        chunk = self.client_socket.recv(size)
+        if chunk == b'':
+            raise RuntimeError("Socket connection broken.")
+        return chunk
 
-        return b''.join(chunks)
+    def frame(self, msg):
+        """Returns the annotated version of a message that send writes."""
+        # Compress large messages if agreed on
+        delimiter = b'`'
+        if self.compress is not None and len(msg) > compression_threshold:
+            compressed = self.compress(msg)
+            if len(compressed) < len(msg):
+                msg, delimiter = compressed, self.compress_delimiter
+
+        # Compute message length and prepend
+        return str(len(msg)).encode('utf-8') + delimiter + msg
 
     def send(self, msg):
         """Sends an annotated version of the variable length bytes string literal message."""
-        # Compute message length and prepend
+        return self.write(self.frame(msg))
+
+    def send_many(self, msgs):
+        """Sends several messages in one write; they are received one by one."""
+        return self.write(b''.join(self.frame(msg) for msg in msgs))
+
+    def write(self, msg):
+        """Writes framed messages to the connection."""
         msglen = len(msg)
-        bstr_msglen = str(msglen).encode('utf-8')
-        msg = bstr_msglen + b'`' + msg
-        msglen += len(bstr_msglen) + 1
 
         # Send message
         total_sent = 0
-        while total_sent < msglen:
-            sent = self.client_socket.send(msg[total_sent:])
-            if sent == 0:
-                raise RuntimeError("Socket connection broken.")
-            total_sent += sent
+        with self.send_lock:
+            while total_sent < msglen:
+                sent = self.client_socket.send(msg[total_sent:])
+                if sent == 0:
+                    raise RuntimeError("Socket connection broken.")
+                total_sent += sent
 
         return total_sent
 
+
+def send_to_all(sockets, msg, timeout=None):
+    """Sends a message to several sockets at once; returns the sockets whose
+    connection broke or which did not take the message within timeout.
+
+    The message is framed once per codec in use. Every socket is first
+    written without blocking, and any remainders are then written as the
+    sockets become writable, so a slow receiver does not hold up the
+    others.
+    """
+    frames = {}
+    pending = {}
+    failed = []
+    for s in sockets:
+        frame = frames.get(s.compress_delimiter)
+        if frame is None:
+            frame = frames[s.compress_delimiter] = s.frame(msg)
+        s.send_lock.acquire()
+        if nonblocking_flag is None:
+            # No per-call non-blocking sends on this platform
+            try:
+                s.client_socket.sendall(frame)
+            except OSError:
+                failed.append(s)
+            s.send_lock.release()
+            continue
+        try:
+            sent = s.client_socket.send(frame, nonblocking_flag)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            failed.append(s)
+            s.send_lock.release()
+            continue
+        if sent < len(frame):
+            pending[s] = memoryview(frame)[sent:]
+        else:
+            s.send_lock.release()
+
+    if pending:
+        deadline = None if timeout is None else time.time() + timeout
+        with selectors.DefaultSelector() as selector:
+            for s in pending:
+                selector.register(s.client_socket, selectors.EVENT_WRITE, s)
+            while pending:
+                wait = None if deadline is None else max(0, deadline - time.time())
+                ready = selector.select(wait)
+                if not ready and deadline is not None and time.time() >= deadline:
+                    break
+                for key, _ in ready:
+                    s = key.data
+                    try:
+                        sent = s.client_socket.send(pending[s], nonblocking_flag)
+                    except BlockingIOError:
+                        continue
+                    except OSError:
+                        sent = None
+                    if sent is not None and sent < len(pending[s]):
+                        pending[s] = pending[s][sent:]
+                        continue
+                    if sent is None:
+                        failed.append(s)
+                    del pending[s]
+                    selector.unregister(s.client_socket)
+                    s.send_lock.release()
+        # Remainders not taken in time
+        for s in pending:
+            failed.append(s)
+            s.send_lock.release()
+
+    return failed
+
 wp = {
     # Protocol related
     'transaction': '0',
@@ -69,6 +289,20 @@ wp = {
     'zip_code': '6',
     # Receipt related
     'output_msg': '7',
+    # Replica coordination related
+    'slot': '8',
+    'replica_id': '9',
+    'phase': '10',
+    'compression': '11',
+    'version': '12',
+    'zip_digits': '13',
+    'expected': '14',
+    'delta': '15',
+    'operations': '16',
+    'status': '17',
+    'query': '18',
+    'match': '19',
+    'limit': '20',
 }
 wp2 = {
     '0': 'transaction',
@@ -79,6 +313,19 @@ wp2 = {
     '5': 'vaccine_no',
     '6': 'zip_code',
     '7': 'output_msg',
+    '8': 'slot',
+    '9': 'replica_id',
+    '10': 'phase',
+    '11': 'compression',
+    '12': 'version',
+    '13': 'zip_digits',
+    '14': 'expected',
+    '15': 'delta',
+    '16': 'operations',
+    '17': 'status',
+    '18': 'query',
+    '19': 'match',
+    '20': 'limit',
 }
 
 def serialize262(field_dict):
@@ -99,3 +346,42 @@ def deserialize262(str_msg):
         field_dict[wp2[match.group(1)]] = match.group(2)
         str_msg = str_msg[index + 1:]
     return field_dict
+
+def read_cluster_config(path, role='replica'):
+    """Reads a cluster configuration; returns {replica ID: (host, port)} of
+    the replicas with a role ('replica' for voting replicas, or 'learner').
+
+    Each line holds a replica ID and the host:port address the replica
+    listens on (or unix:PATH for a Unix domain socket), separated by
+    whitespace, and optionally the role 'learner'; '#' starts a comment.
+    """
+    config = {}
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            replica_id, address, *line_role = line.split()
+            if (line_role or ['replica']) == [role]:
+                config[int(replica_id)] = parse_address(address)
+    return dict(sorted(config.items()))
+
+def write_ready_file(path, replicas, learners={}):
+    """Atomically publishes the {replica ID: (ip, port)} addresses of ready
+    server replicas and learners, as a cluster configuration."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for replica_id, (ip, port) in sorted(replicas.items()):
+            f.write('{} {}:{}\n'.format(replica_id, ip, port))
+        for replica_id, (ip, port) in sorted(learners.items()):
+            f.write('{} {}:{} learner\n'.format(replica_id, ip, port))
+    os.replace(tmp_path, path)
+
+def wait_for_ready_file(path, timeout=None, poll_interval=.005):
+    """Waits until server replicas are ready; returns their (ip, port) addresses."""
+    deadline = None if timeout is None else time.time() + timeout
+    while not os.path.exists(path):
+        if deadline is not None and time.time() > deadline:
+            raise TimeoutError("Server replicas not ready after {}s.".format(timeout))
+        time.sleep(poll_interval)
+    return list(read_cluster_config(path).values())
@@ -1,30 +1,55 @@
+import os
+import re
 import sys
 import time
+import signal
+import socket
+import tempfile
+import threading
 import subprocess
+from socket_utils import ClientSocket262, send_to_all, wait_for_ready_file, read_cluster_config
+from socket_utils import listening_socket, unix_host
+from client import ReplicaClient
 
-# Before running these tests, one must ensure that the pre-specified ports in
-# servers.py are available; otherwise, the servers will not even set up properly
-# to run the tests. This is verified by the first assert statement as a 0th
-# test of sorts.
+# Server replicas listen on ports assigned by the OS and publish their
+# addresses in a readiness file, which clients wait on. Whether the servers
+# set up properly is verified by the first assert statement as a 0th test of
+# sorts.
 
 if __name__ == "__main__":
-    # Start servers
-    servers = subprocess.Popen(["python", "servers.py", "3", "TEST"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    time.sleep(2)
+    # Ordering of server replicas; lamport unless given
+    ordering = sys.argv[1] if len(sys.argv) > 1 else 'lamport'
+    # Transport between clients and replicas; tcp unless given
+    transport = sys.argv[2] if len(sys.argv) > 2 else 'tcp'
+    # Batch execution of stable requests, if given as 'batch'
+    batch_args = ["--batch", "64"] if len(sys.argv) > 3 and sys.argv[3] == 'batch' else []
+
+    # Start servers and wait until they are listening
+    ready_dir = tempfile.mkdtemp()
+    ready_file = os.path.join(ready_dir, 'ready')
+    server_args = ["python", "servers.py", "3", "TEST", "--port", "0", "--ready-file", ready_file, "--ordering", ordering]
+    if transport == 'unix':
+        server_args += ["--unix", ready_dir]
+    server_args += batch_args
+    servers = subprocess.Popen(server_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    wait_for_ready_file(ready_file, timeout=10)
+    client_args = ["python", "client.py", "--ready-file", ready_file]
 
     # Start client 1
-    client1 = subprocess.Popen(["python", "client.py", "8892", "8893", "8894"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    client1 = subprocess.Popen(client_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     # Read 4 lines of startup prompt
     for _ in range(4):
         client1.stdout.readline()
 
-    time.sleep(2)
     assert servers.poll() is None
     assert client1.poll() is None
 
+    # Clients of later clusters, terminated below if started
+    client6 = client7 = client8 = client9 = client10 = client11 = client12 = None
+
     try:
         # Test: Initial list
-        for _ in range(6):
+        for _ in range(11):
             client1.stdout.readline()
         client1.stdin.write(b"l\n")
         client1.stdin.flush()
@@ -37,7 +62,7 @@ if __name__ == "__main__":
         print("Test passed")
 
         # Test: Initial view
-        for _ in range(6):
+        for _ in range(11):
             client1.stdout.readline()
         client1.stdin.write(b"v\nHarvard University\n")
         client1.stdin.flush()
@@ -48,11 +73,11 @@ if __name__ == "__main__":
         print("Test passed")
 
         # Test: List from a second client
-        client2 = subprocess.Popen(["python", "client.py", "8892", "8893", "8894"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        client2 = subprocess.Popen(client_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         # Read 4 lines of startup prompt
         for _ in range(4):
             client2.stdout.readline()
-        for _ in range(6):
+        for _ in range(11):
             client2.stdout.readline()
         client2.stdin.write(b"l\n")
         client2.stdin.flush()
@@ -65,7 +90,7 @@ if __name__ == "__main__":
         print("Test passed")
 
         # Test: Edit from client 1
-        for _ in range(6):
+        for _ in range(11):
             client1.stdout.readline()
         client1.stdin.write(b"e\nHarvard University\n10\n")
         client1.stdin.flush()
@@ -76,7 +101,7 @@ if __name__ == "__main__":
         print("Test passed")
 
         # Test: View updated information from client 2
-        for _ in range(6):
+        for _ in range(11):
             client2.stdout.readline()
         client2.stdin.write(b"v\nHarvard University\n")
         client2.stdin.flush()
@@ -87,7 +112,7 @@ if __name__ == "__main__":
         print("Test passed")
 
         # Test: Add new site from client 2
-        for _ in range(6):
+        for _ in range(11):
             client2.stdout.readline()
         client2.stdin.write(b"n\nMIT\n02138\n")
         client2.stdin.flush()
@@ -98,7 +123,7 @@ if __name__ == "__main__":
         print("Test passed")
 
         # Test: List updated information from client 1
-        for _ in range(6):
+        for _ in range(11):
             client1.stdout.readline()
         client1.stdin.write(b"l\n")
         client1.stdin.flush()
@@ -112,10 +137,18 @@ if __name__ == "__main__":
         assert site2 == b"0,02138,MIT\n"
         print("Test passed")
 
+        # Test: Live replicas give the same reply to a digest query
+        digests = subprocess.run(client_args + ["--digest"], stdout=subprocess.PIPE,
+                                 timeout=30).stdout.splitlines()
+        digests = [line for line in digests if line.startswith(b"State digest after ")]
+        assert len(digests) == 3
+        assert digests[0] == digests[1] == digests[2]
+        print("Test passed")
+
         # Test: Simulate server 0 failure and list from both clients
         servers.stdin.write(b"0\n")
         servers.stdin.flush()
-        for _ in range(6):
+        for _ in range(11):
             client1.stdout.readline()
         client1.stdin.write(b"l\n")
         client1.stdin.flush()
@@ -127,7 +160,7 @@ if __name__ == "__main__":
         assert header == b"Availability,ZIP Code,Site Name\n"
         assert site1 == b"10,02138,Harvard University\n"
         assert site2 == b"0,02138,MIT\n"
-        for _ in range(6):
+        for _ in range(11):
             client2.stdout.readline()
         client2.stdin.write(b"l\n")
         client2.stdin.flush()
@@ -142,14 +175,14 @@ if __name__ == "__main__":
         print("Test passed")
 
         # Test: Quit client 1 and list from client 2
-        for _ in range(6):
+        for _ in range(11):
             client1.stdout.readline()
         client1.stdin.write(b"q\n")
         client1.stdin.flush()
         client1.stdout.readline()
         time.sleep(2)
         assert client1.poll() is not None
-        for _ in range(6):
+        for _ in range(11):
             client2.stdout.readline()
         client2.stdin.write(b"l\n")
         client2.stdin.flush()
@@ -164,7 +197,7 @@ if __name__ == "__main__":
         print("Test passed")
 
         # Test: Add new site from client 2
-        for _ in range(6):
+        for _ in range(11):
             client2.stdout.readline()
         client2.stdin.write(b"n\nBoston University\n02215\n")
         client2.stdin.flush()
@@ -175,11 +208,11 @@ if __name__ == "__main__":
         print("Test passed")
 
         # Test: Initiate client 3 and list updated information
-        client3 = subprocess.Popen(["python", "client.py", "8892", "8893", "8894"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        client3 = subprocess.Popen(client_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         # Read 4 lines of startup prompt
         for _ in range(4):
             client3.stdout.readline()
-        for _ in range(6):
+        for _ in range(11):
             client3.stdout.readline()
         client3.stdin.write(b"l\n")
         client3.stdin.flush()
@@ -195,12 +228,37 @@ if __name__ == "__main__":
         assert site3 == b"0,02138,MIT\n"
         print("Test passed")
 
+        # Test: Search site names by prefix and whole word
+        for _ in range(11):
+            client3.stdout.readline()
+        client3.stdin.write(b"s\nbos\np\n")
+        client3.stdin.flush()
+        client3.stdout.readline()
+        header = client3.stdout.readline()
+        site = client3.stdout.readline()
+        client3.stdout.readline()
+        assert header == b"Site Name\n"
+        assert site == b"Boston University\n"
+        for _ in range(11):
+            client3.stdout.readline()
+        client3.stdin.write(b"s\nUNIVERSITY\nt\n")
+        client3.stdin.flush()
+        client3.stdout.readline()
+        header = client3.stdout.readline()
+        site1 = client3.stdout.readline()
+        site2 = client3.stdout.readline()
+        client3.stdout.readline()
+        assert header == b"Site Name\n"
+        assert site1 == b"Boston University\n"
+        assert site2 == b"Harvard University\n"
+        print("Test passed")
+
         # Test: Initiate client 4 and add new site
-        client4 = subprocess.Popen(["python", "client.py", "8892", "8893", "8894"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        client4 = subprocess.Popen(client_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         # Read 4 lines of startup prompt
         for _ in range(4):
             client4.stdout.readline()
-        for _ in range(6):
+        for _ in range(11):
             client4.stdout.readline()
         client4.stdin.write(b"n\nTufts University\n02155\n")
         client4.stdin.flush()
@@ -213,7 +271,7 @@ if __name__ == "__main__":
         # Test: Simulate server 1 failure and list from all clients
         servers.stdin.write(b"1\n")
         servers.stdin.flush()
-        for _ in range(6):
+        for _ in range(11):
             client2.stdout.readline()
         client2.stdin.write(b"l\n")
         client2.stdin.flush()
@@ -229,7 +287,7 @@ if __name__ == "__main__":
         assert site2 == b"10,02138,Harvard University\n"
         assert site3 == b"0,02138,MIT\n"
         assert site4 == b"0,02155,Tufts University\n"
-        for _ in range(6):
+        for _ in range(11):
             client3.stdout.readline()
         client3.stdin.write(b"l\n")
         client3.stdin.flush()
@@ -245,7 +303,7 @@ if __name__ == "__main__":
         assert site2 == b"10,02138,Harvard University\n"
         assert site3 == b"0,02138,MIT\n"
         assert site4 == b"0,02155,Tufts University\n"
-        for _ in range(6):
+        for _ in range(11):
             client4.stdout.readline()
         client4.stdin.write(b"l\n")
         client4.stdin.flush()
@@ -264,17 +322,17 @@ if __name__ == "__main__":
         print("Test passed")
 
         # Test: Quit all clients, initiate client 5, and list information
-        for _ in range(6):
+        for _ in range(11):
             client2.stdout.readline()
         client2.stdin.write(b"q\n")
         client2.stdin.flush()
         client2.stdout.readline()
-        for _ in range(6):
+        for _ in range(11):
             client3.stdout.readline()
         client3.stdin.write(b"q\n")
         client3.stdin.flush()
         client3.stdout.readline()
-        for _ in range(6):
+        for _ in range(11):
             client4.stdout.readline()
         client4.stdin.write(b"q\n")
         client4.stdin.flush()
@@ -284,11 +342,11 @@ if __name__ == "__main__":
         assert client3.poll() is not None
         assert client4.poll() is not None
         time.sleep(2)
-        client5 = subprocess.Popen(["python", "client.py", "8892", "8893", "8894"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        client5 = subprocess.Popen(client_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         # Read 4 lines of startup prompt
         for _ in range(4):
             client5.stdout.readline()
-        for _ in range(6):
+        for _ in range(11):
             client5.stdout.readline()
         client5.stdin.write(b"l\n")
         client5.stdin.flush()
@@ -307,7 +365,7 @@ if __name__ == "__main__":
         print("Test passed")
 
         # Test: Edit from client 5
-        for _ in range(6):
+        for _ in range(11):
             client5.stdout.readline()
         client5.stdin.write(b"e\nMIT\nFalse\n")
         client5.stdin.flush()
@@ -317,8 +375,100 @@ if __name__ == "__main__":
         assert output == b"Vaccine availability at MIT (ZIP code 02138) updated to False.\n"
         print("Test passed")
 
+        # Test: Aggregate availability by ZIP code prefix from client 5
+        for _ in range(11):
+            client5.stdout.readline()
+        client5.stdin.write(b"a\n02\n3\n")
+        client5.stdin.flush()
+        client5.stdout.readline()
+        header = client5.stdout.readline()
+        group1 = client5.stdout.readline()
+        group2 = client5.stdout.readline()
+        client5.stdout.readline()
+        assert header == b"ZIP Prefix,Sites,Counted,Total,Min,Max,0,1-9,10-99,100-999,1000+\n"
+        assert group1 == b"021*,3,3,10,0,10,2,0,1,0,0\n"
+        assert group2 == b"022*,1,1,0,0,0,1,0,0,0,0\n"
+        print("Test passed")
+
+        # Test: Searches and aggregates with invalid parameters get an error
+        # reply, and replicas keep serving requests afterwards
+        raw_client = ReplicaClient(list(read_cluster_config(ready_file).values()))
+        raw_client.connect()
+        for limit in ('ten', '0', '-1', '', '20.5'):
+            output = raw_client.request({'transaction': 's', 'query': 'bos', 'limit': limit})['output_msg']
+            assert output == 'Search limit must be a positive integer.'
+        for zip_digits in ('three', '-3'):
+            output = raw_client.request({'transaction': 'a', 'zip_code': '02',
+                                         'zip_digits': zip_digits})['output_msg']
+            assert output == 'Number of digits must be a nonnegative integer.'
+        output = raw_client.request({'transaction': 's', 'query': 'bos', 'limit': '1'})['output_msg']
+        assert output == 'Site Name\nBoston University'
+        raw_client.close()
+        print("Test passed")
+
+        # Test: Compare-and-set with a stale expected availability
+        for _ in range(11):
+            client5.stdout.readline()
+        client5.stdin.write(b"c\nHarvard University\n5\n7\n")
+        client5.stdin.flush()
+        client5.stdout.readline()
+        output = client5.stdout.readline()
+        client5.stdout.readline()
+        assert output == b"Vaccine availability at Harvard University is 10, not 5; not updated.\n"
+        print("Test passed")
+
+        # Test: Remove vaccines, then fail to remove more than available
+        for _ in range(11):
+            client5.stdout.readline()
+        client5.stdin.write(b"u\nHarvard University\n-4\n")
+        client5.stdin.flush()
+        client5.stdout.readline()
+        output = client5.stdout.readline()
+        client5.stdout.readline()
+        assert output == b"Vaccine availability at Harvard University (ZIP code 02138) updated to 6.\n"
+        for _ in range(11):
+            client5.stdout.readline()
+        client5.stdin.write(b"u\nHarvard University\n-7\n")
+        client5.stdin.flush()
+        client5.stdout.readline()
+        output = client5.stdout.readline()
+        client5.stdout.readline()
+        assert output == b"Only 6 vaccines available at Harvard University; not updated.\n"
+        print("Test passed")
+
+        # Test: Move vaccines between sites in one transaction, then abort
+        # one that would overdraw a site
+        for _ in range(11):
+            client5.stdout.readline()
+        client5.stdin.write(b"t\nHarvard University\nu\n-6\nTufts University\nu\n6\n\n")
+        client5.stdin.flush()
+        client5.stdout.readline()
+        outcome = client5.stdout.readline()
+        header = client5.stdout.readline()
+        site1 = client5.stdout.readline()
+        site2 = client5.stdout.readline()
+        client5.stdout.readline()
+        assert outcome == b"Transaction committed.\n"
+        assert header == b"Result,Availability,Site Name\n"
+        assert site1 == b"ok,0,Harvard University\n"
+        assert site2 == b"ok,6,Tufts University\n"
+        for _ in range(11):
+            client5.stdout.readline()
+        client5.stdin.write(b"t\nBoston University\ne\n3\nHarvard University\nu\n-1\n\n")
+        client5.stdin.flush()
+        client5.stdout.readline()
+        outcome = client5.stdout.readline()
+        client5.stdout.readline()
+        site1 = client5.stdout.readline()
+        site2 = client5.stdout.readline()
+        client5.stdout.readline()
+        assert outcome == b"Transaction aborted; no site was updated.\n"
+        assert site1 == b"aborted,0,Boston University\n"
+        assert site2 == b"insufficient,0,Harvard University\n"
+        print("Test passed")
+
         # Test: Quit client 5
-        for _ in range(6):
+        for _ in range(11):
             client5.stdout.readline()
         client5.stdin.write(b"q\n")
         client5.stdin.flush()
@@ -326,21 +476,366 @@ if __name__ == "__main__":
         time.sleep(2)
         assert client5.poll() is not None
 
-        # Test: Compare server replica execution logs
+        # Test: Compare server replica digests at every executed command
         # (Replica Coordination / Semantic Characterization of SM, Schneider)
-        log_texts = []
-        f_8892 = open('test_log_8892.txt', 'r')
-        f_8893 = open('test_log_8893.txt', 'r')
-        f_8894 = open('test_log_8894.txt', 'r')
-        log_texts.append(f_8892.read())
-        log_texts.append(f_8893.read())
-        log_texts.append(f_8894.read())
-        f_8892.close()
-        f_8893.close()
-        f_8894.close()
-        log_texts.sort(key = lambda x: len(x))
-        assert log_texts[0] == log_texts[1][:len(log_texts[0])]
-        assert log_texts[1] == log_texts[2][:len(log_texts[1])]
+        servers.terminate()
+        output = servers.communicate()[0]
+        summary = re.search(rb'Compared (\d+) digest checkpoints; (\d+) divergent.', output)
+        assert int(summary.group(1)) > 0
+        assert int(summary.group(2)) == 0
+        print("Test passed")
+
+        # Test: Simulated replicas agree despite a crash, and a simulation is
+        # reproducible from its seed
+        sim_args = ["python", "simulator.py", "--replicas", "3", "--clients", "20",
+                    "--duration", "3", "--ordering", ordering, "--crash", "2:0", "--seed", "5"]
+        runs = [subprocess.run(sim_args, stdout=subprocess.PIPE).stdout.splitlines()[:3]
+                for _ in range(2)]
+        assert runs[0] == runs[1]
+        assert b'requests in' in runs[0][0]
+        assert re.match(rb'Replica digests agree at [1-9]\d* checkpoints', runs[0][2])
+        print("Test passed")
+
+        # Test: A client reads its own write from a learner, which agrees
+        # with the replicas at every command it applies
+        learner_file = os.path.join(ready_dir, 'learner-ready')
+        learner_args = ["python", "servers.py", "2", "TEST", "--port", "0", "--learners", "1",
+                        "--ready-file", learner_file, "--ordering", ordering]
+        if transport == 'unix':
+            learner_args += ["--unix", ready_dir]
+        learner_args += batch_args
+        servers = subprocess.Popen(learner_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        wait_for_ready_file(learner_file, timeout=10)
+        client6 = subprocess.Popen(["python", "client.py", "--ready-file", learner_file],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # Read 4 lines of startup prompt
+        for _ in range(4):
+            client6.stdout.readline()
+        # Reads sent to the replicas are streamed to the learner, which
+        # counts them and folds them into its digests like the replicas
+        replica_client = ReplicaClient(list(read_cluster_config(learner_file).values()))
+        replica_client.connect()
+        for _ in range(2):
+            replica_client.request({'transaction': 'l'})
+            replica_client.request({'transaction': 'a', 'zip_code': '', 'zip_digits': '3'})
+        replica_client.close()
+        for _ in range(11):
+            client6.stdout.readline()
+        client6.stdin.write(b"n\nMIT\n02139\n")
+        client6.stdin.flush()
+        client6.stdout.readline()
+        output = client6.stdout.readline()
+        client6.stdout.readline()
+        assert output == b"MIT (ZIP code 02139) added with vaccine availability 0.\n"
+        for _ in range(11):
+            client6.stdout.readline()
+        client6.stdin.write(b"v\nMIT\n")
+        client6.stdin.flush()
+        client6.stdout.readline()
+        output = client6.stdout.readline()
+        client6.stdout.readline()
+        assert output == b"Availability at MIT (ZIP code 02139): 0\n"
+        if ordering == 'lamport':
+            # The learner follows another replica once the stream of replica 0
+            # goes quiet; with the stability test, replica 1 keeps executing
+            # meanwhile
+            with open('/proc/{0}/task/{0}/children'.format(servers.pid)) as f:
+                replica_pids = sorted(int(pid) for pid in f.read().split())
+            os.kill(replica_pids[0], signal.SIGSTOP)
+            for _ in range(11):
+                client6.stdout.readline()
+            client6.stdin.write(b"e\nMIT\n5\n")
+            client6.stdin.flush()
+            client6.stdout.readline()
+            output = client6.stdout.readline()
+            client6.stdout.readline()
+            assert output == b"Vaccine availability at MIT (ZIP code 02139) updated to 5.\n"
+            for _ in range(11):
+                client6.stdout.readline()
+            client6.stdin.write(b"v\nMIT\n")
+            client6.stdin.flush()
+            client6.stdout.readline()
+            output = client6.stdout.readline()
+            client6.stdout.readline()
+            os.kill(replica_pids[0], signal.SIGCONT)
+            assert output == b"Availability at MIT (ZIP code 02139): 5\n"
+        for _ in range(11):
+            client6.stdout.readline()
+        client6.stdin.write(b"q\n")
+        client6.stdin.flush()
+        client6.stdout.readline()
+        time.sleep(2)
+        assert client6.poll() is not None
+        servers.terminate()
+        output = servers.communicate()[0]
+        summary = re.search(rb'Compared (\d+) digest checkpoints; (\d+) divergent.', output)
+        assert int(summary.group(1)) > 0
+        assert int(summary.group(2)) == 0
+        print("Test passed")
+
+        # Test: A replica that a client dropped after its ack timeout lets the
+        # client leave its total order, and keeps serving other clients once
+        # it is the last replica
+        drop_file = os.path.join(ready_dir, 'drop-ready')
+        drop_args = ["python", "servers.py", "3", "TEST", "--port", "0",
+                     "--ready-file", drop_file, "--ordering", ordering]
+        if transport == 'unix':
+            drop_args += ["--unix", ready_dir]
+        drop_args += batch_args
+        servers = subprocess.Popen(drop_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        wait_for_ready_file(drop_file, timeout=10)
+        with open('/proc/{0}/task/{0}/children'.format(servers.pid)) as f:
+            replica_pids = sorted(int(pid) for pid in f.read().split())
+        client7 = subprocess.Popen(["python", "client.py", "--ready-file", drop_file, "--ack-timeout", ".5"],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # Read 4 lines of startup prompt
+        for _ in range(4):
+            client7.stdout.readline()
+        # Replica 1 misses the ack timeout of client 7, which drops it
+        os.kill(replica_pids[1], signal.SIGSTOP)
+        time.sleep(1.5)
+        os.kill(replica_pids[1], signal.SIGCONT)
+        # A request that replica 1 never receives, yet is sequenced
+        for _ in range(11):
+            client7.stdout.readline()
+        client7.stdin.write(b"v\nHarvard University\n")
+        client7.stdin.flush()
+        client7.stdout.readline()
+        output = client7.stdout.readline()
+        client7.stdout.readline()
+        assert output == b"Availability at Harvard University (ZIP code 02138): 0\n"
+        servers.stdin.write(b"0\n2\n")
+        servers.stdin.flush()
+        client8 = subprocess.Popen(["python", "client.py", "--ready-file", drop_file],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        watchdog = threading.Timer(20, client8.kill)
+        watchdog.start()
+        # Read 4 lines of startup prompt
+        for _ in range(4):
+            client8.stdout.readline()
+        for _ in range(11):
+            client8.stdout.readline()
+        client8.stdin.write(b"v\nHarvard University\n")
+        client8.stdin.flush()
+        client8.stdout.readline()
+        output = client8.stdout.readline()
+        client8.stdout.readline()
+        watchdog.cancel()
+        assert output == b"Availability at Harvard University (ZIP code 02138): 0\n"
+        client7.terminate()
+        client8.terminate()
+        servers.terminate()
+        servers.communicate()
+        print("Test passed")
+
+        # Test: A client sending listings without waiting for their outputs
+        # is held back by its backlog limit (backpressure) while another
+        # client is served, and replicas agree at every executed command
+        backlog_file = os.path.join(ready_dir, 'backlog-ready')
+        backlog_args = ["python", "servers.py", "3", "TEST", "--port", "0", "--client-backlog", "1",
+                        "--ready-file", backlog_file, "--ordering", ordering]
+        if transport == 'unix':
+            backlog_args += ["--unix", ready_dir]
+        backlog_args += batch_args
+        servers = subprocess.Popen(backlog_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        wait_for_ready_file(backlog_file, timeout=10)
+        busy = ReplicaClient(list(read_cluster_config(backlog_file).values()))
+        busy.connect()
+        request_seqnos = []
+        busy_thread = threading.Thread(target=lambda: request_seqnos.extend(
+            busy.send_request({'transaction': 'l'})[0] for _ in range(50)))
+        busy_thread.start()
+        client9 = subprocess.Popen(["python", "client.py", "--ready-file", backlog_file],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        watchdog = threading.Timer(20, client9.kill)
+        watchdog.start()
+        # Read 4 lines of startup prompt
+        for _ in range(4):
+            client9.stdout.readline()
+        for _ in range(11):
+            client9.stdout.readline()
+        client9.stdin.write(b"v\nHarvard University\n")
+        client9.stdin.flush()
+        client9.stdout.readline()
+        output = client9.stdout.readline()
+        client9.stdout.readline()
+        watchdog.cancel()
+        assert output == b"Availability at Harvard University (ZIP code 02138): 0\n"
+        busy_thread.join(20)
+        listed = set()
+        while len(listed) < 50:
+            fields = busy.output_queue.get(timeout=10)
+            assert fields['output_msg'].startswith('Availability,ZIP Code,Site Name')
+            listed.add(int(fields['rseqno']))
+        assert listed == set(request_seqnos)
+        busy.close()
+        client9.terminate()
+        servers.terminate()
+        output = servers.communicate()[0]
+        summary = re.search(rb'Compared (\d+) digest checkpoints; (\d+) divergent.', output)
+        assert int(summary.group(1)) > 0
+        assert int(summary.group(2)) == 0
+        print("Test passed")
+
+        # Test: A client that stalls past its lease does not hold up other
+        # clients, and is served again once it resumes and rejoins
+        lease_file = os.path.join(ready_dir, 'lease-ready')
+        lease_args = ["python", "servers.py", "3", "TEST", "--port", "0", "--lease", ".5",
+                      "--ready-file", lease_file, "--ordering", ordering]
+        if transport == 'unix':
+            lease_args += ["--unix", ready_dir]
+        lease_args += batch_args
+        servers = subprocess.Popen(lease_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        wait_for_ready_file(lease_file, timeout=10)
+        client10 = subprocess.Popen(["python", "client.py", "--ready-file", lease_file],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        client11 = subprocess.Popen(["python", "client.py", "--ready-file", lease_file],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        watchdog = threading.Timer(30, lambda: (client10.kill(), client11.kill()))
+        watchdog.start()
+        # Read 4 lines of startup prompt
+        for _ in range(4):
+            client10.stdout.readline()
+            client11.stdout.readline()
+        os.kill(client10.pid, signal.SIGSTOP)
+        for _ in range(11):
+            client11.stdout.readline()
+        client11.stdin.write(b"e\nHarvard University\n7\n")
+        client11.stdin.flush()
+        client11.stdout.readline()
+        output = client11.stdout.readline()
+        client11.stdout.readline()
+        assert output == b"Vaccine availability at Harvard University (ZIP code 02138) updated to 7.\n"
+        time.sleep(1)
+        # The request of client 10 is sent right as it resumes, so it is
+        # either sent after rejoining or dropped and sent again
+        client10.stdin.write(b"v\nHarvard University\n")
+        client10.stdin.flush()
+        os.kill(client10.pid, signal.SIGCONT)
+        for _ in range(11):
+            client10.stdout.readline()
+        client10.stdout.readline()
+        output = client10.stdout.readline()
+        client10.stdout.readline()
+        watchdog.cancel()
+        assert output == b"Availability at Harvard University (ZIP code 02138): 7\n"
+        client10.terminate()
+        client11.terminate()
+        servers.terminate()
+        output = servers.communicate()[0]
+        summary = re.search(rb'Compared (\d+) digest checkpoints; (\d+) divergent.', output)
+        assert int(summary.group(1)) > 0
+        assert int(summary.group(2)) == 0
+        print("Test passed")
+
+        # Test: Clients that offer zlib compression agree on it with every
+        # replica, and list more sites than fit in an uncompressed 1 KiB
+        sites_file = os.path.join(ready_dir, 'sites-ready')
+        sites_args = ["python", "servers.py", "3", "TEST", "--port", "0",
+                      "--ready-file", sites_file, "--ordering", ordering]
+        if transport == 'unix':
+            sites_args += ["--unix", ready_dir]
+        sites_args += batch_args
+        servers = subprocess.Popen(sites_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        wait_for_ready_file(sites_file, timeout=10)
+        sites_client = ReplicaClient(list(read_cluster_config(sites_file).values()), compression=['zlib'])
+        sites_client.connect()
+        assert all(s.compress is not None for s in sites_client.sockets)
+        for i in range(100):
+            sites_client.request({'transaction': 'n', 'site_name': 'Site {:02}'.format(i),
+                                  'zip_code': '02139'})
+        listing = sites_client.request({'transaction': 'l'})['output_msg']
+        assert len(listing) > 1024
+        client12 = subprocess.Popen(["python", "client.py", "--ready-file", sites_file,
+                                     "--compression", "zlib"],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # Read 4 lines of startup prompt
+        for _ in range(4):
+            client12.stdout.readline()
+        for _ in range(11):
+            client12.stdout.readline()
+        client12.stdin.write(b"l\n")
+        client12.stdin.flush()
+        client12.stdout.readline()
+        rows = [client12.stdout.readline() for _ in range(102)]
+        client12.stdout.readline()
+        assert b"".join(rows).decode() == listing + "\n"
+        assert rows[-1] == b"0,02139,Site 99\n"
+        print("Test passed")
+
+        # Test: A repeated listing is answered from the cache of the client
+        # while the sites are unchanged, and sent again once one changed;
+        # digest queries flush outputs still on the way before counting
+        sites_client.digests()
+        output_bytes = sites_client.output_bytes
+        assert sites_client.request({'transaction': 'l'})['output_msg'] == listing
+        digests = sites_client.digests()
+        assert sites_client.output_bytes == output_bytes + sum(map(len, digests))
+        sites_client.request({'transaction': 'e', 'site_name': 'Site 00', 'vaccine_no': '3'})
+        sites_client.digests()
+        output_bytes = sites_client.output_bytes
+        output = sites_client.request({'transaction': 'l'})['output_msg']
+        assert "3,02139,Site 00" in output
+        digests = sites_client.digests()
+        assert sites_client.output_bytes == output_bytes + 3 * len(output) + sum(map(len, digests))
+        print("Test passed")
+
+        sites_client.close()
+        client12.terminate()
+        servers.terminate()
+        servers.communicate()
+
+        # Test: A broadcast reaches every receiver while one does not read,
+        # which is reported once the timeout passes
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('localhost', 0))
+        listener.listen()
+        senders, receivers = [], []
+        for _ in range(3):
+            s = ClientSocket262(*listener.getsockname())
+            s.connect()
+            senders.append(s)
+            receivers.append(ClientSocket262(None, None, listener.accept()[0]))
+        msg = os.urandom(1 << 25)
+        received = []
+        readers = [threading.Thread(target=lambda r=r: received.append(r.receive()))
+                   for r in receivers[1:]]
+        for t in readers:
+            t.start()
+        assert send_to_all(senders, msg, timeout=1) == [senders[0]]
+        for t in readers:
+            t.join()
+        assert received == [msg, msg]
+        for s in senders + receivers:
+            s.client_socket.close()
+        listener.close()
+        print("Test passed")
+
+        # Test: Listening on a Unix domain socket replaces a stale socket
+        # file, but neither a socket in use nor any other file
+        path = os.path.join(ready_dir, 'test.sock')
+        with open(path, 'w') as f:
+            f.write('not a socket')
+        try:
+            listening_socket(unix_host, path)
+            assert False
+        except OSError:
+            pass
+        with open(path) as f:
+            assert f.read() == 'not a socket'
+        os.remove(path)
+        listener = listening_socket(unix_host, path)
+        try:
+            listening_socket(unix_host, path)
+            assert False
+        except OSError:
+            pass
+        listener.close()
+        assert os.path.exists(path)
+        listener = listening_socket(unix_host, path)
+        listener.close()
+        os.remove(path)
+        print("Test passed")
 
     except AssertionError:
         print('An assertion failed.')
@@ -351,6 +846,9 @@ if __name__ == "__main__":
     client3.terminate()
     client4.terminate()
     client5.terminate()
+    for client in (client6, client7, client8, client9, client10, client11, client12):
+        if client is not None:
+            client.terminate()
     servers.terminate()
     time.sleep(2)
 